@@ -0,0 +1,67 @@
+"""Compare connect and query latency for database execution backends.
+
+Run as:
+
+  python benchmarks/backends.py [--iterations N] [--dsn DSN]
+
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from query_exporter.db import (
+    BACKENDS,
+    DataBase,
+    Query,
+    QueryMetric,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--dsn", default="sqlite://")
+    return parser.parse_args()
+
+
+def report(name: str, timings):
+    mean = statistics.mean(timings) * 1e6
+    p99 = sorted(timings)[int(len(timings) * 0.99)] * 1e6
+    print(f"  {name:<8} mean {mean:8.1f}us  p99 {p99:8.1f}us")
+
+
+async def bench_backend(backend: str, dsn: str, iterations: int):
+    query = Query("q", None, ["db"], [QueryMetric("m", [])], "SELECT 1 AS m")
+    db = DataBase("db", dsn, backend=backend)
+
+    connect_times = []
+    for _ in range(iterations // 10 or 1):
+        start = time.perf_counter()
+        await db.connect()
+        connect_times.append(time.perf_counter() - start)
+        await db.close()
+
+    query_times = []
+    await db.connect()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await db.execute(query)
+        query_times.append(time.perf_counter() - start)
+    await db.close()
+
+    print(f"backend: {backend}")
+    report("connect", connect_times)
+    report("query", query_times)
+
+
+def main():
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    for backend in BACKENDS:
+        loop.run_until_complete(bench_backend(backend, args.dsn, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
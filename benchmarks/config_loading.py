@@ -0,0 +1,109 @@
+"""Time loading of large synthetic configuration files.
+
+The generated config has the specified number of databases, queries and
+metrics, with each query running on a few databases and updating a few
+metrics.
+
+Run as:
+
+  python benchmarks/config_loading.py [--queries N] [--databases N]
+    [--metrics N] [--iterations N]
+
+"""
+
+import argparse
+import io
+import logging
+import statistics
+import time
+
+import yaml
+
+from query_exporter.config import (
+    _validate_config,
+    load_config,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--databases", type=int, default=1000)
+    parser.add_argument("--metrics", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=3)
+    return parser.parse_args()
+
+
+def make_config(queries: int, databases: int, metrics: int) -> str:
+    """Return the text for a synthetic config."""
+    config = {
+        "databases": {
+            f"db{index}": {
+                "dsn": f"sqlite:////tmp/db{index}.sqlite",
+                "pool-size": 2,
+                "labels": {"region": f"region{index % 10}"},
+            }
+            for index in range(databases)
+        },
+        "metrics": {
+            f"metric{index}": {
+                "type": "gauge",
+                "description": f"Metric {index}",
+                "labels": ["table", "schema"],
+            }
+            for index in range(metrics)
+        },
+        "queries": {
+            f"query{index}": {
+                "interval": "1m",
+                "databases": [
+                    f"db{(index + offset) % databases}" for offset in range(3)
+                ],
+                "metrics": [
+                    f"metric{(index + offset) % metrics}" for offset in range(2)
+                ],
+                "sql": (
+                    f"SELECT count(*) AS metric{index % metrics}, "
+                    f"sum(size) AS metric{(index + 1) % metrics}, "
+                    "table_name AS table, schema_name AS schema "
+                    f"FROM stats WHERE kind = {index} "
+                    "GROUP BY table_name, schema_name"
+                ),
+            }
+            for index in range(queries)
+        },
+    }
+    return yaml.dump(config)
+
+
+def bench(name: str, func, iterations: int):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    mean = statistics.mean(timings)
+    print(f"  {name:<12} mean {mean:8.3f}s  min {min(timings):8.3f}s")
+
+
+def main():
+    args = parse_args()
+    text = make_config(args.queries, args.databases, args.metrics)
+    print(
+        f"config with {args.queries} queries, {args.databases} databases, "
+        f"{args.metrics} metrics ({text.count(chr(10))} lines)"
+    )
+    # don't report unused databases and metrics at each iteration
+    logger = logging.getLogger("config-loading")
+    logger.disabled = True
+    iterations = args.iterations
+    data = yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    bench("yaml (pure)", lambda: yaml.load(text, Loader=yaml.SafeLoader), iterations)
+    if hasattr(yaml, "CSafeLoader"):
+        bench("yaml (C)", lambda: yaml.load(text, Loader=yaml.CSafeLoader), iterations)
+    bench("validation", lambda: _validate_config(data), iterations)
+    bench("load_config", lambda: load_config(io.StringIO(text), logger), iterations)
+
+
+if __name__ == "__main__":
+    main()
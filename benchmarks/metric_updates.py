@@ -0,0 +1,98 @@
+"""Measure throughput of metric updates from query results.
+
+Compares the previous update path (building labels and a debug message, and
+looking up the labeled metric from the registry on every update) with the
+cached update methods used by QueryLoop.
+
+Run as:
+
+  python benchmarks/metric_updates.py [--series N] [--updates N]
+
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from prometheus_aioexporter import (
+    MetricConfig,
+    MetricsRegistry,
+)
+
+from query_exporter.config import (
+    Config,
+    DATABASE_LABEL,
+)
+from query_exporter.db import DataBase
+from query_exporter.loop import QueryLoop
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--series", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=1000000)
+    return parser.parse_args()
+
+
+def make_query_loop() -> QueryLoop:
+    database = DataBase("db", "sqlite://", labels={"region": "eu"})
+    metric = MetricConfig(
+        "metric", "A metric", "gauge", {"labels": ["database", "l1", "l2", "region"]}
+    )
+    config = Config({"db": database}, {"metric": metric}, {})
+    registry = MetricsRegistry()
+    registry.create_metrics([metric])
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    return QueryLoop(config, registry, logger)
+
+
+def uncached_update(query_loop: QueryLoop, database, name, value, labels):
+    """Update a metric as done before update methods were cached."""
+    method = query_loop._METRIC_METHODS[query_loop._config.metrics[name].type]
+    all_labels = {DATABASE_LABEL: database.name}
+    all_labels.update(database.labels)
+    all_labels.update(labels)
+    labels_string = ",".join(
+        f'{label}="{value}"' for label, value in sorted(all_labels.items())
+    )
+    query_loop._logger.debug(
+        f'updating metric "{name}" {method} {value} {{{labels_string}}}'
+    )
+    metric = query_loop._registry.get_metric(name, labels=all_labels)
+    getattr(metric, method)(value)
+
+
+def bench(update, query_loop: QueryLoop, series: int, updates: int) -> float:
+    database = query_loop._config.databases["db"]
+    labels = [{"l1": f"a{index}", "l2": f"b{index % 10}"} for index in range(series)]
+    start = time.perf_counter()
+    for index in range(updates):
+        update(database, "metric", float(index), labels[index % series])
+    return time.perf_counter() - start
+
+
+def report(name: str, updates: int, elapsed: float):
+    print(f"{name:<10} {updates / elapsed:,.0f} updates/s")
+
+
+def main():
+    args = parse_args()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    print(f"{args.updates} updates over {args.series} series")
+    query_loop = make_query_loop()
+    elapsed = bench(
+        lambda *args: uncached_update(query_loop, *args),
+        query_loop,
+        args.series,
+        args.updates,
+    )
+    report("uncached", args.updates, elapsed)
+    query_loop = make_query_loop()
+    elapsed = bench(query_loop._update_metric, query_loop, args.series, args.updates)
+    report("cached", args.updates, elapsed)
+
+
+if __name__ == "__main__":
+    main()
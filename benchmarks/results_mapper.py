@@ -0,0 +1,92 @@
+"""Measure throughput of mapping query results rows to metric results.
+
+Compares the previous per-row mapping (building a dict for every row and
+checking values types when updating metrics) with the compiled mapper used by
+Query.results.
+
+Run as:
+
+  python benchmarks/results_mapper.py [--rows N] [--repeat N]
+
+"""
+
+import argparse
+from decimal import Decimal
+import time
+
+from query_exporter.db import (
+    MetricResult,
+    Query,
+    QueryMetric,
+    QueryResults,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def uncompiled_results(query: Query, query_results: QueryResults):
+    """Map results as done before mappers were compiled."""
+    result_keys = sorted(query_results.keys)
+    metrics = [metric.name for metric in query.metrics]
+    expected_keys = sorted(set(metrics) | query.labels())
+    assert result_keys == expected_keys
+    results = []
+    for row in query_results.rows:
+        values = dict(zip(query_results.keys, row))
+        for metric in query.metrics:
+            value = values[metric.name]
+            if value is None:
+                value = 0.0
+            elif isinstance(value, Decimal):
+                value = float(value)
+            metric_result = MetricResult(
+                metric.name, value, {label: values[label] for label in metric.labels},
+            )
+            results.append(metric_result)
+    return results
+
+
+def bench(name: str, func, rows: int, repeat: int):
+    best = min(timed(func) for _ in range(repeat))
+    print(f"{name:<12} {best * 1e3:8.1f}ms  {rows / best:12.0f} rows/s")
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    query = Query(
+        "q",
+        10,
+        ["db"],
+        [QueryMetric("m1", ["l1", "l2"]), QueryMetric("m2", ["l1"])],
+        "",
+    )
+    query_results = QueryResults(
+        ["l1", "m1", "l2", "m2"],
+        [
+            (f"a{i % 100}", Decimal(i), f"b{i}", None if i % 10 else i)
+            for i in range(args.rows)
+        ],
+    )
+    assert uncompiled_results(query, query_results) == query.results(query_results)
+    bench(
+        "uncompiled",
+        lambda: uncompiled_results(query, query_results),
+        args.rows,
+        args.repeat,
+    )
+    bench("compiled", lambda: query.results(query_results), args.rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Measure scheduling overhead for a large number of periodic calls.
+
+Calls are scheduled with intervals between 10 and 300 seconds and run on a
+simulated clock, so that only the time spent scheduling calls is measured.
+
+The Scheduler is compared with a separate loop timer for each periodic call
+(as previously done with a PeriodicCall for each query).
+
+Run as:
+
+  python benchmarks/scheduler.py [--calls N] [--duration SECONDS]
+
+"""
+
+import argparse
+import asyncio
+import heapq
+import random
+import time
+
+from query_exporter.schedule import (
+    phase_offset,
+    ScheduledCall,
+    Scheduler,
+)
+
+INTERVALS = [10, 15, 30, 60, 120, 300]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=10000)
+    parser.add_argument("--duration", type=int, default=3600)
+    return parser.parse_args()
+
+
+def make_loop() -> asyncio.AbstractEventLoop:
+    """Return an event loop with a manually advanced clock."""
+    loop = asyncio.new_event_loop()
+    loop.now = 0.0
+    loop.time = lambda: loop.now
+    return loop
+
+
+def run_timers(loop: asyncio.AbstractEventLoop, duration: int):
+    """Run loop timers until the duration expires."""
+    scheduled = loop._scheduled
+    while scheduled and loop.now < duration:
+        timer = heapq.heappop(scheduled)
+        loop.now = timer.when()
+        if not timer.cancelled():
+            timer._run()
+
+
+def bench_scheduler(calls: int, duration: int):
+    loop = make_loop()
+    scheduler = Scheduler(loop)
+    runs = 0
+
+    def func():
+        nonlocal runs
+        runs += 1
+
+    for index in range(calls):
+        key = f"query{index}:db"
+        interval = random.choice(INTERVALS)
+        offset = phase_offset(key, interval)
+        scheduler.add(ScheduledCall(key, func, interval, offset=offset, jitter=1.0))
+    scheduler.start()
+    start = time.perf_counter()
+    run_timers(loop, duration)
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+    loop.close()
+    return runs, elapsed
+
+
+def bench_timers(calls: int, duration: int):
+    loop = make_loop()
+    runs = 0
+
+    def func(interval: float):
+        nonlocal runs
+        runs += 1
+        loop.call_at(loop.now + interval, func, interval)
+
+    for _ in range(calls):
+        loop.call_at(0.0, func, random.choice(INTERVALS))
+    start = time.perf_counter()
+    run_timers(loop, duration)
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return runs, elapsed
+
+
+def report(name: str, runs: int, elapsed: float):
+    print(
+        f"{name:<10} {runs} calls in {elapsed * 1e3:.1f}ms "
+        f"({elapsed / runs * 1e6:.2f}us/call)"
+    )
+
+
+def main():
+    args = parse_args()
+    print(f"{args.calls} periodic calls over {args.duration} seconds")
+    report("timers", *bench_timers(args.calls, args.duration))
+    report("scheduler", *bench_scheduler(args.calls, args.duration))
+
+
+if __name__ == "__main__":
+    main()
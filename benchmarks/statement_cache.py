@@ -0,0 +1,91 @@
+"""Compare per-execution overhead of wrapping and compiling query SQL text
+against reusing a cached compiled statement.
+
+Run as:
+
+  python benchmarks/statement_cache.py [--iterations N] [--dsn DSN]
+
+"""
+
+import argparse
+import statistics
+import time
+
+import sqlalchemy
+
+from query_exporter.db import (
+    Query,
+    QueryMetric,
+)
+
+SQL = """
+SELECT :a AS m1, :b AS m2, 'label' AS l
+WHERE :a IS NOT NULL AND :b IS NOT NULL
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--dsn", default="sqlite://")
+    return parser.parse_args()
+
+
+def report(name: str, timings):
+    mean = statistics.mean(timings) * 1e6
+    p99 = sorted(timings)[int(len(timings) * 0.99)] * 1e6
+    print(f"  {name:<10} mean {mean:8.1f}us  p99 {p99:8.1f}us")
+
+
+def bench(name: str, conn, get_statement, parameters, iterations: int):
+    prepare_times = []
+    execute_times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        statement = get_statement()
+        prepared = time.perf_counter()
+        conn.execute(statement, parameters).fetchall()
+        end = time.perf_counter()
+        prepare_times.append(prepared - start)
+        execute_times.append(end - start)
+    print(name)
+    report("prepare", prepare_times)
+    report("total", execute_times)
+
+
+def main():
+    args = parse_args()
+    parameters = {"a": 1, "b": 2}
+    query = Query(
+        "q",
+        None,
+        ["db"],
+        [QueryMetric("m1", ["l"]), QueryMetric("m2", ["l"])],
+        SQL,
+        parameters=parameters,
+    )
+    engine = sqlalchemy.create_engine(args.dsn)
+    with engine.connect() as conn:
+        dialect = conn.dialect
+        bench(
+            "uncached (text + compile)",
+            conn,
+            lambda: sqlalchemy.text(SQL).compile(dialect=dialect),
+            parameters,
+            args.iterations,
+        )
+        bench(
+            "cached compiled statement",
+            conn,
+            lambda: query.compiled_statement(dialect),
+            parameters,
+            args.iterations,
+        )
+    print(
+        f"cache hits: {query.compiled_cache_hits}, "
+        f"misses: {query.compiled_cache_misses}"
+    )
+
+
+if __name__ == "__main__":
+    main()
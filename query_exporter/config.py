@@ -1,20 +1,28 @@
 """Configuration management functions."""
 
-from collections import defaultdict
-from copy import deepcopy
+from collections import (
+    ChainMap,
+    defaultdict,
+)
+from functools import lru_cache
+import hashlib
 from logging import Logger
 import os
 import re
 from typing import (
+    AbstractSet,
     Any,
+    cast,
     Dict,
     FrozenSet,
     IO,
     List,
     Mapping,
     NamedTuple,
+    Optional,
     Set,
     Tuple,
+    Union,
 )
 
 import jsonschema
@@ -23,12 +31,23 @@ import yaml
 
 from . import PACKAGE
 from .db import (
+    AdaptiveInterval,
+    batch_query_sql,
+    CircuitBreaker,
     DataBase,
     DATABASE_LABEL,
     InvalidQueryParameters,
+    LabelFilter,
     Query,
     QueryMetric,
 )
+from .schedule import valid_schedule
+
+# use the libyaml-based loader, if available, as it's much faster
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: nocover
+    from yaml import SafeLoader  # type: ignore
 
 # metric for counting database errors
 DB_ERRORS_METRIC_NAME = "database_errors"
@@ -43,7 +62,138 @@ _QUERIES_METRIC_CONFIG = MetricConfig(
     "counter",
     {"labels": ["status"]},
 )
-GLOBAL_METRICS = frozenset([DB_ERRORS_METRIC_NAME, QUERIES_METRIC_NAME])
+# metric for tracking connections in the database pool
+POOL_CONNECTIONS_METRIC_NAME = "database_pool_connections"
+_POOL_CONNECTIONS_METRIC_CONFIG = MetricConfig(
+    POOL_CONNECTIONS_METRIC_NAME,
+    "Number of connections in the database pool",
+    "gauge",
+    {"labels": ["state"]},
+)
+# metric for tracking time spent waiting for a pool connection
+POOL_WAIT_METRIC_NAME = "database_pool_wait_seconds"
+_POOL_WAIT_METRIC_CONFIG = MetricConfig(
+    POOL_WAIT_METRIC_NAME,
+    "Time spent waiting for a connection from the database pool",
+    "histogram",
+    {"labels": []},
+)
+# metric for the state of database circuit breakers
+CIRCUIT_BREAKER_STATE_METRIC_NAME = "database_circuit_breaker_state"
+_CIRCUIT_BREAKER_STATE_METRIC_CONFIG = MetricConfig(
+    CIRCUIT_BREAKER_STATE_METRIC_NAME,
+    "State of the database connection circuit breaker",
+    "enum",
+    {"labels": [], "states": list(CircuitBreaker.STATES)},
+)
+# metric for the time of the next connection attempt for open circuit breakers
+CIRCUIT_BREAKER_RETRY_METRIC_NAME = "database_circuit_breaker_retry_timestamp_seconds"
+_CIRCUIT_BREAKER_RETRY_METRIC_CONFIG = MetricConfig(
+    CIRCUIT_BREAKER_RETRY_METRIC_NAME,
+    "Time of the next connection attempt when the circuit breaker is open",
+    "gauge",
+    {"labels": []},
+)
+# metric for counting queries not completed within the scrape deadline
+SCRAPE_DEADLINE_MISSES_METRIC_NAME = "scrape_deadline_misses"
+_SCRAPE_DEADLINE_MISSES_METRIC_CONFIG = MetricConfig(
+    SCRAPE_DEADLINE_MISSES_METRIC_NAME,
+    "Number of queries run on HTTP requests not completed within the deadline",
+    "counter",
+    {"labels": ["query"]},
+)
+# metric for the effective interval of queries with adaptive intervals
+QUERY_INTERVAL_METRIC_NAME = "query_interval_seconds"
+_QUERY_INTERVAL_METRIC_CONFIG = MetricConfig(
+    QUERY_INTERVAL_METRIC_NAME,
+    "Effective interval for queries with adaptive intervals",
+    "gauge",
+    {"labels": ["query"]},
+)
+# metrics for query execution statistics
+QUERY_LATENCY_METRIC_NAME = "query_latency_seconds"
+_QUERY_LATENCY_METRIC_CONFIG = MetricConfig(
+    QUERY_LATENCY_METRIC_NAME,
+    "Query execution time, including fetching and processing results",
+    "histogram",
+    {"labels": ["query"]},
+)
+QUERY_FETCH_TIME_METRIC_NAME = "query_fetch_seconds"
+_QUERY_FETCH_TIME_METRIC_CONFIG = MetricConfig(
+    QUERY_FETCH_TIME_METRIC_NAME,
+    "Time spent executing queries and fetching rows",
+    "summary",
+    {"labels": ["query"]},
+)
+QUERY_PROCESS_TIME_METRIC_NAME = "query_process_seconds"
+_QUERY_PROCESS_TIME_METRIC_CONFIG = MetricConfig(
+    QUERY_PROCESS_TIME_METRIC_NAME,
+    "Time spent converting query rows to metric updates",
+    "summary",
+    {"labels": ["query"]},
+)
+QUERY_ROWS_METRIC_NAME = "query_rows"
+_QUERY_ROWS_METRIC_CONFIG = MetricConfig(
+    QUERY_ROWS_METRIC_NAME,
+    "Number of rows returned by the last query execution",
+    "gauge",
+    {"labels": ["query"]},
+)
+QUERY_SERIES_METRIC_NAME = "query_series_updated"
+_QUERY_SERIES_METRIC_CONFIG = MetricConfig(
+    QUERY_SERIES_METRIC_NAME,
+    "Number of metric series updated by the last query execution",
+    "gauge",
+    {"labels": ["query"]},
+)
+QUERY_STATEMENT_CACHE_METRIC_NAME = "query_statement_cache_lookups"
+_QUERY_STATEMENT_CACHE_METRIC_CONFIG = MetricConfig(
+    QUERY_STATEMENT_CACHE_METRIC_NAME,
+    "Number of lookups of compiled query statements in the cache",
+    "counter",
+    {"labels": ["query", "result"]},
+)
+# builtin metrics for query statistics, which can be disabled
+QUERY_STATS_METRICS = frozenset(
+    [
+        QUERY_LATENCY_METRIC_NAME,
+        QUERY_FETCH_TIME_METRIC_NAME,
+        QUERY_PROCESS_TIME_METRIC_NAME,
+        QUERY_ROWS_METRIC_NAME,
+        QUERY_SERIES_METRIC_NAME,
+        QUERY_STATEMENT_CACHE_METRIC_NAME,
+    ]
+)
+# metric for counting series removed after their expiration
+EXPIRED_SERIES_METRIC_NAME = "expired_series"
+_EXPIRED_SERIES_METRIC_CONFIG = MetricConfig(
+    EXPIRED_SERIES_METRIC_NAME,
+    "Number of metric series removed after their expiration",
+    "counter",
+    {"labels": ["metric"]},
+)
+# metric for counting metric updates dropped by label filters or series limits
+DROPPED_UPDATES_METRIC_NAME = "dropped_updates"
+_DROPPED_UPDATES_METRIC_CONFIG = MetricConfig(
+    DROPPED_UPDATES_METRIC_NAME,
+    "Number of metric updates dropped by label filters or series limits",
+    "counter",
+    {"labels": ["metric", "reason"]},
+)
+GLOBAL_METRICS = QUERY_STATS_METRICS | frozenset(
+    [
+        DB_ERRORS_METRIC_NAME,
+        QUERIES_METRIC_NAME,
+        POOL_CONNECTIONS_METRIC_NAME,
+        POOL_WAIT_METRIC_NAME,
+        CIRCUIT_BREAKER_STATE_METRIC_NAME,
+        CIRCUIT_BREAKER_RETRY_METRIC_NAME,
+        SCRAPE_DEADLINE_MISSES_METRIC_NAME,
+        QUERY_INTERVAL_METRIC_NAME,
+        EXPIRED_SERIES_METRIC_NAME,
+        DROPPED_UPDATES_METRIC_NAME,
+    ]
+)
 
 # regexp for validating environment variables names
 _ENV_VAR_RE = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*$")
@@ -61,33 +211,180 @@ class Config(NamedTuple):
     queries: Dict[str, Query]
 
 
+class Shard(NamedTuple):
+    """A shard of databases, for running multiple exporters on a config."""
+
+    shard_index: int
+    shard_count: int
+
+
+def database_shard(dbname: str, shard_count: int) -> int:
+    """Return the index of the shard for a database.
+
+    Shards are assigned with rendezvous hashing, so that when the number of
+    shards changes only databases for added or removed shards are moved.
+
+    """
+
+    def weight(index: int) -> bytes:
+        key = f"{index}:{dbname}".encode("utf-8")
+        return hashlib.blake2b(key, digest_size=8).digest()
+
+    return max(range(shard_count), key=weight)
+
+
 # Type matching os.environ.
 Environ = Mapping[str, str]
 
 
-def load_config(config_fd: IO, logger: Logger, env: Environ = os.environ) -> Config:
-    """Load YAML config from file."""
-    data = defaultdict(dict, yaml.safe_load(config_fd))
+def load_config(
+    config_fd: IO,
+    logger: Logger,
+    env: Environ = os.environ,
+    shard: Optional[Shard] = None,
+) -> Config:
+    """Load YAML config from file.
+
+    If a shard is specified, only databases in the shard (and queries on
+    them) are included in the config.
+
+    """
+    data = defaultdict(dict, yaml.load(config_fd, Loader=SafeLoader))
     _validate_config(data)
-    databases, database_labels = _get_databases(data["databases"], env)
+    # relative paths in the config are based on the config file location
+    config_dir = os.path.dirname(getattr(config_fd, "name", ""))
+    database_configs, templates = _expand_database_templates(data, env, config_dir)
+    database_names = frozenset(database_configs)
+    shard_database_names = database_names
+    if shard is not None:
+        shard_database_names = frozenset(
+            name
+            for name in database_names
+            if database_shard(name, shard.shard_count) == shard.shard_index
+        )
+    databases, database_labels = _get_databases(
+        database_configs, env, shard_database_names
+    )
     extra_labels = frozenset([DATABASE_LABEL]) | database_labels
     metrics = _get_metrics(data["metrics"], extra_labels)
-    queries = _get_queries(data["queries"], frozenset(databases), metrics, extra_labels)
+    queries = _get_queries(
+        data["queries"],
+        database_names,
+        metrics,
+        extra_labels,
+        shard_database_names,
+        templates=templates,
+    )
     config = Config(databases, metrics, queries)
-    _warn_if_unused(config, logger)
+    _warn_if_unused(data, logger, templates=templates)
     return config
 
 
+def _expand_database_templates(
+    data: Dict[str, Any], env: Environ, config_dir: str = ""
+) -> Tuple[Dict[str, Mapping[str, Any]], Dict[str, List[str]]]:
+    """Return configs for all databases, including those from templates.
+
+    Configs for databases from a template share the template settings, only
+    the DSN and labels are specific to each target.
+
+    A dict mapping template names to names of their databases is also
+    returned.
+
+    """
+    configs: Dict[str, Mapping[str, Any]] = dict(data["databases"])
+    templates: Dict[str, List[str]] = {}
+    for name, template in data["database-templates"].items():
+        if name in configs:
+            raise ConfigError(
+                f'Database template "{name}" has the same name as a database'
+            )
+        settings = template.get("settings", {})
+        if "dsn" in settings:
+            raise ConfigError(
+                f'Invalid settings for database template "{name}": '
+                '"dsn" must be specified in targets'
+            )
+        settings_labels = settings.get("labels", {})
+        target_names = []
+        targets = _get_template_targets(name, template["targets"], env, config_dir)
+        for target in targets:
+            target_name = target["name"]
+            if target_name in configs or target_name in data["database-templates"]:
+                raise ConfigError(
+                    f'Duplicated database name "{target_name}" '
+                    f'in database template "{name}"'
+                )
+            labels = {**settings_labels, **target.get("labels", {})}
+            configs[target_name] = ChainMap(
+                {"dsn": target["dsn"], "labels": labels}, settings
+            )
+            target_names.append(target_name)
+        templates[name] = target_names
+    return configs, templates
+
+
+def _get_template_targets(
+    name: str,
+    targets: Union[str, List[Dict[str, Any]]],
+    env: Environ,
+    config_dir: str = "",
+) -> List[Dict[str, Any]]:
+    """Return the list of targets for a database template.
+
+    Targets can be listed in the config, or loaded from an environment
+    variable or a file, as a YAML (or JSON) list.  Relative file paths are
+    based on the config directory.
+
+    """
+    if not isinstance(targets, str):
+        return targets
+
+    source, value = targets.split(":", 1)
+    if source == "env":
+        try:
+            text = _resolve_dsn(targets, env)
+        except ValueError as e:
+            raise ConfigError(f'Invalid targets for database template "{name}": {e}')
+    else:
+        try:
+            with open(os.path.join(config_dir, value)) as fd:
+                text = fd.read()
+        except OSError as e:
+            raise ConfigError(f'Invalid targets for database template "{name}": {e}')
+
+    try:
+        loaded = yaml.load(text, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        raise ConfigError(f'Invalid targets for database template "{name}": {e}')
+    error = _schema_error(loaded, definition="database-targets")
+    if error is not None:
+        path = "/".join(str(item) for item in error.absolute_path)
+        raise ConfigError(
+            f'Invalid targets for database template "{name}" '
+            f"at {path}: {error.message}"
+        )
+    return cast(List[Dict[str, Any]], loaded)
+
+
 def _get_databases(
-    configs: Dict[str, Dict[str, Any]], env: Environ
+    configs: Mapping[str, Mapping[str, Any]],
+    env: Environ,
+    names: Optional[AbstractSet[str]] = None,
 ) -> Tuple[Dict[str, DataBase], FrozenSet[str]]:
-    """Return a dict mapping names to DataBases."""
+    """Return a dict mapping names to DataBases.
+
+    If names are specified, only DataBases for those are returned.
+
+    """
     databases = {}
     all_db_labels: Set[FrozenSet[str]] = set()  # set of all labels sets
     try:
         for name, config in configs.items():
             labels = config.get("labels")
             all_db_labels.add(frozenset((labels) if labels else frozenset()))
+            if names is not None and name not in names:
+                continue
             databases[name] = DataBase(
                 name,
                 _resolve_dsn(config["dsn"], env),
@@ -95,6 +392,12 @@ def _get_databases(
                 keep_connected=config.get("keep-connected", True),
                 autocommit=config.get("autocommit", True),
                 labels=labels,
+                pool_size=config.get("pool-size", 1),
+                max_overflow=config.get("max-overflow", 0),
+                pool_timeout=config.get("pool-timeout"),
+                backend=config.get("backend", "thread"),
+                query_timeout=config.get("query-timeout"),
+                circuit_breaker=_get_circuit_breaker(config),
             )
     except Exception as e:
         raise ConfigError(str(e))
@@ -110,18 +413,53 @@ def _get_databases(
     return databases, db_labels
 
 
+def _get_circuit_breaker(config: Mapping[str, Any]) -> Optional[CircuitBreaker]:
+    """Return a CircuitBreaker for a database, if enabled in config."""
+    breaker_config = config.get("circuit-breaker")
+    if breaker_config is None:
+        return None
+    min_backoff = breaker_config.get("min-backoff", 1.0)
+    max_backoff = breaker_config.get("max-backoff", 300.0)
+    if min_backoff > max_backoff:
+        raise ConfigError(
+            "Circuit breaker min-backoff must not be greater than max-backoff"
+        )
+    return CircuitBreaker(
+        failures=breaker_config.get("failures", 5),
+        min_backoff=min_backoff,
+        max_backoff=max_backoff,
+    )
+
+
 def _get_metrics(
     metrics: Dict[str, Dict[str, Any]], extra_labels: FrozenSet[str]
 ) -> Dict[str, MetricConfig]:
     """Return a dict mapping metric names to their configuration."""
     configs = {}
     # global metrics
-    for metric_config in (_DB_ERRORS_METRIC_CONFIG, _QUERIES_METRIC_CONFIG):
-        # make a copy since labels are not immutable
-        metric_config = deepcopy(metric_config)
-        metric_config.config["labels"].extend(extra_labels)
-        metric_config.config["labels"].sort()
-        configs[metric_config.name] = metric_config
+    for metric_config in (
+        _DB_ERRORS_METRIC_CONFIG,
+        _QUERIES_METRIC_CONFIG,
+        _POOL_CONNECTIONS_METRIC_CONFIG,
+        _POOL_WAIT_METRIC_CONFIG,
+        _CIRCUIT_BREAKER_STATE_METRIC_CONFIG,
+        _CIRCUIT_BREAKER_RETRY_METRIC_CONFIG,
+        _SCRAPE_DEADLINE_MISSES_METRIC_CONFIG,
+        _QUERY_INTERVAL_METRIC_CONFIG,
+        _EXPIRED_SERIES_METRIC_CONFIG,
+        _DROPPED_UPDATES_METRIC_CONFIG,
+        _QUERY_LATENCY_METRIC_CONFIG,
+        _QUERY_FETCH_TIME_METRIC_CONFIG,
+        _QUERY_PROCESS_TIME_METRIC_CONFIG,
+        _QUERY_ROWS_METRIC_CONFIG,
+        _QUERY_SERIES_METRIC_CONFIG,
+        _QUERY_STATEMENT_CACHE_METRIC_CONFIG,
+    ):
+        # make a copy of the config since labels are not immutable
+        labels = sorted([*metric_config.config["labels"], *extra_labels])
+        configs[metric_config.name] = metric_config._replace(
+            config={**metric_config.config, "labels": labels}
+        )
     # other metrics
     for name, config in metrics.items():
         _validate_metric_config(name, config, extra_labels)
@@ -129,10 +467,35 @@ def _get_metrics(
         config.setdefault("labels", []).extend(extra_labels)
         config["labels"].sort()
         description = config.pop("description", "")
+        if "expiration" in config:
+            config["expiration"] = _convert_interval(config["expiration"])
+        if "label-filters" in config:
+            config["label-filters"] = _get_label_filters(name, config["label-filters"])
         configs[name] = MetricConfig(name, description, metric_type, config)
     return configs
 
 
+def _get_label_filters(
+    name: str, configs: Dict[str, Dict[str, str]]
+) -> Dict[str, LabelFilter]:
+    """Return a dict mapping label names to LabelFilters for a metric."""
+    label_filters = {}
+    for label, config in configs.items():
+        patterns = {}
+        for key in ("allow", "deny"):
+            if key not in config:
+                continue
+            try:
+                patterns[key] = re.compile(config[key])
+            except re.error as error:
+                raise ConfigError(
+                    f'Invalid {key} regexp for label "{label}" '
+                    f'of metric "{name}": {error}'
+                )
+        label_filters[label] = LabelFilter(**patterns)
+    return label_filters
+
+
 def _validate_metric_config(
     name: str, config: Dict[str, Any], extra_labels: FrozenSet[str]
 ):
@@ -146,6 +509,12 @@ def _validate_metric_config(
         raise ConfigError(
             f'Labels for metric "{name}" overlap with reserved/database ones: {overlap_list}'
         )
+    unknown_labels = set(config.get("label-filters", ())) - labels
+    if unknown_labels:
+        unknown_list = ", ".join(sorted(unknown_labels))
+        raise ConfigError(
+            f'Filters for metric "{name}" reference unknown labels: {unknown_list}'
+        )
 
 
 def _get_queries(
@@ -153,27 +522,66 @@ def _get_queries(
     database_names: FrozenSet[str],
     metrics: Dict[str, MetricConfig],
     extra_labels: FrozenSet[str],
+    shard_database_names: Optional[FrozenSet[str]] = None,
+    templates: Optional[Dict[str, List[str]]] = None,
 ) -> Dict[str, Query]:
-    """Return a list of Queries from config."""
+    """Return a list of Queries from config.
+
+    If shard database names are specified, queries are only run on those, and
+    queries not running on any of them are not returned.
+
+    Names of database templates in queries are replaced with the names of
+    their databases.
+
+    """
     metric_names = frozenset(metrics)
     queries: Dict[str, Query] = {}
     for name, config in configs.items():
+        if templates:
+            config["databases"] = _expand_template_names(config["databases"], templates)
         _validate_query_config(name, config, database_names, metric_names)
         _convert_query_interval(name, config)
+        databases = config["databases"]
+        if shard_database_names is not None:
+            databases = [
+                dbname for dbname in databases if dbname in shard_database_names
+            ]
         query_metrics = _get_query_metrics(config, metrics, extra_labels)
         parameters = config.get("parameters")
+        options = {
+            "chunk_size": config.get("chunk-size"),
+            "timeout": config.get("timeout"),
+            "overlap": config.get("overlap", "allow"),
+            "cache_ttl": config.get("cache-ttl"),
+            "jitter": config.get("jitter", 0.0),
+            "schedule": config.get("schedule"),
+            "adaptive_interval": _get_adaptive_interval(name, config),
+        }
         try:
-            if parameters:
+            if parameters and config.get("batch-parameters"):
+                sql, batch_parameters = batch_query_sql(config["sql"], parameters)
+                queries[name] = Query(
+                    name,
+                    config["interval"],
+                    databases,
+                    query_metrics,
+                    sql,
+                    parameters=batch_parameters,
+                    batched=True,
+                    **options,
+                )
+            elif parameters:
                 queries.update(
                     (
                         f"{name}[params{index}]",
                         Query(
                             f"{name}[params{index}]",
                             config["interval"],
-                            config["databases"],
+                            databases,
                             query_metrics,
                             config["sql"].strip(),
                             parameters=params,
+                            **options,
                         ),
                     )
                     for index, params in enumerate(parameters)
@@ -182,13 +590,25 @@ def _get_queries(
                 queries[name] = Query(
                     name,
                     config["interval"],
-                    config["databases"],
+                    databases,
                     query_metrics,
                     config["sql"].strip(),
+                    **options,
                 )
         except InvalidQueryParameters as e:
             raise ConfigError(str(e))
-    return queries
+    return {name: query for name, query in queries.items() if query.databases}
+
+
+def _expand_template_names(
+    names: List[str], templates: Dict[str, List[str]]
+) -> List[str]:
+    """Replace template names with their databases, removing duplicates."""
+    expanded: Dict[str, None] = {}
+    for name in names:
+        for dbname in templates.get(name, [name]):
+            expanded[dbname] = None
+    return list(expanded)
 
 
 def _get_query_metrics(
@@ -202,7 +622,11 @@ def _get_query_metrics(
         return sorted(set(labels) - extra_labels)
 
     return [
-        QueryMetric(name, _metric_labels(metrics[name].config["labels"]))
+        QueryMetric(
+            name,
+            _metric_labels(metrics[name].config["labels"]),
+            label_filters=metrics[name].config.get("label-filters"),
+        )
         for name in config["metrics"]
     ]
 
@@ -222,6 +646,21 @@ def _validate_query_config(
     if unknown_metrics:
         unknown_list = ", ".join(sorted(unknown_metrics))
         raise ConfigError(f'Unknown metrics for query "{name}": {unknown_list}')
+    schedule = config.get("schedule")
+    if schedule is not None:
+        if config.get("interval") is not None:
+            raise ConfigError(
+                f'Invalid schedule for query "{name}": '
+                "schedule and interval can't be both specified"
+            )
+        if not valid_schedule(schedule):
+            raise ConfigError(f'Invalid schedule for query "{name}": "{schedule}"')
+    timed = config.get("interval") is not None or schedule is not None
+    if config.get("cache-ttl") is not None and timed:
+        raise ConfigError(
+            f'Invalid cache-ttl for query "{name}": '
+            "only queries without an interval can be cached"
+        )
     parameters = config.get("parameters")
     if parameters:
         keys = {frozenset(param.keys()) for param in parameters}
@@ -239,6 +678,11 @@ def _convert_query_interval(name: str, config: Dict[str, Any]):
         # the query should be run at every request
         return
 
+    config["interval"] = _convert_interval(interval)
+
+
+def _convert_interval(interval: Union[int, str]) -> int:
+    """Convert an interval to seconds."""
     multiplier = 1
     if isinstance(interval, str):
         # convert to seconds
@@ -248,7 +692,33 @@ def _convert_query_interval(name: str, config: Dict[str, Any]):
             interval = interval[:-1]
             multiplier = multipliers[suffix]
 
-    config["interval"] = int(interval) * multiplier
+    return int(interval) * multiplier
+
+
+def _get_adaptive_interval(
+    name: str, config: Dict[str, Any]
+) -> Optional[AdaptiveInterval]:
+    """Return the AdaptiveInterval for a query, if enabled in config."""
+    adaptive_config = config.get("adaptive-interval")
+    if adaptive_config is None:
+        return None
+
+    interval = config["interval"]
+    if interval is None:
+        raise ConfigError(
+            f'Invalid adaptive-interval for query "{name}": '
+            "the query must have an interval"
+        )
+    min_interval = _convert_interval(adaptive_config.get("min-interval", interval))
+    max_interval = _convert_interval(adaptive_config["max-interval"])
+    if not min_interval <= interval <= max_interval:
+        raise ConfigError(
+            f'Invalid adaptive-interval for query "{name}": '
+            "interval must be between min-interval and max-interval"
+        )
+    return AdaptiveInterval(
+        min_interval, max_interval, adaptive_config.get("cost-threshold", 0.5)
+    )
 
 
 def _resolve_dsn(dsn: str, env: Environ) -> str:
@@ -263,33 +733,83 @@ def _resolve_dsn(dsn: str, env: Environ) -> str:
     return dsn
 
 
-def _validate_config(config: Dict[str, Any]):
+@lru_cache(maxsize=None)
+def _config_schema() -> Dict[str, Any]:
+    """Return the config schema, which is only loaded once."""
     schema_path = PACKAGE.get_resource_filename(  # type: ignore
         None, "query_exporter/schemas/config.yaml"
     )
     with open(schema_path) as fd:
-        schema = yaml.safe_load(fd)
-    try:
-        jsonschema.validate(config, schema)
-    except jsonschema.ValidationError as e:
-        path = "/".join(str(item) for item in e.absolute_path)
-        raise ConfigError(f"Invalid config at {path}: {e.message}")
+        schema = yaml.load(fd, Loader=SafeLoader)
+    jsonschema.Draft7Validator.check_schema(schema)
+    return cast(Dict[str, Any], schema)
+
+
+@lru_cache(maxsize=None)
+def _config_validator(definition: Optional[str] = None) -> jsonschema.Draft7Validator:
+    """Return the validator for the config schema.
+
+    If a definition is specified, the validator is for that subschema.
+
+    """
+    schema = _config_schema()
+    if definition is not None:
+        schema = {
+            "$ref": f"#/definitions/{definition}",
+            "definitions": schema["definitions"],
+        }
+    return jsonschema.Draft7Validator(schema)
+
+
+def _schema_error(
+    data: Any, definition: Optional[str] = None
+) -> Optional[jsonschema.ValidationError]:
+    """Return the most relevant schema validation error, if any."""
+    # like jsonschema.validate()
+    return jsonschema.exceptions.best_match(
+        _config_validator(definition).iter_errors(data)
+    )
+
 
+def _validate_config(config: Dict[str, Any]):
+    error = _schema_error(config)
+    if error is not None:
+        path = "/".join(str(item) for item in error.absolute_path)
+        raise ConfigError(f"Invalid config at {path}: {error.message}")
 
-def _warn_if_unused(config: Config, logger: Logger):
-    """Warn if there are unused databases or metrics defined."""
+
+def _warn_if_unused(
+    data: Dict[str, Any],
+    logger: Logger,
+    templates: Optional[Dict[str, List[str]]] = None,
+):
+    """Warn if there are unused databases or metrics defined.
+
+    This checks the whole configuration file, regardless of sharding. Database
+    templates are unused if none of their databases is.
+
+    """
     used_dbs: Set[str] = set()
     used_metrics: Set[str] = set()
-    for query in config.queries.values():
-        used_dbs.update(query.databases)
-        used_metrics.update(metric.name for metric in query.metrics)
-
-    unused_dbs = sorted(set(config.databases) - used_dbs)
+    for config in data["queries"].values():
+        used_dbs.update(config["databases"])
+        used_metrics.update(config["metrics"])
+
+    unused_dbs = sorted(
+        [
+            *(set(data["databases"]) - used_dbs),
+            *(
+                name
+                for name, dbnames in (templates or {}).items()
+                if used_dbs.isdisjoint(dbnames)
+            ),
+        ]
+    )
     if unused_dbs:
         logger.warning(
             f"unused entries in \"databases\" section: {', '.join(unused_dbs)}"
         )
-    unused_metrics = sorted(set(config.metrics) - GLOBAL_METRICS - used_metrics)
+    unused_metrics = sorted(set(data["metrics"]) - used_metrics)
     if unused_metrics:
         logger.warning(
             f"unused entries in \"metrics\" section: {', '.join(unused_metrics)}"
@@ -84,10 +84,10 @@ def query_tracker(mocker, event_loop):
     tracker = QueryTracker()
     orig_execute = DataBase.execute
 
-    async def execute(self, query):
+    async def execute(self, query, **kwargs):
         tracker.queries.append(query)
         try:
-            result = await orig_execute(self, query)
+            result = await orig_execute(self, query, **kwargs)
         except Exception as e:
             tracker.failures.append(e)
             raise
@@ -1,30 +1,57 @@
 """Database wrapper."""
 
 import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from functools import (
+    lru_cache,
+    partial,
+)
 from itertools import chain
 import logging
+import random
+import re
+import time
 from typing import (
     Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    cast,
+    Counter,
     Dict,
     FrozenSet,
+    Iterator,
     List,
     NamedTuple,
     Optional,
+    Pattern,
+    Set,
     Tuple,
+    Type,
     Union,
 )
+from weakref import WeakKeyDictionary
 
 import sqlalchemy
 from sqlalchemy.engine import (
     Connection,
     ResultProxy,
 )
+from sqlalchemy.engine.interfaces import (
+    Compiled,
+    Dialect,
+)
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import (
     ArgumentError,
     NoSuchModuleError,
 )
+from sqlalchemy.pool import NullPool
 from sqlalchemy_aio import ASYNCIO_STRATEGY
-from sqlalchemy_aio.engine import AsyncioEngine
 
 # label used to tag metrics by database
 DATABASE_LABEL = "database"
@@ -40,6 +67,22 @@ class DataBaseError(Exception):
         super().__init__(message)
         self.fatal = fatal
 
+    def __reduce__(self):
+        return self.__class__, (str(self), self.fatal)
+
+
+class DataBaseUnavailable(DataBaseError):
+    """The database circuit breaker is open, connections are not attempted."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(
+            f"circuit breaker open, next connection attempt in {retry_in:.1f} seconds"
+        )
+        self.retry_in = retry_in
+
+    def __reduce__(self):
+        return self.__class__, (self.retry_in,)
+
 
 class InvalidResultCount(Exception):
     """Number of results from a query don't match metrics count."""
@@ -48,6 +91,11 @@ class InvalidResultCount(Exception):
         super().__init__(
             f"Wrong result count from query: expected {expected}, got {got}"
         )
+        self.expected = expected
+        self.got = got
+
+    def __reduce__(self):
+        return self.__class__, (self.expected, self.got)
 
 
 class InvalidResultColumnNames(Exception):
@@ -56,6 +104,39 @@ class InvalidResultColumnNames(Exception):
     def __init__(self):
         super().__init__("Wrong column names from query")
 
+    def __reduce__(self):
+        return self.__class__, ()
+
+
+class InvalidBatchResults(Exception):
+    """Different parameters sets of a batched query return the same series."""
+
+    def __init__(self, metric: str, index: int, other_index: int):
+        super().__init__(
+            f'Same labels for metric "{metric}" from parameters sets '
+            f"{index} and {other_index}"
+        )
+        self.metric = metric
+        self.index = index
+        self.other_index = other_index
+
+    def __reduce__(self):
+        return self.__class__, (self.metric, self.index, self.other_index)
+
+
+class QueryTimeoutExpired(Exception):
+    """Query execution timeout expired."""
+
+    def __init__(self, query_name: str, timeout: float):
+        super().__init__(
+            f'Execution for query "{query_name}" expired after {timeout} seconds'
+        )
+        self.query_name = query_name
+        self.timeout = timeout
+
+    def __reduce__(self):
+        return self.__class__, (self.query_name, self.timeout)
+
 
 class InvalidQueryParameters(Exception):
     """Query parameter names don't match those in query SQL."""
@@ -64,6 +145,10 @@ class InvalidQueryParameters(Exception):
         super().__init__(
             f'Parameters for query "{query_name}" don\'t match those from SQL'
         )
+        self.query_name = query_name
+
+    def __reduce__(self):
+        return self.__class__, (self.query_name,)
 
 
 # database errors that mean the query won't ever succeed.  Not all possible
@@ -71,7 +156,71 @@ class InvalidQueryParameters(Exception):
 # circumstances which can be fatal or not.  Since there doesn't seem to be a
 # reliable way to know, there might be cases when a query will never succeed
 # but will end up being retried.
-FATAL_ERRORS = (InvalidResultCount, InvalidResultColumnNames)
+FATAL_ERRORS = (InvalidResultCount, InvalidResultColumnNames, InvalidBatchResults)
+
+# map dialect names to the DBAPI connection method that cancels the running
+# query from another thread.  MySQL queries are killed from a separate
+# connection.  For other dialects, the connection running a query that times
+# out is just discarded.
+_QUERY_CANCEL_METHODS = {
+    "oracle": "cancel",
+    "postgresql": "cancel",
+    "sqlite": "interrupt",
+}
+
+
+# same pattern used by SQLAlchemy to match bind parameters in text
+_BIND_PARAMS_REGEX = re.compile(r"(?<![:\w\x5c]):(\w+)(?!:)")
+
+# column with the index of the parameters set for rows from batched queries
+BATCH_INDEX_COLUMN = "batch_index"
+
+
+def batch_query_sql(
+    sql: str, parameters_sets: List[Dict[str, Any]]
+) -> Tuple[str, Dict[str, Any]]:
+    """Combine a query and parameters sets into a single query.
+
+    Return the SQL for a statement which runs the query for each set with a
+    UNION ALL, along with parameters for it.  Each copy of the query has its
+    parameters renamed so that values for all sets can be passed at once, and
+    rows are tagged with the index of their set in the BATCH_INDEX_COLUMN.
+
+    Subqueries aliases are given without "AS", which Oracle doesn't accept.
+
+    """
+    sql = sql.strip().rstrip(";")
+    subqueries = []
+    parameters: Dict[str, Any] = {}
+    for index, params in enumerate(parameters_sets):
+        suffix = f"__batch{index}"
+        subquery_sql = _BIND_PARAMS_REGEX.sub(rf":\1{suffix}", sql)
+        subqueries.append(
+            f"SELECT batch{index}.*, {index} AS {BATCH_INDEX_COLUMN} "
+            f"FROM ({subquery_sql}) batch{index}"
+        )
+        parameters.update((name + suffix, value) for name, value in params.items())
+    return "\nUNION ALL\n".join(subqueries), parameters
+
+
+class LabelFilter(NamedTuple):
+    """Filter for values of a metric label.
+
+    A value passes the filter if it matches the `allow` regexp (if set) and
+    doesn't match the `deny` one (if set).  Regexps must match the whole
+    value.
+
+    """
+
+    allow: Optional[Pattern] = None
+    deny: Optional[Pattern] = None
+
+    def match(self, value: Any) -> bool:
+        """Return whether a label value passes the filter."""
+        value = str(value)
+        if self.allow is not None and not self.allow.fullmatch(value):
+            return False
+        return self.deny is None or not self.deny.fullmatch(value)
 
 
 class QueryMetric(NamedTuple):
@@ -79,6 +228,21 @@ class QueryMetric(NamedTuple):
 
     name: str
     labels: List[str]
+    label_filters: Optional[Dict[str, LabelFilter]] = None
+
+
+class AdaptiveInterval(NamedTuple):
+    """Bounds for adapting a query interval to its execution cost.
+
+    The interval is stretched when the execution time exceeds the
+    `cost_threshold` fraction of the interval (or the query fails), and
+    shrunk when the query is cheap again.
+
+    """
+
+    min_interval: int
+    max_interval: int
+    cost_threshold: float = 0.5
 
 
 class QueryResults(NamedTuple):
@@ -92,6 +256,18 @@ class QueryResults(NamedTuple):
         """Return a QueryResults from results for a query."""
         return cls(await results.keys(), await results.fetchall())
 
+    @classmethod
+    async def from_results_chunks(
+        cls, results: ResultProxy, size: int
+    ) -> AsyncIterator["QueryResults"]:
+        """Yield QueryResults from results for a query, in chunks of rows."""
+        keys = await results.keys()
+        while True:
+            rows = await results.fetchmany(size)
+            if not rows:
+                return
+            yield cls(keys, rows)
+
 
 class MetricResult(NamedTuple):
     """A result for a metric from a query."""
@@ -101,6 +277,135 @@ class MetricResult(NamedTuple):
     labels: Dict[str, str]
 
 
+class QueryStats(NamedTuple):
+    """Statistics for a query execution.
+
+    The latency includes the time spent executing the query, fetching rows
+    (`fetch_time`) and converting them to metric results (`process_time`).
+
+    """
+
+    latency: float
+    fetch_time: float
+    process_time: float
+    rows: int
+    series: int
+    # map metric names to number of rows dropped by label filters
+    filtered: Dict[str, int]
+    # whether the compiled statement for the query was found in the cache
+    statement_cached: bool = False
+
+
+class MetricResults(NamedTuple):
+    """Collection of metric results for a query."""
+
+    results: List[MetricResult]
+    pool_wait: Optional[float] = None
+    stats: Optional[QueryStats] = None
+
+
+# Signature for handlers of results from a query
+ResultsHandler = Callable[[List[MetricResult]], None]
+
+
+# map types of values returned by queries to conversions to metric values.
+# Other values are used as they are.
+_VALUE_CONVERTERS: Dict[type, Callable[[Any], Any]] = {
+    # don't fail is queries that count return NULL
+    type(None): lambda value: 0.0,
+    Decimal: float,
+    bool: float,
+    datetime: datetime.timestamp,
+}
+
+
+class ResultsMapper:
+    """Map rows from query results to MetricResults.
+
+    Positions of metrics and labels values in rows are computed once for a
+    set of result keys, and reused for all rows.
+
+    """
+
+    def __init__(self, query: "Query", keys: List[str]):
+        self.keys = tuple(keys)
+        metrics = query.metrics
+        expected_keys = {metric.name for metric in metrics} | query.labels()
+        if query.batched:
+            expected_keys.add(BATCH_INDEX_COLUMN)
+        if len(expected_keys) != len(keys):
+            raise InvalidResultCount(len(expected_keys), len(keys))
+        if expected_keys != set(keys):
+            raise InvalidResultColumnNames()
+        indexes = {key: index for index, key in enumerate(keys)}
+        self._batch_index = indexes.get(BATCH_INDEX_COLUMN)
+        self._plan = [
+            (
+                metric.name,
+                indexes[metric.name],
+                [(label, indexes[label]) for label in metric.labels],
+                [
+                    (indexes[label], label_filter)
+                    for label, label_filter in (metric.label_filters or {}).items()
+                ],
+            )
+            for metric in metrics
+        ]
+
+    def map(
+        self,
+        rows: List[Tuple],
+        filtered: Optional[Counter[str]] = None,
+        batch_series: Optional[Dict[Tuple, int]] = None,
+    ) -> List[MetricResult]:
+        """Return MetricResults for rows.
+
+        Rows with label values not passing label filters for a metric are
+        skipped for that metric, and counted in `filtered` if passed.
+
+        For batched queries, InvalidBatchResults is raised if different
+        parameters sets return the same series.  Series are tracked in
+        `batch_series` (mapping them to the index of their set) if passed, to
+        check across calls.
+
+        """
+        converters = _VALUE_CONVERTERS
+        # skip argument handling in MetricResult.__new__
+        new_result = partial(tuple.__new__, MetricResult)
+        results: List[MetricResult] = []
+        append = results.append
+        batch_index = self._batch_index
+        seen_series: Dict[Tuple, int] = {} if batch_series is None else batch_series
+        for row in rows:
+            for name, value_index, label_indexes, label_filters in self._plan:
+                if label_filters and not all(
+                    label_filter.match(row[index])
+                    for index, label_filter in label_filters
+                ):
+                    if filtered is not None:
+                        filtered[name] += 1
+                    continue
+                value = row[value_index]
+                converter = converters.get(type(value))
+                if converter is not None:
+                    value = converter(value)
+                labels = {label: row[index] for label, index in label_indexes}
+                if batch_index is not None:
+                    series = (name, tuple(labels.values()))
+                    set_index = seen_series.setdefault(series, row[batch_index])
+                    if set_index != row[batch_index]:
+                        raise InvalidBatchResults(name, set_index, row[batch_index])
+                append(new_result((name, value, labels)))
+        return results
+
+
+class PoolStatus(NamedTuple):
+    """Status of the connection pool for a database."""
+
+    used: int
+    idle: int
+
+
 class Query:
     """Query definition and configuration."""
 
@@ -112,6 +417,14 @@ class Query:
         metrics: List[QueryMetric],
         sql: str,
         parameters: Optional[Dict[str, Any]] = None,
+        chunk_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        overlap: str = "allow",
+        cache_ttl: Optional[float] = None,
+        jitter: float = 0.0,
+        schedule: Optional[str] = None,
+        adaptive_interval: Optional[AdaptiveInterval] = None,
+        batched: bool = False,
     ):
         self.name = name
         self.interval = interval
@@ -119,49 +432,347 @@ class Query:
         self.metrics = metrics
         self.sql = sql
         self.parameters = parameters or {}
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.overlap = overlap
+        self.cache_ttl = cache_ttl
+        self.jitter = jitter
+        self.schedule = schedule
+        self.adaptive_interval = adaptive_interval
+        # whether the SQL combines multiple parameters sets (see
+        # batch_query_sql)
+        self.batched = batched
+        self.statement = sqlalchemy.text(sql)
+        if chunk_size:
+            # use server-side cursors where the dialect supports them
+            self.statement = self.statement.execution_options(stream_results=True)
+        # map dialects to statements compiled for them
+        self._compiled_statements: "WeakKeyDictionary[Dialect, Compiled]" = (
+            WeakKeyDictionary()
+        )
+        self.compiled_cache_hits = 0
+        self.compiled_cache_misses = 0
+        self._mapper: Optional[ResultsMapper] = None
         self._check_parameters()
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # only pickle the query definition, caches are rebuilt
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "databases": self.databases,
+            "metrics": self.metrics,
+            "sql": self.sql,
+            "parameters": self.parameters,
+            "chunk_size": self.chunk_size,
+            "timeout": self.timeout,
+            "overlap": self.overlap,
+            "cache_ttl": self.cache_ttl,
+            "jitter": self.jitter,
+            "schedule": self.schedule,
+            "adaptive_interval": self.adaptive_interval,
+            "batched": self.batched,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(**state)  # type: ignore
+
+    def same_definition(self, other: "Query") -> bool:
+        """Return whether another Query has the same definition."""
+        return self.__getstate__() == other.__getstate__()
+
+    @property
+    def timed(self) -> bool:
+        """Whether the query is run periodically."""
+        return self.interval is not None or self.schedule is not None
+
     def labels(self) -> FrozenSet[str]:
         """Resturn all labels for metrics in the query."""
         return frozenset(chain(*(metric.labels for metric in self.metrics)))
 
-    def results(self, query_results: QueryResults) -> List[MetricResult]:
-        """Return MetricResults from a query."""
+    def compiled_statement(self, dialect: Dialect) -> Compiled:
+        """Return the query statement compiled for a dialect.
+
+        Compiled statements are cached by dialect instance, since compilation
+        can depend on its options and on the server version, and reused for
+        all executions of the query on the same database.  Cache hits and
+        misses are counted in `compiled_cache_hits` and
+        `compiled_cache_misses`.
+
+        """
+        compiled = self._compiled_statements.get(dialect)
+        if compiled is None:
+            self.compiled_cache_misses += 1
+            compiled = self.statement.compile(dialect=dialect)
+            self._compiled_statements[dialect] = compiled
+        else:
+            self.compiled_cache_hits += 1
+        return compiled
+
+    def results(
+        self,
+        query_results: QueryResults,
+        filtered: Optional[Counter[str]] = None,
+        batch_series: Optional[Dict[Tuple, int]] = None,
+    ) -> List[MetricResult]:
+        """Return MetricResults from a query.
+
+        Rows dropped by label filters are counted by metric in `filtered`, if
+        passed.  For batched queries, series from different parameters sets
+        are checked not to overlap, tracking them in `batch_series` if passed
+        (see ResultsMapper.map).
+
+        """
         if not query_results.rows:
             return []
 
-        result_keys = sorted(query_results.keys)
-        labels = self.labels()
-        metrics = [metric.name for metric in self.metrics]
-        expected_keys = sorted(set(metrics) | labels)
-        if len(expected_keys) != len(result_keys):
-            raise InvalidResultCount(len(expected_keys), len(result_keys))
-        if result_keys != expected_keys:
-            raise InvalidResultColumnNames()
-        results = []
-        for row in query_results.rows:
-            values = dict(zip(query_results.keys, row))
-            for metric in self.metrics:
-                metric_result = MetricResult(
-                    metric.name,
-                    values[metric.name],
-                    {label: values[label] for label in metric.labels},
-                )
-                results.append(metric_result)
-        return results
+        mapper = self._mapper
+        if mapper is None or mapper.keys != tuple(query_results.keys):
+            mapper = self._mapper = ResultsMapper(self, query_results.keys)
+        return mapper.map(
+            query_results.rows, filtered=filtered, batch_series=batch_series
+        )
 
     def _check_parameters(self):
-        expr = sqlalchemy.text(self.sql)
-        query_params = set(expr.compile().params)
+        # bind parameters are parsed from the text, no need to compile it
+        query_params = set(self.statement._bindparams)
         if set(self.parameters) != query_params:
             raise InvalidQueryParameters(self.name)
 
 
+class CircuitBreaker:
+    """Circuit breaker for database connection attempts.
+
+    After `failures` consecutive connection failures, the breaker opens and
+    connection attempts are refused until a backoff time expires.  After that,
+    the breaker is half-open and a single attempt is let through: if it
+    succeeds, the breaker closes, otherwise it opens again with a doubled
+    backoff (up to `max_backoff`).  Actual backoff times are randomized between
+    half and the full value, to spread retries for multiple databases.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    def __init__(
+        self, failures: int = 5, min_backoff: float = 1.0, max_backoff: float = 300.0
+    ):
+        self.failures = failures
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        # time when the next connection attempt is allowed, if open, or when
+        # the outcome of the probing attempt is expected, if half-open
+        self.retry_at: Optional[float] = None
+        self._failures_count = 0
+        self._backoff = min_backoff
+
+    @property
+    def settings(self) -> Tuple[int, float, float]:
+        """Return settings for the breaker, excluding its current state."""
+        return (self.failures, self.min_backoff, self.max_backoff)
+
+    def allow_attempt(self) -> bool:
+        """Return whether a connection attempt is allowed.
+
+        When the backoff time expires, the breaker turns half-open and allows a
+        single attempt.  Until its outcome is recorded, other attempts are told
+        to retry after `min_backoff`.
+
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            assert self.retry_at is not None, "retry time unset for open breaker"
+            if time.time() >= self.retry_at:
+                self.state = self.HALF_OPEN
+                self.retry_at = time.time() + self.min_backoff
+                return True
+        return False
+
+    def retry_in(self) -> float:
+        """Return seconds until the next connection attempt is allowed."""
+        if self.retry_at is None:
+            return 0.0
+        return max(self.retry_at - time.time(), 0.0)
+
+    def record_success(self):
+        """Record a successful connection attempt, closing the breaker."""
+        self.state = self.CLOSED
+        self.retry_at = None
+        self._failures_count = 0
+        self._backoff = self.min_backoff
+
+    def record_failure(self) -> bool:
+        """Record a failed connection attempt.
+
+        Return whether the breaker has been opened by the failure.
+
+        """
+        self._failures_count += 1
+        if self.state == self.HALF_OPEN:
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        elif self._failures_count < self.failures:
+            return False
+        self.state = self.OPEN
+        self.retry_at = time.time() + random.uniform(self._backoff / 2, self._backoff)
+        return True
+
+
+class ThreadBackend:
+    """Execution backend running each connection in a dedicated thread.
+
+    This uses the sqlalchemy_aio engine, where every call on a connection is
+    dispatched to the connection thread.
+
+    """
+
+    name = "thread"
+
+    def __init__(self, dsn: str, **engine_options: Any):
+        self.engine = sqlalchemy.create_engine(
+            dsn, strategy=ASYNCIO_STRATEGY, **engine_options
+        )
+
+    async def connect(self) -> Connection:
+        """Return a new connection."""
+        return await self.engine.connect()
+
+
+class ExecutorBackend:
+    """Execution backend running calls in a thread pool shared by databases.
+
+    This avoids a thread for each connection, and dispatches only blocking
+    calls to the thread pool.
+
+    """
+
+    name = "executor"
+
+    # max number of threads in the pool, defaults to the ThreadPoolExecutor one
+    max_threads: Optional[int] = None
+
+    # thread pool shared by all databases using the backend
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    def __init__(self, dsn: str, **engine_options: Any):
+        if make_url(dsn).get_backend_name() == "sqlite":
+            # connections are used from different threads in the pool, but
+            # never concurrently
+            engine_options["connect_args"] = {"check_same_thread": False}
+        self.engine = sqlalchemy.create_engine(dsn, **engine_options)
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        """Return the shared executor."""
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(
+                max_workers=cls.max_threads, thread_name_prefix="query-exporter"
+            )
+        return cls._executor
+
+    async def connect(self) -> "ExecutorConnection":
+        """Return a new connection."""
+        executor = self.executor()
+        loop = asyncio.get_event_loop()
+        conn = await loop.run_in_executor(executor, self.engine.connect)
+        return ExecutorConnection(conn, executor)
+
+
+class ExecutorConnection:
+    """A connection running blocking calls in an executor."""
+
+    def __init__(self, connection: Connection, executor: ThreadPoolExecutor):
+        self.sync_connection = connection
+        self._executor = executor
+        self._lock = asyncio.Lock()
+
+    @property
+    def dialect(self):
+        return self.sync_connection.dialect
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.sync_connection.closed)
+
+    async def execute(self, *args, **kwargs) -> "ExecutorResultProxy":
+        result = await self.run_in_executor(
+            self.sync_connection.execute, *args, **kwargs
+        )
+        return ExecutorResultProxy(result, self.run_in_executor)
+
+    async def close(self):
+        await self.run_in_executor(self.sync_connection.close)
+
+    async def run_in_executor(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking call for the connection in the executor.
+
+        Calls are serialized, since the underlying connection can't be used
+        concurrently.  If the caller is cancelled, the lock is held until the
+        blocking call actually completes.
+
+        """
+        loop = asyncio.get_event_loop()
+        await self._lock.acquire()
+        try:
+            future = self._executor.submit(partial(func, *args, **kwargs))
+        except Exception:
+            self._lock.release()
+            raise
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._lock.release)
+        )
+        return await asyncio.wrap_future(future)
+
+
+class ExecutorResultProxy:
+    """A result for a query from an ExecutorConnection."""
+
+    def __init__(self, result: ResultProxy, run_in_executor: Callable):
+        self._result = result
+        self._run_in_executor = run_in_executor
+
+    async def keys(self) -> List[str]:
+        # keys are available without fetching, no need to use the executor
+        return list(self._result.keys())
+
+    async def fetchmany(self, size: Optional[int] = None) -> List[Tuple]:
+        rows = await self._run_in_executor(self._result.fetchmany, size=size)
+        return cast(List[Tuple], rows)
+
+    async def fetchall(self) -> List[Tuple]:
+        rows = await self._run_in_executor(self._result.fetchall)
+        return cast(List[Tuple], rows)
+
+    async def close(self):
+        await self._run_in_executor(self._result.close)
+
+
+# Map names to backend classes
+BACKENDS: Dict[str, Type[Union[ThreadBackend, ExecutorBackend]]] = {
+    backend.name: backend for backend in (ThreadBackend, ExecutorBackend)
+}
+
+
+@lru_cache(maxsize=None)
+def load_dialect(drivername: str) -> Type[Dialect]:
+    """Return the dialect class for a driver name, importing the driver module.
+
+    This is cached, so checking DSNs for databases using the same driver is
+    cheap.
+
+    """
+    dialect_class: Type[Dialect] = make_url(f"{drivername}://").get_dialect()
+    dialect_class.dbapi()
+    return dialect_class
+
+
 class DataBase:
     """A database to perform Queries."""
 
-    _engine: AsyncioEngine
-    _conn: Optional[Connection] = None
     _logger: logging.Logger = logging.getLogger()
     _pending_queries: int = 0
 
@@ -173,6 +784,12 @@ class DataBase:
         keep_connected: Optional[bool] = True,
         autocommit: Optional[bool] = True,
         labels: Optional[Dict[str, str]] = None,
+        pool_size: int = 1,
+        max_overflow: int = 0,
+        pool_timeout: Optional[float] = None,
+        backend: str = ThreadBackend.name,
+        query_timeout: Optional[float] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
     ):
         self.name = name
         self.dsn = dsn
@@ -180,17 +797,49 @@ class DataBase:
         self.keep_connected = keep_connected
         self.autocommit = autocommit
         self.labels = labels or {}
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.backend = backend
+        self.query_timeout = query_timeout
+        self.circuit_breaker = circuit_breaker
         self._connect_lock = asyncio.Lock()
+        # all open connections, and those not currently in use
+        self._conns: List[Connection] = []
+        self._idle_conns: List[Connection] = []
+        # tasks closing connections in background, for discarded ones and for
+        # attempts abandoned on timeout or cancellation, once they complete
+        self._close_tasks: Set[asyncio.Task] = set()
+        self._pool_semaphore = asyncio.Semaphore(pool_size + max_overflow)
         try:
-            self._engine = sqlalchemy.create_engine(
-                dsn,
-                strategy=ASYNCIO_STRATEGY,
-                execution_options={"autocommit": self.autocommit},
-            )
-        except ImportError as error:
-            raise self._db_error(f'module "{error.name}" not found', fatal=True)
-        except (ArgumentError, ValueError, NoSuchModuleError):
-            raise self._db_error(f'Invalid database DSN: "{self.dsn}"', fatal=True)
+            self._backend_class = BACKENDS[backend]
+        except KeyError:
+            raise self._db_error(f'Unknown backend: "{backend}"', fatal=True)
+        # the engine is only created on first connection, but the DSN is
+        # checked right away
+        self._backend_instance: Optional[Union[ThreadBackend, ExecutorBackend]] = None
+        with self._engine_errors():
+            load_dialect(make_url(dsn).drivername)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # only pickle the database definition, connections are not shared
+        return {
+            "name": self.name,
+            "dsn": self.dsn,
+            "connect_sql": self.connect_sql,
+            "keep_connected": self.keep_connected,
+            "autocommit": self.autocommit,
+            "labels": self.labels,
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+            "backend": self.backend,
+            "query_timeout": self.query_timeout,
+            "circuit_breaker": self.circuit_breaker,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(**state)  # type: ignore
 
     async def __aenter__(self):
         await self.connect()
@@ -199,54 +848,118 @@ class DataBase:
     async def __aexit__(self, exc_type, exc_value, traceback):
         await self.close()
 
+    def same_definition(self, other: "DataBase") -> bool:
+        """Return whether another DataBase has the same definition."""
+
+        def definition(database: "DataBase") -> Dict[str, Any]:
+            state = database.__getstate__()
+            breaker = state.pop("circuit_breaker")
+            state["circuit_breaker"] = breaker.settings if breaker else None
+            return state
+
+        return definition(self) == definition(other)
+
+    @property
+    def _backend(self) -> Union[ThreadBackend, ExecutorBackend]:
+        """The execution backend, created on first use."""
+        if self._backend_instance is None:
+            with self._engine_errors():
+                self._backend_instance = self._backend_class(
+                    self.dsn,
+                    # connections are pooled by the DataBase itself
+                    poolclass=NullPool,
+                    execution_options={"autocommit": self.autocommit},
+                )
+        return self._backend_instance
+
     @property
     def connected(self) -> bool:
         """Whether the database is connected."""
-        return self._conn is not None
+        return bool(self._conns)
+
+    def pool_status(self) -> PoolStatus:
+        """Return the status of the connection pool."""
+        idle = len(self._idle_conns)
+        return PoolStatus(used=len(self._conns) - idle, idle=idle)
 
     def set_logger(self, logger: logging.Logger):
         """Set a logger for the DataBase"""
         self._logger = logger
 
-    async def connect(self):
-        """Connect to the database."""
+    async def connect(self, timeout: Optional[float] = None):
+        """Connect to the database.
+
+        If the connection isn't established within the timeout, a
+        DataBaseError is raised, and the connection is closed if it completes
+        later.
+
+        """
         async with self._connect_lock:
             if self.connected:
                 return
 
-            try:
-                self._conn = await self._engine.connect()
-            except Exception as error:
-                raise self._db_error(error)
-
-            self._logger.debug(f'connected to database "{self.name}"')
-            for sql in self.connect_sql:
-                try:
-                    await self.execute_sql(sql)
-                except Exception as error:
-                    await self._close()
-                    raise self._db_error(f'failed executing query "{sql}": {error}')
+            conn = await self._open_connection(timeout=timeout)
+            self._idle_conns.append(conn)
 
     async def close(self):
-        """Close the database connection."""
+        """Close the database connection.
+
+        This also waits for connections being closed in background, including
+        those from abandoned connection attempts.
+
+        """
         async with self._connect_lock:
+            if self._close_tasks:
+                # don't cancel tasks if closing is cancelled
+                await asyncio.wait(list(self._close_tasks))
             if not self.connected:
                 return
             await self._close()
 
-    async def execute(self, query: Query) -> List[MetricResult]:
-        """Execute a query."""
+    async def execute(
+        self, query: Query, handler: Optional[ResultsHandler] = None
+    ) -> MetricResults:
+        """Execute a query.
+
+        If a handler is passed, it's called with MetricResults as they're
+        processed (possibly in multiple chunks, if the query has a chunk
+        size), and results are not included in the returned MetricResults.
+
+        If the query doesn't complete within its timeout (or the database
+        default one), it's cancelled and QueryTimeoutExpired is raised.  The
+        query is also cancelled if the execution is.
+
+        """
         await self.connect()
         self._logger.debug(f'running query "{query.name}" on database "{self.name}"')
+        timeout = query.timeout or self.query_timeout
         self._pending_queries += 1
-        self._conn: Connection
         try:
-            result = await self._execute_query(query)
-            return query.results(await QueryResults.from_results(result))
-        except Exception as error:
-            raise self._query_db_error(
-                query.name, error, fatal=isinstance(error, FATAL_ERRORS)
-            )
+            conn, pool_wait = await self._checkout()
+            discard = False
+            try:
+                results, stats = await asyncio.wait_for(
+                    self._run_query(conn, query, handler), timeout
+                )
+            except asyncio.TimeoutError:
+                assert timeout is not None
+                # the connection is left in an unknown state
+                discard = True
+                await self._cancel_query(conn)
+                raise self._query_timeout_error(query.name, timeout)
+            except asyncio.CancelledError:
+                # the execution was cancelled (e.g. when stopping or reloading),
+                # the query might still be running on the connection
+                discard = True
+                await self._cancel_query(conn)
+                raise
+            except Exception as error:
+                raise self._query_db_error(
+                    query.name, error, fatal=isinstance(error, FATAL_ERRORS)
+                )
+            finally:
+                await self._checkin(conn, discard=discard)
+            return MetricResults(results, pool_wait=pool_wait, stats=stats)
         finally:
             assert self._pending_queries >= 0, "pending queries is negative"
             self._pending_queries -= 1
@@ -256,22 +969,286 @@ class DataBase:
     async def execute_sql(
         self, sql: str, parameters: Optional[Dict[str, Any]] = None
     ) -> ResultProxy:
-        """Execute a raw SQL query."""
+        """Execute a raw SQL query.
+
+        The connection used for the query is returned to the pool once the
+        query is executed.
+
+        """
+        conn, _ = await self._checkout()
+        try:
+            return await self._execute_sql(conn, sql, parameters=parameters)
+        finally:
+            await self._checkin(conn)
+
+    async def _execute_sql(
+        self, conn: Connection, sql: str, parameters: Optional[Dict[str, Any]] = None,
+    ) -> ResultProxy:
+        """Execute a raw SQL query on a connection."""
         if parameters is None:
             parameters = {}
-        self._conn: Connection
-        return await self._conn.execute(sqlalchemy.text(sql), parameters)
+        return await conn.execute(sqlalchemy.text(sql), parameters)
+
+    async def _run_query(
+        self, conn: Connection, query: Query, handler: Optional[ResultsHandler] = None,
+    ) -> Tuple[List[MetricResult], QueryStats]:
+        """Execute a query and process its results."""
+        start = time.monotonic()
+        # the statement is compiled before the first await in the execution,
+        # so the count can't change for other executions in between
+        cache_misses = query.compiled_cache_misses
+        result = await self._execute_query(conn, query)
+        statement_cached = query.compiled_cache_misses == cache_misses
+        results, stats = await self._process_results(query, result, handler)
+        latency = time.monotonic() - start
+        stats = stats._replace(
+            latency=latency,
+            fetch_time=max(latency - stats.process_time, 0.0),
+            statement_cached=statement_cached,
+        )
+        return results, stats
+
+    async def _cancel_query(self, conn: Connection):
+        """Cancel the query running on a connection, if supported."""
+        dialect_name = conn.dialect.name
+        method_name = _QUERY_CANCEL_METHODS.get(dialect_name)
+        if method_name is None and dialect_name != "mysql":
+            return
+        dbapi_conn = conn.sync_connection.connection.connection
+        loop = asyncio.get_event_loop()
+        try:
+            if method_name is None:
+                await self._kill_mysql_query(dbapi_conn)
+            else:
+                # cancelling might block on network communication
+                await loop.run_in_executor(None, getattr(dbapi_conn, method_name))
+        except Exception as error:
+            self._logger.warning(
+                f'failed cancelling query on database "{self.name}": {error}'
+            )
 
-    async def _execute_query(self, query: Query) -> ResultProxy:
+    async def _kill_mysql_query(self, dbapi_conn: Any):
+        """Kill the query running on a MySQL connection from a new connection."""
+        # MySQLdb and PyMySQL have a method, MySQL Connector an attribute
+        thread_id = getattr(dbapi_conn, "thread_id", None)
+        if callable(thread_id):
+            thread_id = thread_id()
+        else:
+            thread_id = dbapi_conn.connection_id
+        kill_conn = await self._backend.connect()
+        try:
+            await kill_conn.execute(sqlalchemy.text(f"KILL QUERY {int(thread_id)}"))
+        finally:
+            await kill_conn.close()
+
+    async def _execute_query(self, conn: Connection, query: Query) -> ResultProxy:
         """Execute a query."""
-        return await self.execute_sql(query.sql, parameters=query.parameters)
+        statement = query.compiled_statement(conn.dialect)
+        return await conn.execute(statement, query.parameters)
+
+    async def _process_results(
+        self,
+        query: Query,
+        result: ResultProxy,
+        handler: Optional[ResultsHandler] = None,
+    ) -> Tuple[List[MetricResult], QueryStats]:
+        """Convert query results to MetricResults.
+
+        If the query has a chunk size, rows are fetched and processed in
+        chunks, so that the whole result is never held in memory.
+
+        Returned stats only include processing time, rows and series counts.
+
+        """
+        all_results: List[MetricResult] = []
+        process_time = 0.0
+        rows = series = 0
+        filtered: Counter[str] = collections.Counter()
+        # series from each parameters set of batched queries, across chunks
+        batch_series: Optional[Dict[Tuple, int]] = {} if query.batched else None
+
+        def process(query_results: QueryResults):
+            nonlocal process_time, rows, series
+            start = time.monotonic()
+            results = query.results(
+                query_results, filtered=filtered, batch_series=batch_series
+            )
+            if handler is None:
+                all_results.extend(results)
+            else:
+                handler(results)
+            process_time += time.monotonic() - start
+            rows += len(query_results.rows)
+            series += len(results)
+
+        if not query.chunk_size:
+            process(await QueryResults.from_results(result))
+        else:
+            try:
+                async for query_results in QueryResults.from_results_chunks(
+                    result, query.chunk_size
+                ):
+                    process(query_results)
+            except Exception:
+                # discard remaining rows
+                await result.close()
+                raise
+        stats = QueryStats(0.0, 0.0, process_time, rows, series, dict(filtered))
+        return all_results, stats
+
+    async def _open_connection(self, timeout: Optional[float] = None) -> Connection:
+        """Open a new connection and run connect SQL on it."""
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow_attempt():
+            # don't log, as this would flood logs while the database is down
+            raise DataBaseUnavailable(breaker.retry_in())
+        backend = self._backend
+        # connection attempts can't be interrupted, so wait for the attempt
+        # without cancelling it, and close the connection if it completes late
+        connecting = asyncio.ensure_future(backend.connect())
+        try:
+            try:
+                conn = await asyncio.wait_for(asyncio.shield(connecting), timeout)
+            except asyncio.TimeoutError:
+                self._abandon_connection(connecting)
+                raise ConnectionError(f"timeout connecting after {timeout} seconds")
+            except asyncio.CancelledError:
+                self._abandon_connection(connecting)
+                raise
+        except Exception as error:
+            if breaker is not None and breaker.record_failure():
+                self._logger.warning(
+                    f'circuit breaker open for database "{self.name}", '
+                    f"next connection attempt in {breaker.retry_in():.1f} seconds"
+                )
+            raise self._db_error(error)
+        if breaker is not None:
+            breaker.record_success()
+
+        self._conns.append(conn)
+        self._logger.debug(f'connected to database "{self.name}"')
+        for sql in self.connect_sql:
+            try:
+                await self._execute_sql(conn, sql)
+            except Exception as error:
+                await self._close_connection(conn)
+                raise self._db_error(f'failed executing query "{sql}": {error}')
+        return conn
+
+    async def _checkout(self) -> Tuple[Connection, float]:
+        """Get a connection from the pool, opening a new one if needed.
+
+        Return the connection and the time spent waiting for it.
+
+        """
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._pool_semaphore.acquire(), self.pool_timeout)
+        except asyncio.TimeoutError:
+            raise self._db_error(
+                "timeout waiting for a connection from the pool "
+                f"after {self.pool_timeout} seconds"
+            )
+        wait = time.monotonic() - start
+
+        if self._idle_conns:
+            return self._idle_conns.pop(), wait
+        try:
+            return await self._open_connection(), wait
+        except BaseException:
+            # also release on cancellation, or the permit would be lost
+            self._pool_semaphore.release()
+            raise
+
+    async def _checkin(self, conn: Connection, discard: bool = False):
+        """Return a connection to the pool.
+
+        Connections exceeding the pool size are closed.  If `discard` is
+        True, the connection is closed in background without waiting.
+
+        """
+        try:
+            if conn not in self._conns:
+                # the connection has been closed while in use
+                return
+            if discard:
+                self._discard_connection(conn)
+            elif len(self._conns) > self.pool_size:
+                await self._close_connection(conn)
+            else:
+                self._idle_conns.append(conn)
+        finally:
+            self._pool_semaphore.release()
 
     async def _close(self):
-        await self._conn.close()
-        self._conn = None
+        conns = self._conns[:]
+        self._idle_conns.clear()
         self._pending_queries = 0
+        for conn in conns:
+            await self._close_connection(conn)
+
+    async def _close_connection(self, conn: Connection):
+        self._conns.remove(conn)
+        if conn in self._idle_conns:
+            self._idle_conns.remove(conn)
+        await conn.close()
         self._logger.debug(f'disconnected from database "{self.name}"')
 
+    def _abandon_connection(self, connecting: "asyncio.Future[Connection]"):
+        """Close the connection from an abandoned attempt once established."""
+        self._close_in_background(self._close_late_connection(connecting))
+
+    async def _close_late_connection(self, connecting: "asyncio.Future[Connection]"):
+        try:
+            conn = await connecting
+        except Exception:
+            # errors have been reported when the attempt was abandoned
+            return
+        try:
+            await conn.close()
+        except Exception as error:
+            self._logger.debug(
+                f'error closing connection for database "{self.name}": {error}'
+            )
+        else:
+            self._logger.debug(f'closed late connection for database "{self.name}"')
+
+    def _discard_connection(self, conn: Connection):
+        """Remove a connection from the pool, closing it in background.
+
+        Closing might have to wait for a running query to complete.
+
+        """
+        self._conns.remove(conn)
+
+        async def close():
+            try:
+                await conn.close()
+            except Exception as error:
+                self._logger.debug(
+                    f'error closing connection for database "{self.name}": {error}'
+                )
+            else:
+                self._logger.debug(f'disconnected from database "{self.name}"')
+
+        self._close_in_background(close())
+
+    def _close_in_background(self, coro: Awaitable):
+        """Run a coroutine closing a connection, tracking its task."""
+        task = asyncio.ensure_future(coro)
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    @contextmanager
+    def _engine_errors(self) -> Iterator[None]:
+        """Convert errors from creating engines for the DSN to DataBaseErrors."""
+        try:
+            yield
+        except ImportError as error:
+            raise self._db_error(f'module "{error.name}" not found', fatal=True)
+        except (ArgumentError, ValueError, NoSuchModuleError):
+            raise self._db_error(f'Invalid database DSN: "{self.dsn}"', fatal=True)
+
     def _query_db_error(
         self, query_name: str, error: Union[str, Exception], fatal: bool = False,
     ):
@@ -282,6 +1259,14 @@ class DataBase:
         )
         return DataBaseError(message, fatal=fatal)
 
+    def _query_timeout_error(self, query_name: str, timeout: float):
+        """Create and log a QueryTimeoutExpired for a query."""
+        error = QueryTimeoutExpired(query_name, timeout)
+        self._logger.error(
+            f'query "{query_name}" on database "{self.name}" failed: {error}'
+        )
+        return error
+
     def _db_error(self, error: Union[str, Exception], fatal: bool = False):
         """Create and log a DataBaseError."""
         message = str(error).strip()
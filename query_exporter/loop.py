@@ -1,33 +1,106 @@
 """Loop to periodically execute queries."""
 
 import asyncio
-from collections import defaultdict
-from decimal import Decimal
-from logging import Logger
+from collections import (
+    defaultdict,
+    OrderedDict,
+)
+from functools import partial
+from logging import (
+    DEBUG,
+    Logger,
+)
 from typing import (
     Any,
+    Callable,
+    cast,
     Dict,
     Iterable,
     List,
     Mapping,
     Optional,
     Set,
+    Tuple,
+    TypeVar,
+    Union,
 )
 
-from prometheus_aioexporter import MetricsRegistry
-from toolrack.aio import PeriodicCall
+from prometheus_aioexporter import (
+    MetricConfig,
+    MetricsRegistry,
+)
 
 from .config import (
+    CIRCUIT_BREAKER_RETRY_METRIC_NAME,
+    CIRCUIT_BREAKER_STATE_METRIC_NAME,
     Config,
     DB_ERRORS_METRIC_NAME,
+    DROPPED_UPDATES_METRIC_NAME,
+    EXPIRED_SERIES_METRIC_NAME,
+    POOL_CONNECTIONS_METRIC_NAME,
+    POOL_WAIT_METRIC_NAME,
     QUERIES_METRIC_NAME,
+    QUERY_FETCH_TIME_METRIC_NAME,
+    QUERY_INTERVAL_METRIC_NAME,
+    QUERY_LATENCY_METRIC_NAME,
+    QUERY_PROCESS_TIME_METRIC_NAME,
+    QUERY_ROWS_METRIC_NAME,
+    QUERY_SERIES_METRIC_NAME,
+    QUERY_STATEMENT_CACHE_METRIC_NAME,
+    QUERY_STATS_METRICS,
+    SCRAPE_DEADLINE_MISSES_METRIC_NAME,
 )
 from .db import (
     DataBase,
     DATABASE_LABEL,
     DataBaseError,
+    DataBaseUnavailable,
+    MetricResult,
     Query,
+    QueryStats,
+    QueryTimeoutExpired,
 )
+from .schedule import (
+    phase_offset,
+    scheduled_call,
+    ScheduledCall,
+    Scheduler,
+)
+from .workers import WorkerPool
+
+# (query, database) names pair identifying executions of a query
+_QueryKey = Tuple[str, str]
+
+# (metric, database) names and labels identifying a metric series
+_SeriesKey = Tuple[str, str, Tuple[Tuple[str, str], ...]]
+
+# key for the scheduled call removing expired series
+_EXPIRE_SERIES_KEY = "expire-series"
+
+_Definition = TypeVar("_Definition", bound=Union[DataBase, Query])
+
+
+def _merge_changed(
+    current: Dict[str, _Definition], new: Dict[str, _Definition]
+) -> Tuple[Dict[str, _Definition], Set[str]]:
+    """Merge new definitions with current ones.
+
+    Return a dict with current definitions for unchanged entries and new ones
+    for the others, and the set of names for added, changed and removed ones.
+
+    """
+    merged: Dict[str, _Definition] = {}
+    changed = set(current) - set(new)
+    for name, definition in new.items():
+        current_definition = current.get(name)
+        if current_definition is not None and current_definition.same_definition(
+            definition  # type: ignore
+        ):
+            merged[name] = current_definition
+        else:
+            merged[name] = definition
+            changed.add(name)
+    return merged, changed
 
 
 class QueryLoop:
@@ -41,50 +114,235 @@ class QueryLoop:
         "enum": "state",
     }
 
+    # max number of cached update methods for metric series
+    METRIC_CACHE_SIZE = 100000
+
     def __init__(
-        self, config: Config, registry: MetricsRegistry, logger: Logger,
+        self,
+        config: Config,
+        registry: MetricsRegistry,
+        logger: Logger,
+        query_stats: bool = True,
+        workers: int = 0,
+        connect_parallelism: int = 10,
+        connect_timeout: Optional[float] = 10.0,
     ):
         self.loop = asyncio.get_event_loop()
         self._config = config
         self._registry = registry
         self._logger = logger
+        # whether to update builtin metrics for query execution statistics
+        self._query_stats = query_stats
+        self._workers = workers
+        # max number of concurrent connection attempts at startup and reload,
+        # and timeout for each of them
+        self._connect_parallelism = connect_parallelism
+        self._connect_timeout = connect_timeout
+        # background task connecting to databases, and names of databases
+        # whose connection attempt is pending
+        self._connect_task: Optional[asyncio.Task] = None
+        self._connecting: Set[str] = set()
+        # worker processes running queries, if enabled
+        self._worker_pool = self._make_worker_pool()
         self._periodic_queries: List[Query] = []
         self._aperiodic_queries: List[Query] = []
-        # map query names to their PeriodicCall
-        self._periodic_calls: Dict[str, PeriodicCall] = {}
+        # periodic calls for (query, database) names
+        self._scheduler = Scheduler(self.loop)
         # map query names to list of database names
         self._doomed_queries: Dict[str, Set[str]] = defaultdict(set)
+        # map (query, database) names to in-flight executions
+        self._running_queries: Dict[_QueryKey, Set[asyncio.Task]] = defaultdict(set)
+        # (query, database) names with an execution queued after the running one
+        self._queued_queries: Set[_QueryKey] = set()
+        # map (query, database) names to the loop time of the last successful
+        # execution, for queries with cached results
+        self._cached_queries: Dict[_QueryKey, float] = {}
+        # map database names to labels for their metrics
+        self._database_labels: Dict[str, Dict[str, str]] = {}
+        # map metric series to their update method, in least recently used
+        # order
+        self._metric_updaters: "OrderedDict[_SeriesKey, Callable]" = OrderedDict()
+        # map metric names to their series expiration, if set
+        self._metric_expirations: Dict[str, float] = {}
+        # map series for metrics with expiration to the loop time of their
+        # last update
+        self._series_last_updates: Dict[_SeriesKey, float] = {}
+        # map metric names to their max number of series, if set
+        self._metric_max_series: Dict[str, int] = {}
+        # map names of metrics with max series to their current series
+        self._metric_series: Dict[str, Set[_SeriesKey]] = defaultdict(set)
+        # names of metrics which reached their max series
+        self._series_limited_metrics: Set[str] = set()
         self._setup()
 
     async def start(self):
-        """Start periodic queries execution."""
-        for db in self._databases:
-            try:
-                await db.connect()
-            except DataBaseError:
-                self._increment_db_error_count(db)
+        """Start periodic queries execution.
 
-        for query in self._periodic_queries:
-            call = PeriodicCall(self.loop, self._run_query, query)
-            self._periodic_calls[query.name] = call
-            call.start(query.interval)
+        Databases are connected concurrently in background, and periodic
+        queries on each database are scheduled as soon as its connection
+        attempt completes.
+
+        """
+        self._scheduler.start()
+        if self._worker_pool is not None:
+            # workers connect to databases when running queries
+            self._worker_pool.start()
+        else:
+            self._start_connecting(self._databases)
+        self._schedule_calls()
 
     async def stop(self):
         """Stop periodic query execution."""
-        coros = (call.stop() for call in self._periodic_calls.values())
-        await asyncio.gather(*coros, return_exceptions=True)
-        self._periodic_calls.clear()
+        await self._stop_connecting()
+        self._scheduler.stop()
+        self._queued_queries.clear()
+        tasks = set().union(*self._running_queries.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._worker_pool is not None:
+            await self._worker_pool.stop()
         coros = (db.close() for db in self._databases)
         await asyncio.gather(*coros, return_exceptions=True)
 
-    async def run_aperiodic_queries(self):
-        """Run queries that don't have a period set."""
-        coros = (
-            self._execute_query(query, dbname)
-            for query in self._aperiodic_queries
+    async def reload(self, config: Config):
+        """Apply a new configuration, only changing what differs.
+
+        Unchanged databases keep their connections, and unchanged queries keep
+        running on them.  Changed and removed queries are stopped, changed
+        databases are reconnected in background, and changed or removed
+        metrics are unregistered, with changed ones registered again.
+
+        """
+        # pending connection attempts are restarted after applying changes
+        connecting = await self._stop_connecting()
+        old_config = self._config
+        databases, changed_dbs = _merge_changed(old_config.databases, config.databases)
+        queries, changed_queries = _merge_changed(old_config.queries, config.queries)
+        changed_metrics = {
+            name
+            for name in set(old_config.metrics) | set(config.metrics)
+            if old_config.metrics.get(name) != config.metrics.get(name)
+        }
+
+        await self._stop_queries(
+            (query.name, dbname)
+            for query in old_config.queries.values()
             for dbname in query.databases
+            if query.name in changed_queries or dbname in changed_dbs
         )
-        await asyncio.gather(*coros, return_exceptions=True)
+        for name in changed_queries - set(queries):
+            self._doomed_queries.pop(name, None)
+        self._forget_series(changed_metrics, changed_dbs)
+        # series for removed databases, and for databases with different labels,
+        # would otherwise be exported forever with their last values
+        self._remove_database_series(
+            set(old_config.metrics) - changed_metrics,
+            {
+                name
+                for name in changed_dbs & set(old_config.databases)
+                if name not in databases
+                or databases[name].labels != old_config.databases[name].labels
+            },
+        )
+        self._replace_metrics(
+            changed_metrics & set(old_config.metrics),
+            [config.metrics[name] for name in changed_metrics & set(config.metrics)],
+        )
+        await asyncio.gather(
+            *(
+                database.close()
+                for name, database in old_config.databases.items()
+                if name in changed_dbs
+            ),
+            return_exceptions=True,
+        )
+
+        self._config = Config(databases, config.metrics, queries)
+        self._setup()
+        if self._worker_pool is not None:
+            # workers have their own copy of databases and queries, restart
+            # only those running changed ones
+            await self._worker_pool.update(
+                databases,
+                queries,
+                changed_dbs
+                | {
+                    dbname
+                    for name in changed_queries
+                    for query in (old_config.queries.get(name), queries.get(name))
+                    if query is not None
+                    for dbname in query.databases
+                },
+            )
+        else:
+            self._start_connecting(
+                databases[name]
+                for name in sorted((changed_dbs | connecting) & set(databases))
+            )
+        self._scheduler.remove(_EXPIRE_SERIES_KEY)
+        self._schedule_calls()
+        self._logger.info(
+            f"configuration reloaded, changed databases: {len(changed_dbs)}, "
+            f"queries: {len(changed_queries)}, metrics: {len(changed_metrics)}"
+        )
+
+    async def run_aperiodic_queries(self, deadline: Optional[float] = None):
+        """Run queries that don't have a period set.
+
+        Concurrent calls share executions of the same query on a database,
+        and queries are not run again until their cache TTL (if any) expires,
+        so that metrics keep values from the previous execution.
+
+        If a deadline is specified, return after that many seconds even if
+        some queries are still running.  These are left running in background,
+        and metrics keep their previous values until they complete.
+
+        """
+        runs: Dict[asyncio.Future, _QueryKey] = {}
+        for query in self._aperiodic_queries:
+            for dbname in query.databases:
+                run = asyncio.ensure_future(self._run_aperiodic_query(query, dbname))
+                runs[run] = (query.name, dbname)
+        if not runs:
+            return
+        done, pending = await asyncio.wait(runs, timeout=deadline)
+        for future in done:
+            if not future.cancelled():
+                future.exception()
+        for future in pending:
+            query_name, dbname = runs[future]
+            self._logger.warning(
+                f'query "{query_name}" on database "{dbname}" not completed '
+                f"within the {deadline} seconds deadline"
+            )
+            db = self._config.databases[dbname]
+            self._update_metric(
+                db, SCRAPE_DEADLINE_MISSES_METRIC_NAME, 1, labels={"query": query_name}
+            )
+
+    def update_database_metrics(self):
+        """Update metrics for connection pools and circuit breakers.
+
+        These are not available when queries are run in workers.
+
+        """
+        if self._worker_pool is not None:
+            return
+        for db in self._databases:
+            status = db.pool_status()
+            for state, count in status._asdict().items():
+                self._update_metric(
+                    db, POOL_CONNECTIONS_METRIC_NAME, count, labels={"state": state}
+                )
+            breaker = db.circuit_breaker
+            if breaker is not None:
+                self._update_metric(
+                    db, CIRCUIT_BREAKER_STATE_METRIC_NAME, breaker.state
+                )
+                self._update_metric(
+                    db, CIRCUIT_BREAKER_RETRY_METRIC_NAME, breaker.retry_at or 0.0
+                )
 
     @property
     def _databases(self) -> Iterable[DataBase]:
@@ -92,31 +350,282 @@ class QueryLoop:
         return self._config.databases.values()
 
     def _setup(self):
-        """Initialize instance attributes."""
+        """Initialize instance attributes from the config."""
+        self._database_labels.clear()
+        self._metric_expirations.clear()
+        self._metric_max_series.clear()
+        self._periodic_queries.clear()
+        self._aperiodic_queries.clear()
         for database in self._databases:
             database.set_logger(self._logger)
+            labels = {DATABASE_LABEL: database.name}
+            labels.update(database.labels)
+            self._database_labels[database.name] = labels
+
+        for name, metric in self._config.metrics.items():
+            expiration = metric.config.get("expiration")
+            if expiration:
+                self._metric_expirations[name] = expiration
+            max_series = metric.config.get("max-series")
+            if max_series:
+                self._metric_max_series[name] = max_series
 
         for query in self._config.queries.values():
-            if query.interval is None:
+            if query.timed:
+                self._periodic_queries.append(query)
+            else:
                 self._aperiodic_queries.append(query)
+
+    def _make_worker_pool(self) -> Optional[WorkerPool]:
+        """Return a pool of worker processes for the config, if enabled."""
+        if not self._workers:
+            return None
+        return WorkerPool(
+            self._config.databases,
+            self._config.queries,
+            self._workers,
+            log_level=self._logger.getEffectiveLevel(),
+            logger=self._logger,
+        )
+
+    def _start_connecting(self, databases: Iterable[DataBase]):
+        """Connect to databases in a background task."""
+        databases = list(databases)
+        self._connecting.update(database.name for database in databases)
+        self._connect_task = asyncio.ensure_future(self._connect_databases(databases))
+
+    async def _stop_connecting(self) -> Set[str]:
+        """Cancel the background connection task, if running.
+
+        Return names of databases whose connection attempt didn't complete.
+
+        """
+        task, self._connect_task = self._connect_task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        connecting, self._connecting = self._connecting, set()
+        return connecting
+
+    async def _connect_databases(self, databases: Iterable[DataBase]):
+        """Connect to databases concurrently, up to the connect parallelism.
+
+        Periodic queries on each database are scheduled once its connection
+        attempt completes, even if it fails, since queries try to connect
+        again when run.
+
+        """
+        semaphore = asyncio.Semaphore(self._connect_parallelism)
+
+        async def connect(database: DataBase):
+            async with semaphore:
+                await self._connect(database)
+            self._connecting.discard(database.name)
+            self._schedule_calls(dbname=database.name)
+
+        await asyncio.gather(*(connect(database) for database in databases))
+
+    async def _connect(self, database: DataBase):
+        """Connect to a database, counting errors."""
+        try:
+            await database.connect(timeout=self._connect_timeout)
+        except DataBaseError:
+            self._increment_db_error_count(database)
+
+    def _schedule_calls(self, dbname: Optional[str] = None):
+        """Add scheduled calls for periodic queries not scheduled yet.
+
+        If a database name is specified, only calls for queries on that
+        database are added, otherwise databases with a pending connection
+        attempt are skipped.  Calls for queries that have been removed as
+        doomed are not added.
+
+        """
+        for query in self._periodic_queries:
+            for query_dbname in query.databases:
+                if dbname is None:
+                    if query_dbname in self._connecting:
+                        continue
+                elif query_dbname != dbname:
+                    continue
+                key = (query.name, query_dbname)
+                doomed = self._doomed_queries.get(query.name, ())
+                if key in self._scheduler or query_dbname in doomed:
+                    continue
+                self._scheduler.add(self._scheduled_call(query, query_dbname))
+                if query.adaptive_interval:
+                    self._update_interval_metric(query, query_dbname, query.interval)
+        if self._metric_expirations and _EXPIRE_SERIES_KEY not in self._scheduler:
+            # check for expired series at least twice per expiration
+            interval = min(self._metric_expirations.values()) / 2
+            self._scheduler.add(
+                ScheduledCall(_EXPIRE_SERIES_KEY, self._expire_series, interval)
+            )
+
+    async def _stop_queries(self, keys: Iterable[_QueryKey]):
+        """Stop scheduled calls and running executions for queries."""
+        tasks: List[asyncio.Task] = []
+        for key in keys:
+            query_name, dbname = key
+            self._scheduler.remove(key)
+            self._queued_queries.discard(key)
+            self._cached_queries.pop(key, None)
+            self._doomed_queries.get(query_name, set()).discard(dbname)
+            tasks.extend(self._running_queries.get(key, ()))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _forget_series(self, metric_names: Set[str], dbnames: Set[str]):
+        """Forget tracked series for metrics and databases.
+
+        Series for databases are forgotten since their labels might have
+        changed, so they're not expired.
+
+        """
+
+        def forget(key: _SeriesKey) -> bool:
+            return key[0] in metric_names or key[1] in dbnames
+
+        for key in list(self._metric_updaters):
+            if forget(key):
+                del self._metric_updaters[key]
+        for key in list(self._series_last_updates):
+            if forget(key):
+                del self._series_last_updates[key]
+        for name, series in list(self._metric_series.items()):
+            if name in metric_names:
+                del self._metric_series[name]
             else:
-                self._periodic_queries.append(query)
+                series.difference_update([key for key in series if forget(key)])
+        self._series_limited_metrics.difference_update(metric_names)
+
+    def _remove_database_series(self, metric_names: Iterable[str], dbnames: Set[str]):
+        """Remove series for databases from metrics in the registry."""
+        if not dbnames:
+            return
+        for name in metric_names:
+            if not self._exported_metric(name):
+                continue
+            metric = self._registry.get_metric(name)
+            index = metric._labelnames.index(DATABASE_LABEL)
+            with metric._lock:
+                label_values = list(metric._metrics)
+            for values in label_values:
+                if values[index] in dbnames:
+                    metric.remove(*values)
+
+    def _replace_metrics(self, removed: Iterable[str], added: Iterable[MetricConfig]):
+        """Unregister metrics from the registry, and register new ones."""
+        for name in removed:
+            if self._exported_metric(name):
+                self._registry.registry.unregister(self._registry.get_metric(name))
+        self._registry.create_metrics(
+            config for config in added if self._exported_metric(config.name)
+        )
+
+    def _exported_metric(self, name: str) -> bool:
+        """Return whether a metric is exported."""
+        return self._query_stats or name not in QUERY_STATS_METRICS
+
+    def _scheduled_call(self, query: Query, dbname: str) -> ScheduledCall:
+        """Return the ScheduledCall for a periodic query on a database."""
+        key = (query.name, dbname)
+        func = partial(self._run_query, query, dbname)
+        if query.schedule is not None:
+            return scheduled_call(key, func, query.schedule, jitter=query.jitter)
+        # spread executions of queries across their interval
+        offset = phase_offset(f"{query.name}:{dbname}", query.interval)
+        return ScheduledCall(
+            key, func, query.interval, offset=offset, jitter=query.jitter
+        )
+
+    def _run_query(self, query: Query, dbname: str):
+        """Periodic task to run a query on a database."""
+        key = (query.name, dbname)
+        if self._running_queries[key] and query.overlap != "allow":
+            if query.overlap == "queue-one" and key not in self._queued_queries:
+                self._queued_queries.add(key)
+            else:
+                self._skip_query(query, dbname)
+            return
+        self._start_query_task(query, dbname)
+
+    async def _run_aperiodic_query(self, query: Query, dbname: str):
+        """Run an aperiodic query, unless cached or already running."""
+        key = (query.name, dbname)
+        last_run = self._cached_queries.get(key)
+        if (
+            query.cache_ttl is not None
+            and last_run is not None
+            and self.loop.time() - last_run < query.cache_ttl
+        ):
+            return
+
+        tasks = self._running_queries.get(key)
+        if tasks:
+            task = next(iter(tasks))
+        else:
+            task = self._start_query_task(query, dbname)
+        # don't cancel the execution shared with other calls
+        await asyncio.shield(task)
+
+    def _start_query_task(self, query: Query, dbname: str) -> asyncio.Task:
+        """Start a task executing a query on a database."""
+        key = (query.name, dbname)
+        task = self.loop.create_task(self._execute_query(query, dbname))
+        self._running_queries[key].add(task)
+        task.add_done_callback(partial(self._query_task_done, query, dbname))
+        return task
 
-    def _run_query(self, query: Query):
-        """Periodic task to run a query."""
-        for dbname in query.databases:
-            self.loop.create_task(self._execute_query(query, dbname))
+    def _query_task_done(self, query: Query, dbname: str, task: asyncio.Task):
+        """Cleanup after a query execution task, starting a queued one."""
+        key = (query.name, dbname)
+        running = self._running_queries[key]
+        running.discard(task)
+        if not running:
+            del self._running_queries[key]
+        if key in self._queued_queries and not task.cancelled():
+            self._queued_queries.remove(key)
+            self._start_query_task(query, dbname)
+
+    def _skip_query(self, query: Query, dbname: str):
+        """Skip a query execution overlapping a running one."""
+        self._logger.debug(
+            f'skipping query "{query.name}" on database "{dbname}", '
+            "previous execution still running"
+        )
+        db = self._config.databases[dbname]
+        self._increment_queries_count(db, "skipped")
 
     async def _execute_query(self, query: Query, dbname: str):
         """'Execute a Query on a DataBase."""
-        if await self._remove_if_dooomed(query, dbname):
+        if self._remove_if_dooomed(query, dbname):
             return
 
         db = self._config.databases[dbname]
+        start_time = self.loop.time()
+        handler = partial(self._update_metrics, db)
         try:
-            results = await db.execute(query)
+            if self._worker_pool is not None:
+                metric_results = await self._worker_pool.execute(
+                    query, dbname, handler=handler
+                )
+            else:
+                metric_results = await db.execute(query, handler=handler)
+        except QueryTimeoutExpired:
+            self._increment_queries_count(db, "timeout")
+            self._adapt_interval(query, dbname, None)
+            return
+        except DataBaseUnavailable as error:
+            self._logger.debug(
+                f'not running query "{query.name}" on database "{dbname}": {error}'
+            )
+            self._increment_queries_count(db, "unavailable")
+            return
         except DataBaseError as error:
             self._increment_queries_count(db, "error")
+            self._adapt_interval(query, dbname, None)
             if error.fatal:
                 self._logger.debug(
                     f'removing doomed query "{query.name}" ' f'for database "{dbname}"'
@@ -124,11 +633,79 @@ class QueryLoop:
                 self._doomed_queries[query.name].add(dbname)
             return
 
-        for result in results:
-            self._update_metric(db, result.metric, result.value, labels=result.labels)
         self._increment_queries_count(db, "success")
+        self._adapt_interval(query, dbname, self.loop.time() - start_time)
+        if query.cache_ttl:
+            self._cached_queries[(query.name, dbname)] = self.loop.time()
+        if metric_results.pool_wait is not None:
+            self._update_metric(db, POOL_WAIT_METRIC_NAME, metric_results.pool_wait)
+        stats = metric_results.stats
+        if stats is not None:
+            if self._query_stats:
+                self._update_query_stats_metrics(db, query, stats)
+            for name, count in stats.filtered.items():
+                self._increment_dropped_updates_count(db, name, "label-filter", count)
+
+    def _update_query_stats_metrics(
+        self, database: DataBase, query: Query, stats: QueryStats
+    ):
+        """Update metrics for query execution statistics."""
+        labels = {"query": query.name}
+        for name, value in (
+            (QUERY_LATENCY_METRIC_NAME, stats.latency),
+            (QUERY_FETCH_TIME_METRIC_NAME, stats.fetch_time),
+            (QUERY_PROCESS_TIME_METRIC_NAME, stats.process_time),
+            (QUERY_ROWS_METRIC_NAME, stats.rows),
+            (QUERY_SERIES_METRIC_NAME, stats.series),
+        ):
+            self._update_metric(database, name, value, labels=labels)
+        self._update_metric(
+            database,
+            QUERY_STATEMENT_CACHE_METRIC_NAME,
+            1,
+            labels={**labels, "result": "hit" if stats.statement_cached else "miss"},
+        )
 
-    async def _remove_if_dooomed(self, query: Query, dbname: str) -> bool:
+    def _adapt_interval(self, query: Query, dbname: str, duration: Optional[float]):
+        """Adapt the interval of a query to the cost of its execution.
+
+        The interval is doubled when the query fails (if `duration` is None) or
+        takes longer than the cost threshold, and halved when the query takes
+        less than a quarter of it, within the configured bounds.  The new
+        interval applies from the call following the next one.
+
+        """
+        adaptive_interval = query.adaptive_interval
+        if adaptive_interval is None:
+            return
+        call = self._scheduler.get((query.name, dbname))
+        if call is None:
+            return
+
+        interval = call.interval
+        threshold = adaptive_interval.cost_threshold
+        if duration is None or duration / interval > threshold:
+            interval = min(interval * 2, adaptive_interval.max_interval)
+        elif duration / interval < threshold / 4:
+            interval = max(interval / 2, adaptive_interval.min_interval)
+        if interval == call.interval:
+            return
+
+        self._logger.debug(
+            f'changing interval for query "{query.name}" on database "{dbname}" '
+            f"from {call.interval} to {interval} seconds"
+        )
+        call.interval = interval
+        self._update_interval_metric(query, dbname, interval)
+
+    def _update_interval_metric(self, query: Query, dbname: str, interval: float):
+        """Update the effective interval metric for a query."""
+        db = self._config.databases[dbname]
+        self._update_metric(
+            db, QUERY_INTERVAL_METRIC_NAME, interval, labels={"query": query.name}
+        )
+
+    def _remove_if_dooomed(self, query: Query, dbname: str) -> bool:
         """Remove a query if it will never work.
 
         Return whether the query has been removed for the database.
@@ -137,17 +714,22 @@ class QueryLoop:
         if dbname not in self._doomed_queries[query.name]:
             return False
 
+        if query.timed:
+            self._scheduler.remove((query.name, dbname))
         if set(query.databases) == self._doomed_queries[query.name]:
             # the query has failed on all databases
-            if query.interval is None:
-                self._aperiodic_queries.remove(query)
-            else:
-                self._periodic_queries.remove(query)
-                call = self._periodic_calls.pop(query.name, None)
-                if call is not None:
-                    await call.stop()
+            queries = self._periodic_queries if query.timed else self._aperiodic_queries
+            if query in queries:
+                queries.remove(query)
         return True
 
+    def _update_metrics(self, database: DataBase, results: List[MetricResult]):
+        """Update metrics from query results."""
+        for result in results:
+            self._update_metric(
+                database, result.metric, result.value, labels=result.labels
+            )
+
     def _update_metric(
         self,
         database: DataBase,
@@ -155,30 +737,117 @@ class QueryLoop:
         value: Any,
         labels: Optional[Mapping[str, str]] = None,
     ):
-        """Update value for a metric."""
-        if value is None:
-            # don't fail is queries that count return NULL
-            value = 0.0
-        elif isinstance(value, Decimal):
-            value = float(value)
+        """Update value for a metric.
+
+        Updates creating new series for a metric which has reached its max
+        number of series are dropped.
+
+        """
+        key = (name, database.name, tuple(labels.items()) if labels else ())
+        max_series = self._metric_max_series.get(name)
+        if max_series is not None:
+            series = self._metric_series[name]
+            if key not in series:
+                if len(series) >= max_series:
+                    self._drop_series_update(database, name, max_series)
+                    return
+                series.add(key)
+        updater = self._metric_updaters.get(key)
+        if updater is None:
+            updater = self._metric_updater(database, name, labels)
+            self._metric_updaters[key] = updater
+            if len(self._metric_updaters) > self.METRIC_CACHE_SIZE:
+                self._metric_updaters.popitem(last=False)
+        else:
+            self._metric_updaters.move_to_end(key)
+        if name in self._metric_expirations:
+            self._series_last_updates[key] = self.loop.time()
+
+        if self._logger.isEnabledFor(DEBUG):
+            method = self._METRIC_METHODS[self._config.metrics[name].type]
+            all_labels = self._all_labels(database, labels)
+            labels_string = ",".join(
+                f'{label}="{value}"' for label, value in sorted(all_labels.items())
+            )
+            self._logger.debug(
+                f'updating metric "{name}" {method} {value} {{{labels_string}}}'
+            )
+        updater(value)
+
+    def _expire_series(self):
+        """Remove series not updated within their metric expiration."""
+        now = self.loop.time()
+        expired: Dict[Tuple[str, str], int] = defaultdict(int)
+        for key, last_update in list(self._series_last_updates.items()):
+            name, dbname, labels = key
+            if now - last_update < self._metric_expirations[name]:
+                continue
+            del self._series_last_updates[key]
+            self._metric_updaters.pop(key, None)
+            self._metric_series[name].discard(key)
+            database = self._config.databases[dbname]
+            all_labels = self._all_labels(database, dict(labels))
+            label_values = (
+                str(all_labels[label])
+                for label in self._config.metrics[name].config["labels"]
+            )
+            self._registry.get_metric(name).remove(*label_values)
+            expired[name, dbname] += 1
+
+        for (name, dbname), count in expired.items():
+            self._logger.debug(
+                f'removed {count} expired series for metric "{name}" '
+                f'from database "{dbname}"'
+            )
+            database = self._config.databases[dbname]
+            self._update_metric(
+                database, EXPIRED_SERIES_METRIC_NAME, count, labels={"metric": name}
+            )
+
+    def _drop_series_update(self, database: DataBase, name: str, max_series: int):
+        """Drop an update creating a new series beyond the metric limit."""
+        if name not in self._series_limited_metrics:
+            # only log once, drops are counted in the metric
+            self._series_limited_metrics.add(name)
+            self._logger.warning(
+                f'limit of {max_series} series reached for metric "{name}", '
+                "dropping updates for new series"
+            )
+        self._increment_dropped_updates_count(database, name, "max-series")
+
+    def _metric_updater(
+        self, database: DataBase, name: str, labels: Optional[Mapping[str, str]]
+    ) -> Callable:
+        """Return the update method for a metric series."""
         method = self._METRIC_METHODS[self._config.metrics[name].type]
-        all_labels = {DATABASE_LABEL: database.name}
-        all_labels.update(database.labels)
-        if labels:
-            all_labels.update(labels)
-        labels_string = ",".join(
-            f'{label}="{value}"' for label, value in sorted(all_labels.items())
-        )
-        self._logger.debug(
-            f'updating metric "{name}" {method} {value} {{{labels_string}}}'
-        )
+        all_labels = self._all_labels(database, labels)
         metric = self._registry.get_metric(name, labels=all_labels)
-        getattr(metric, method)(value)
+        return cast(Callable, getattr(metric, method))
+
+    def _all_labels(
+        self, database: DataBase, labels: Optional[Mapping[str, str]]
+    ) -> Dict[str, str]:
+        """Return all labels for a metric series from a database."""
+        all_labels = self._database_labels[database.name]
+        if labels:
+            all_labels = {**all_labels, **labels}
+        return all_labels
 
     def _increment_queries_count(self, database: DataBase, status: str):
         """Increment count of queries in a status for a database."""
         self._update_metric(database, QUERIES_METRIC_NAME, 1, labels={"status": status})
 
+    def _increment_dropped_updates_count(
+        self, database: DataBase, name: str, reason: str, count: int = 1
+    ):
+        """Increment number of dropped updates for a metric."""
+        self._update_metric(
+            database,
+            DROPPED_UPDATES_METRIC_NAME,
+            count,
+            labels={"metric": name, "reason": reason},
+        )
+
     def _increment_db_error_count(self, database: DataBase):
         """Increment number of errors for a database."""
         self._update_metric(database, DB_ERRORS_METRIC_NAME, 1)
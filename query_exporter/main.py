@@ -1,25 +1,36 @@
 """Script entry point."""
 
 import argparse
+import asyncio
+import signal
 from typing import (
     IO,
     List,
+    Optional,
 )
 
-from aiohttp.web import Application
+from aiohttp.web import (
+    Application,
+    Request,
+    Response,
+)
 from prometheus_aioexporter import (
     MetricConfig,
     PrometheusExporterScript,
 )
 from prometheus_aioexporter.metric import InvalidMetricType
 from toolrack.script import ErrorExitMessage
+import yaml
 
 from . import __version__
 from .config import (
     Config,
     ConfigError,
     load_config,
+    QUERY_STATS_METRICS,
+    Shard,
 )
+from .db import ExecutorBackend
 from .loop import QueryLoop
 
 
@@ -42,16 +53,109 @@ class QueryExporterScript(PrometheusExporterScript):
             action="store_true",
             help="only check configuration, don't run the exporter",
         )
+        parser.add_argument(
+            "--scrape-deadline",
+            type=float,
+            help=(
+                "max seconds to wait for queries run on HTTP requests, "
+                "reporting previous values for late ones"
+            ),
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help=(
+                "number of worker processes running queries "
+                "(by default, queries are run in the main process)"
+            ),
+        )
+        parser.add_argument(
+            "--executor-threads",
+            type=int,
+            help=(
+                "max number of threads for databases using the executor backend "
+                "(by default, based on the number of CPUs)"
+            ),
+        )
+        parser.add_argument(
+            "--connect-parallelism",
+            type=int,
+            default=10,
+            help="max number of databases to connect to concurrently at startup",
+        )
+        parser.add_argument(
+            "--connect-timeout",
+            type=float,
+            default=10.0,
+            help="max seconds to wait for each database connection at startup",
+        )
+        parser.add_argument(
+            "--shard-count",
+            type=int,
+            default=1,
+            help=(
+                "number of exporter instances sharing databases from the "
+                "configuration file"
+            ),
+        )
+        parser.add_argument(
+            "--shard-index",
+            type=int,
+            default=0,
+            help="index of the shard of databases for this instance (from 0)",
+        )
+        parser.add_argument(
+            "--enable-reload-endpoint",
+            action="store_true",
+            help="reload the configuration on POST requests to /-/reload",
+        )
+        parser.add_argument(
+            "--no-query-stats",
+            action="store_true",
+            help="don't export builtin metrics with query execution statistics",
+        )
 
     def configure(self, args: argparse.Namespace):
-        config = self._load_config(args.config)
+        if args.connect_parallelism < 1:
+            raise ErrorExitMessage("Connect parallelism must be at least 1")
+        if args.connect_timeout <= 0:
+            raise ErrorExitMessage("Connect timeout must be positive")
+        if args.executor_threads is not None:
+            if args.executor_threads < 1:
+                raise ErrorExitMessage("Executor threads must be at least 1")
+            ExecutorBackend.max_threads = args.executor_threads
+        self.shard = self._get_shard(args.shard_index, args.shard_count)
+        self.config_path: str = args.config.name
+        config = self._load_config(args.config, shard=self.shard)
         if args.check_only:
             self.exit()
-        self.create_metrics(config.metrics.values())
-        self.query_loop = QueryLoop(config, self.registry, self.logger)
+        query_stats = not args.no_query_stats
+        self.create_metrics(
+            metric
+            for name, metric in config.metrics.items()
+            if query_stats or name not in QUERY_STATS_METRICS
+        )
+        self.query_loop = QueryLoop(
+            config,
+            self.registry,
+            self.logger,
+            query_stats=query_stats,
+            workers=args.workers,
+            connect_parallelism=args.connect_parallelism,
+            connect_timeout=args.connect_timeout,
+        )
+        self.scrape_deadline: Optional[float] = args.scrape_deadline
+        self.enable_reload_endpoint: bool = args.enable_reload_endpoint
+        self._reload_lock = asyncio.Lock()
 
     async def on_application_startup(self, application: Application):
         application["exporter"].set_metric_update_handler(self._update_handler)
+        if self.enable_reload_endpoint:
+            application.router.add_post("/-/reload", self._reload_handler)
+        self.query_loop.loop.add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.ensure_future(self._reload())
+        )
         await self.query_loop.start()
 
     async def on_application_shutdown(self, application: Application):
@@ -59,12 +163,49 @@ class QueryExporterScript(PrometheusExporterScript):
 
     async def _update_handler(self, metrics: List[MetricConfig]):
         """Run queries with no specified interval on each request."""
-        await self.query_loop.run_aperiodic_queries()
+        await self.query_loop.run_aperiodic_queries(deadline=self.scrape_deadline)
+        self.query_loop.update_database_metrics()
+
+    async def _reload_handler(self, request: Request) -> Response:
+        """Reload the configuration on HTTP requests."""
+        error = await self._reload()
+        if error:
+            return Response(status=400, text=error + "\n")
+        return Response(text="Configuration reloaded\n")
+
+    async def _reload(self) -> Optional[str]:
+        """Reload the configuration file, applying changes.
+
+        Return an error message if the configuration is invalid, in which case
+        the current one is kept.
+
+        """
+        async with self._reload_lock:
+            self.logger.info(f"reloading configuration from {self.config_path}")
+            try:
+                with open(self.config_path) as config_file:
+                    config = load_config(config_file, self.logger, shard=self.shard)
+            except (OSError, yaml.YAMLError, InvalidMetricType, ConfigError) as error:
+                message = f"failed reloading configuration: {error}"
+                self.logger.error(message)
+                return message
+            await self.query_loop.reload(config)
+        return None
+
+    def _get_shard(self, index: int, count: int) -> Optional[Shard]:
+        """Return the shard of databases for the exporter, if sharding."""
+        if count < 1:
+            raise ErrorExitMessage("Shard count must be at least 1")
+        if not 0 <= index < count:
+            raise ErrorExitMessage("Shard index must be between 0 and shard count - 1")
+        if count == 1:
+            return None
+        return Shard(index, count)
 
-    def _load_config(self, config_file: IO) -> Config:
+    def _load_config(self, config_file: IO, shard: Optional[Shard] = None) -> Config:
         """Load the application configuration."""
         try:
-            config = load_config(config_file, self.logger)
+            config = load_config(config_file, self.logger, shard=shard)
         except (InvalidMetricType, ConfigError) as error:
             raise ErrorExitMessage(str(error))
         finally:
@@ -0,0 +1,280 @@
+"""Scheduler for periodic calls."""
+
+from abc import (
+    ABC,
+    abstractmethod,
+)
+import asyncio
+from datetime import datetime
+import heapq
+from itertools import count
+import random
+import re
+import time
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+import zlib
+
+from croniter import croniter
+from dateutil.tz import tzlocal
+
+# format for intervals aligned to the wall clock
+_ALIGNED_INTERVAL_RE = re.compile(r"every\s+(?P<value>[1-9][0-9]*)(?P<unit>[smhd]?)$")
+_INTERVAL_MULTIPLIERS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 3600 * 24}
+
+
+def phase_offset(key: str, interval: float) -> float:
+    """Return a deterministic offset for a key, between 0 and the interval.
+
+    Offsets are stable across restarts and replicas, and spread calls with the
+    same interval across it.
+
+    """
+    return zlib.crc32(key.encode("utf-8")) / 2 ** 32 * interval
+
+
+class ScheduledCall:
+    """A function called periodically by a Scheduler.
+
+    Calls are made every `interval` seconds, shifted by `offset` from the
+    scheduler start. If `jitter` is not zero, each call is delayed by a random
+    time up to `jitter` seconds, without affecting following ones.
+
+    """
+
+    def __init__(
+        self,
+        key: Hashable,
+        func: Callable[[], None],
+        interval: float,
+        offset: float = 0.0,
+        jitter: float = 0.0,
+    ):
+        self.key = key
+        self.func = func
+        self.interval = interval
+        self.offset = offset
+        self.jitter = jitter
+        # scheduled time of the next call, without jitter
+        self.next_time: Optional[float] = None
+        self.cancelled = False
+
+    def first_time(self, now: float) -> float:
+        """Return the time for the first call, based on the start time."""
+        return now + self.offset
+
+    def following_time(self, now: float) -> float:
+        """Return the time of the call following the current one.
+
+        Calls missed because the loop was busy are skipped.
+
+        """
+        assert self.next_time is not None, "following time for unscheduled call"
+        next_time = self.next_time + self.interval
+        if next_time <= now:
+            missed = (now - next_time) // self.interval + 1
+            next_time += missed * self.interval
+        return next_time
+
+
+class WallClockScheduledCall(ScheduledCall, ABC):
+    """A function called at times based on the wall clock.
+
+    Subclasses must implement `wall_time_after`.
+
+    """
+
+    def __init__(self, key: Hashable, func: Callable[[], None], jitter: float = 0.0):
+        super().__init__(key, func, 0, jitter=jitter)
+        # wall-clock time of the next call
+        self.next_wall_time: Optional[float] = None
+
+    @abstractmethod
+    def wall_time_after(self, wall_time: float) -> float:
+        """Return the wall-clock time of the first call after the specified one."""
+
+    def first_time(self, now: float) -> float:
+        return self._loop_time(now, time.time())
+
+    def following_time(self, now: float) -> float:
+        assert self.next_wall_time is not None, "following time for unscheduled call"
+        # never return the same time for the call that just ran, even if the
+        # loop timer ran a bit early
+        return self._loop_time(now, max(time.time(), self.next_wall_time))
+
+    def _loop_time(self, now: float, wall_time: float) -> float:
+        """Return the loop time for the next call after a wall-clock time."""
+        self.next_wall_time = self.wall_time_after(wall_time)
+        return now + max(self.next_wall_time - time.time(), 0.0)
+
+
+class AlignedScheduledCall(WallClockScheduledCall):
+    """A function called at multiples of the interval on the wall clock."""
+
+    def __init__(
+        self,
+        key: Hashable,
+        func: Callable[[], None],
+        interval: float,
+        jitter: float = 0.0,
+    ):
+        super().__init__(key, func, jitter=jitter)
+        self.interval = interval
+
+    def wall_time_after(self, wall_time: float) -> float:
+        return (wall_time // self.interval + 1) * self.interval
+
+
+class CronScheduledCall(WallClockScheduledCall):
+    """A function called based on a cron expression, in local time."""
+
+    def __init__(
+        self,
+        key: Hashable,
+        func: Callable[[], None],
+        expression: str,
+        jitter: float = 0.0,
+    ):
+        super().__init__(key, func, jitter=jitter)
+        self.expression = expression
+
+    def wall_time_after(self, wall_time: float) -> float:
+        start = datetime.fromtimestamp(wall_time, tz=tzlocal())
+        return float(croniter(self.expression, start).get_next(float))
+
+
+def valid_schedule(schedule: str) -> bool:
+    """Return whether a schedule is valid."""
+    return bool(_ALIGNED_INTERVAL_RE.match(schedule)) or croniter.is_valid(schedule)
+
+
+def scheduled_call(
+    key: Hashable, func: Callable[[], None], schedule: str, jitter: float = 0.0
+) -> WallClockScheduledCall:
+    """Return a call for a schedule.
+
+    The schedule can be either a cron expression, or an interval aligned to
+    the wall clock, in the form "every <N>[smhd]".
+
+    """
+    match = _ALIGNED_INTERVAL_RE.match(schedule)
+    if match:
+        interval = int(match["value"]) * _INTERVAL_MULTIPLIERS[match["unit"]]
+        return AlignedScheduledCall(key, func, interval, jitter=jitter)
+    return CronScheduledCall(key, func, schedule, jitter=jitter)
+
+
+class Scheduler:
+    """Call functions periodically from a single timer.
+
+    Scheduled calls are kept in a heap sorted by time, and a single loop timer
+    is set for the earliest one.
+
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop or asyncio.get_event_loop()
+        self._calls: Dict[Hashable, ScheduledCall] = {}
+        self._heap: List[Tuple[float, int, ScheduledCall]] = []
+        # sequence for ordering calls scheduled at the same time
+        self._sequence = count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        """Whether the scheduler is running."""
+        return self._running
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def get(self, key: Hashable) -> Optional[ScheduledCall]:
+        """Return the call for a key, if present."""
+        return self._calls.get(key)
+
+    def add(self, call: ScheduledCall):
+        """Add a call to the scheduler.
+
+        If the scheduler is running, the call is scheduled right away.
+
+        """
+        if call.key in self._calls:
+            raise KeyError(f"Call already scheduled: {call.key}")
+        self._calls[call.key] = call
+        if self._running:
+            self._schedule(call, call.first_time(self.loop.time()))
+            self._set_timer()
+
+    def remove(self, key: Hashable):
+        """Remove a call from the scheduler, if present."""
+        call = self._calls.pop(key, None)
+        if call is not None:
+            # the heap entry is discarded when it's due
+            call.cancelled = True
+
+    def start(self):
+        """Start running scheduled calls."""
+        if self._running:
+            return
+        self._running = True
+        now = self.loop.time()
+        for call in self._calls.values():
+            self._schedule(call, call.first_time(now))
+        self._set_timer()
+
+    def stop(self):
+        """Stop running scheduled calls."""
+        self._running = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._heap.clear()
+
+    def _schedule(self, call: ScheduledCall, next_time: float):
+        """Add the next run for a call to the heap."""
+        call.next_time = next_time
+        if call.jitter:
+            next_time += random.uniform(0, call.jitter)
+        heapq.heappush(self._heap, (next_time, next(self._sequence), call))
+
+    def _set_timer(self):
+        """Set the timer for the earliest call, if needed."""
+        if not self._heap:
+            return
+        when = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self.loop.call_at(when, self._run_due)
+
+    def _run_due(self):
+        """Run calls which are due, and reschedule them."""
+        self._timer = None
+        now = self.loop.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, call = heapq.heappop(heap)
+            if call.cancelled:
+                continue
+            self._schedule(call, call.following_time(now))
+            try:
+                call.func()
+            except Exception as error:
+                self.loop.call_exception_handler(
+                    {
+                        "message": f"Error running scheduled call {call.key}",
+                        "exception": error,
+                    }
+                )
+        self._set_timer()
@@ -1,4 +1,5 @@
 import logging
+import re
 
 import yaml
 
@@ -6,12 +7,18 @@ import pytest
 
 from ..config import (
     ConfigError,
+    database_shard,
     DB_ERRORS_METRIC_NAME,
     GLOBAL_METRICS,
     load_config,
     QUERIES_METRIC_NAME,
+    Shard,
+)
+from ..db import (
+    AdaptiveInterval,
+    LabelFilter,
+    QueryMetric,
 )
-from ..db import QueryMetric
 
 
 @pytest.fixture
@@ -138,12 +145,109 @@ class TestLoadConfig:
         assert database1.dsn == "sqlite:///foo"
         assert database1.keep_connected
         assert database1.autocommit
-        assert database1._engine._execution_options == {"autocommit": True}
+        assert database1._backend.engine._execution_options == {"autocommit": True}
         assert database2.name == "db2"
         assert database2.dsn == "sqlite:///bar"
         assert not database2.keep_connected
         assert not database2.autocommit
-        assert database2._engine._execution_options == {"autocommit": False}
+        assert database2._backend.engine._execution_options == {"autocommit": False}
+
+    def test_load_databases_pool_options(self, logger, write_config):
+        """Connection pool options can be specified for databases."""
+        config = {
+            "databases": {
+                "db1": {"dsn": "sqlite://"},
+                "db2": {
+                    "dsn": "sqlite://",
+                    "pool-size": 5,
+                    "max-overflow": 2,
+                    "pool-timeout": 10,
+                },
+            },
+            "metrics": {},
+            "queries": {},
+        }
+        config_file = write_config(config)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        database1 = result.databases["db1"]
+        assert database1.pool_size == 1
+        assert database1.max_overflow == 0
+        assert database1.pool_timeout is None
+        database2 = result.databases["db2"]
+        assert database2.pool_size == 5
+        assert database2.max_overflow == 2
+        assert database2.pool_timeout == 10
+
+    def test_load_databases_query_timeout(self, logger, write_config):
+        """A default query timeout can be specified for databases."""
+        config = {
+            "databases": {"db": {"dsn": "sqlite://", "query-timeout": 2.5}},
+            "metrics": {},
+            "queries": {},
+        }
+        config_file = write_config(config)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert result.databases["db"].query_timeout == 2.5
+
+    def test_load_databases_circuit_breaker(self, logger, write_config):
+        """A circuit breaker can be configured for databases."""
+        config = {
+            "databases": {
+                "db1": {"dsn": "sqlite://"},
+                "db2": {
+                    "dsn": "sqlite://",
+                    "circuit-breaker": {"failures": 3, "max-backoff": 60},
+                },
+            },
+            "metrics": {},
+            "queries": {},
+        }
+        config_file = write_config(config)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert result.databases["db1"].circuit_breaker is None
+        breaker = result.databases["db2"].circuit_breaker
+        assert breaker.failures == 3
+        assert breaker.min_backoff == 1.0
+        assert breaker.max_backoff == 60
+
+    def test_load_databases_circuit_breaker_invalid_backoff(self, logger, write_config):
+        """An error is raised if circuit breaker backoff limits are invalid."""
+        config = {
+            "databases": {
+                "db": {
+                    "dsn": "sqlite://",
+                    "circuit-breaker": {"min-backoff": 60, "max-backoff": 10},
+                },
+            },
+            "metrics": {},
+            "queries": {},
+        }
+        config_file = write_config(config)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert (
+            str(err.value)
+            == "Circuit breaker min-backoff must not be greater than max-backoff"
+        )
+
+    def test_load_databases_backend(self, logger, write_config):
+        """The execution backend can be specified for databases."""
+        config = {
+            "databases": {
+                "db1": {"dsn": "sqlite://"},
+                "db2": {"dsn": "sqlite://", "backend": "executor"},
+            },
+            "metrics": {},
+            "queries": {},
+        }
+        config_file = write_config(config)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert result.databases["db1"].backend == "thread"
+        assert result.databases["db2"].backend == "executor"
 
     def test_load_databases_dsn_from_env(self, logger, write_config):
         """The database DSN can be loaded from env."""
@@ -305,6 +409,78 @@ class TestLoadConfig:
         assert result.metrics.get(DB_ERRORS_METRIC_NAME) is not None
         assert result.metrics.get(QUERIES_METRIC_NAME) is not None
 
+    def test_load_metrics_global_labels_not_shared(
+        self, logger, config_full, write_config
+    ):
+        """Labels for global metrics are not shared across loaded configs."""
+        config_full["databases"]["db"]["labels"] = {"region": "us1"}
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert result.metrics[QUERIES_METRIC_NAME].config["labels"] == [
+            "database",
+            "region",
+            "status",
+        ]
+        del config_full["databases"]["db"]["labels"]
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert result.metrics[QUERIES_METRIC_NAME].config["labels"] == [
+            "database",
+            "status",
+        ]
+
+    def test_load_metrics_label_filters(self, logger, config_full, write_config):
+        """Label filters for metrics are compiled and set for queries."""
+        config_full["metrics"]["m"]["label-filters"] = {
+            "l1": {"allow": "a.*"},
+            "l2": {"allow": "[0-9]+", "deny": "0"},
+        }
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        label_filters = result.metrics["m"].config["label-filters"]
+        assert label_filters == {
+            "l1": LabelFilter(allow=re.compile("a.*")),
+            "l2": LabelFilter(allow=re.compile("[0-9]+"), deny=re.compile("0")),
+        }
+        [query_metric] = result.queries["q"].metrics
+        assert query_metric.label_filters is label_filters
+
+    def test_load_metrics_label_filters_unknown_label(
+        self, logger, config_full, write_config
+    ):
+        """An error is raised if label filters reference unknown labels."""
+        config_full["metrics"]["m"]["label-filters"] = {"l3": {"allow": "a"}}
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == 'Filters for metric "m" reference unknown labels: l3'
+
+    def test_load_metrics_label_filters_invalid_regexp(
+        self, logger, config_full, write_config
+    ):
+        """An error is raised if label filters regexps are invalid."""
+        config_full["metrics"]["m"]["label-filters"] = {"l1": {"deny": "a("}}
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value).startswith(
+            'Invalid deny regexp for label "l1" of metric "m": '
+        )
+
+    @pytest.mark.parametrize("expiration,value", [(60, 60), ("2h", 7200)])
+    def test_load_metrics_expiration(
+        self, logger, config_full, write_config, expiration, value
+    ):
+        """Metric expirations are converted to seconds."""
+        config_full["metrics"]["m"]["expiration"] = expiration
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert result.metrics["m"].config["expiration"] == value
+
     def test_load_metrics_overlap_reserved_label(self, logger, write_config):
         """An error is raised if reserved labels are used."""
         config = {
@@ -443,6 +619,187 @@ class TestLoadConfig:
             "param2": 20,
         }
 
+    def test_load_queries_section_with_batch_parameters(self, logger, write_config):
+        """Query parameters sets can be batched in a single query."""
+        config = {
+            "databases": {"db": {"dsn": "sqlite://"}},
+            "metrics": {"m": {"type": "summary", "labels": ["l"]}},
+            "queries": {
+                "q": {
+                    "interval": 10,
+                    "databases": ["db"],
+                    "metrics": ["m"],
+                    "sql": "SELECT :param1 AS l, :param2 AS m",
+                    "parameters": [
+                        {"param1": "label1", "param2": 10},
+                        {"param1": "label2", "param2": 20},
+                    ],
+                    "batch-parameters": True,
+                },
+            },
+        }
+        config_file = write_config(config)
+        with config_file.open() as fd:
+            result = load_config(fd, logger)
+        assert list(result.queries) == ["q"]
+        query = result.queries["q"]
+        assert query.name == "q"
+        assert query.metrics == [QueryMetric("m", ["l"])]
+        assert query.parameters == {
+            "param1__batch0": "label1",
+            "param2__batch0": 10,
+            "param1__batch1": "label2",
+            "param2__batch1": 20,
+        }
+        assert query.batched
+
+    def test_load_queries_chunk_size(self, logger, config_full, write_config):
+        """Queries can have a chunk size for fetching results."""
+        config_full["queries"]["q"]["chunk-size"] = 1000
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].chunk_size == 1000
+
+    def test_load_queries_timeout(self, logger, config_full, write_config):
+        """Queries can have a timeout."""
+        config_full["queries"]["q"]["timeout"] = 1.5
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].timeout == 1.5
+
+    def test_load_queries_overlap(self, logger, config_full, write_config):
+        """Queries can have an overlap policy."""
+        config_full["queries"]["q"]["overlap"] = "skip"
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].overlap == "skip"
+
+    def test_load_queries_overlap_default(self, logger, config_full, write_config):
+        """Overlapping query executions are allowed by default."""
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].overlap == "allow"
+
+    def test_load_queries_schedule(self, logger, config_full, write_config):
+        """Queries can have a schedule instead of an interval."""
+        del config_full["queries"]["q"]["interval"]
+        config_full["queries"]["q"]["schedule"] = "0 3 * * *"
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        query = config.queries["q"]
+        assert query.schedule == "0 3 * * *"
+        assert query.interval is None
+        assert query.timed
+
+    def test_load_queries_schedule_and_interval(
+        self, logger, config_full, write_config
+    ):
+        """An error is raised if both schedule and interval are specified."""
+        config_full["queries"]["q"]["schedule"] = "every 5m"
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == (
+            'Invalid schedule for query "q": '
+            "schedule and interval can't be both specified"
+        )
+
+    def test_load_queries_invalid_schedule(self, logger, config_full, write_config):
+        """An error is raised if the schedule is invalid."""
+        del config_full["queries"]["q"]["interval"]
+        config_full["queries"]["q"]["schedule"] = "every day"
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == 'Invalid schedule for query "q": "every day"'
+
+    def test_load_queries_jitter(self, logger, config_full, write_config):
+        """Queries can have a jitter for periodic runs."""
+        config_full["queries"]["q"]["jitter"] = 2.5
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].jitter == 2.5
+
+    def test_load_queries_adaptive_interval(self, logger, config_full, write_config):
+        """Queries can have an adaptive interval."""
+        config_full["queries"]["q"]["adaptive-interval"] = {
+            "min-interval": 5,
+            "max-interval": "2m",
+            "cost-threshold": 0.2,
+        }
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].adaptive_interval == AdaptiveInterval(5, 120, 0.2)
+
+    def test_load_queries_adaptive_interval_defaults(
+        self, logger, config_full, write_config
+    ):
+        """The min interval defaults to the query interval."""
+        config_full["queries"]["q"]["adaptive-interval"] = {"max-interval": 60}
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].adaptive_interval == AdaptiveInterval(10, 60, 0.5)
+
+    def test_load_queries_adaptive_interval_no_interval(
+        self, logger, config_full, write_config
+    ):
+        """An error is raised if an adaptive interval is set without interval."""
+        config_full["queries"]["q"]["interval"] = None
+        config_full["queries"]["q"]["adaptive-interval"] = {"max-interval": 60}
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == (
+            'Invalid adaptive-interval for query "q": the query must have an interval'
+        )
+
+    @pytest.mark.parametrize("min_interval,max_interval", [(20, 60), (5, 8)])
+    def test_load_queries_adaptive_interval_out_of_bounds(
+        self, logger, config_full, write_config, min_interval, max_interval
+    ):
+        """An error is raised if the interval is not within bounds."""
+        config_full["queries"]["q"]["adaptive-interval"] = {
+            "min-interval": min_interval,
+            "max-interval": max_interval,
+        }
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == (
+            'Invalid adaptive-interval for query "q": '
+            "interval must be between min-interval and max-interval"
+        )
+
+    def test_load_queries_cache_ttl(self, logger, config_full, write_config):
+        """Queries without an interval can have a cache TTL."""
+        config_full["queries"]["q"]["interval"] = None
+        config_full["queries"]["q"]["cache-ttl"] = 30
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].cache_ttl == 30
+
+    def test_load_queries_cache_ttl_with_interval(
+        self, logger, config_full, write_config
+    ):
+        """An error is raised if a cache TTL is set for periodic queries."""
+        config_full["queries"]["q"]["cache-ttl"] = 30
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == (
+            'Invalid cache-ttl for query "q": '
+            "only queries without an interval can be cached"
+        )
+
     def test_load_queries_section_with_wrong_parameters(self, logger, write_config):
         """An error is raised if query parameters don't match."""
         config = {
@@ -610,3 +967,273 @@ class TestLoadConfig:
         assert (
             str(err.value) == "Invalid config at queries/q/databases: [] is too short"
         )
+
+    def test_load_sharded(self, logger, config_full, write_config):
+        """With a shard, only databases in the shard and their queries are loaded."""
+        dbnames = [f"db{index}" for index in range(20)]
+        config_full["databases"] = {name: {"dsn": "sqlite://"} for name in dbnames}
+        config_full["queries"]["q"]["databases"] = dbnames
+        config_full["queries"]["q2"] = {
+            "interval": 10,
+            "databases": ["db0"],
+            "metrics": ["m"],
+            "sql": "SELECT 1 as m",
+        }
+        config_file = write_config(config_full)
+        shard_dbs = []
+        for index in range(3):
+            with config_file.open() as fd:
+                config = load_config(fd, logger, shard=Shard(index, 3))
+            assert all(database_shard(name, 3) == index for name in config.databases)
+            assert config.queries["q"].databases == sorted(
+                config.databases, key=dbnames.index
+            )
+            assert ("q2" in config.queries) == ("db0" in config.databases)
+            shard_dbs.extend(config.databases)
+        assert sorted(shard_dbs) == sorted(dbnames)
+
+    def test_load_sharded_no_unused_warning(
+        self, caplog, logger, config_full, write_config
+    ):
+        """Databases and metrics used in other shards are not reported as unused."""
+        config_full["databases"]["db2"] = {"dsn": "sqlite://"}
+        config_full["queries"]["q"]["databases"] = ["db", "db2"]
+        config_file = write_config(config_full)
+        for index in range(2):
+            with config_file.open() as fd:
+                load_config(fd, logger, shard=Shard(index, 2))
+        assert caplog.messages == []
+
+    def test_load_database_templates(self, logger, config_full, write_config):
+        """Database templates define databases sharing the same settings."""
+        config_full["databases"]["db"]["labels"] = {"region": "eu", "env": "dev"}
+        config_full["database-templates"] = {
+            "tmpl": {
+                "settings": {
+                    "connect-sql": ["SELECT 1"],
+                    "pool-size": 3,
+                    "labels": {"region": "us", "env": "prod"},
+                },
+                "targets": [
+                    {"name": "t1", "dsn": "sqlite:///t1"},
+                    {"name": "t2", "dsn": "sqlite:///t2", "labels": {"region": "eu"}},
+                ],
+            }
+        }
+        config_full["queries"]["q"]["databases"] = ["db", "tmpl"]
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert list(config.databases) == ["db", "t1", "t2"]
+        t1, t2 = config.databases["t1"], config.databases["t2"]
+        assert t1.dsn == "sqlite:///t1"
+        assert t2.dsn == "sqlite:///t2"
+        assert t1.labels == {"region": "us", "env": "prod"}
+        assert t2.labels == {"region": "eu", "env": "prod"}
+        assert t1.pool_size == t2.pool_size == 3
+        assert t1.connect_sql == ["SELECT 1"]
+        assert t1.connect_sql is t2.connect_sql
+        assert config.queries["q"].databases == ["db", "t1", "t2"]
+
+    def test_load_database_templates_dsn_from_env(
+        self, logger, config_full, write_config
+    ):
+        config_full["database-templates"] = {
+            "tmpl": {"targets": [{"name": "t", "dsn": "env:FOO"}]}
+        }
+        config_full["queries"]["q"]["databases"] = ["tmpl"]
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger, env={"FOO": "sqlite://"})
+        assert config.databases["t"].dsn == "sqlite://"
+
+    def test_load_database_templates_query_duplicated_databases(
+        self, logger, config_full, write_config
+    ):
+        """Databases listed both directly and through a template are not repeated."""
+        config_full["database-templates"] = {
+            "tmpl": {
+                "targets": [
+                    {"name": "t1", "dsn": "sqlite://"},
+                    {"name": "t2", "dsn": "sqlite://"},
+                ]
+            }
+        }
+        config_full["queries"]["q"]["databases"] = ["t2", "tmpl", "db"]
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].databases == ["t2", "t1", "db"]
+
+    def test_load_database_templates_targets_from_env(
+        self, logger, config_full, write_config
+    ):
+        config_full["database-templates"] = {"tmpl": {"targets": "env:TARGETS"}}
+        config_full["queries"]["q"]["databases"] = ["tmpl"]
+        config_file = write_config(config_full)
+        env = {"TARGETS": '[{"name": "t1", "dsn": "sqlite://"}]'}
+        with config_file.open() as fd:
+            config = load_config(fd, logger, env=env)
+        assert config.queries["q"].databases == ["t1"]
+
+    def test_load_database_templates_targets_from_file(
+        self, tmpdir, logger, config_full, write_config
+    ):
+        targets_file = tmpdir / "targets.yaml"
+        targets_file.write_text(
+            yaml.dump([{"name": "t1", "dsn": "sqlite://"}]), "utf-8"
+        )
+        config_full["database-templates"] = {
+            "tmpl": {"targets": f"file:{targets_file}"}
+        }
+        config_full["queries"]["q"]["databases"] = ["tmpl"]
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].databases == ["t1"]
+
+    def test_load_database_templates_targets_from_file_relative(
+        self, tmpdir, monkeypatch, logger, config_full, write_config
+    ):
+        """Relative paths for target files are based on the config directory."""
+        (tmpdir / "targets.yaml").write_text(
+            yaml.dump([{"name": "t1", "dsn": "sqlite://"}]), "utf-8"
+        )
+        config_full["database-templates"] = {"tmpl": {"targets": "file:targets.yaml"}}
+        config_full["queries"]["q"]["databases"] = ["tmpl"]
+        config_file = write_config(config_full)
+        monkeypatch.chdir("/")
+        with config_file.open() as fd:
+            config = load_config(fd, logger)
+        assert config.queries["q"].databases == ["t1"]
+
+    def test_load_database_templates_targets_missing_file(
+        self, tmpdir, logger, config_full, write_config
+    ):
+        config_full["database-templates"] = {
+            "tmpl": {"targets": f"file:{tmpdir}/missing.yaml"}
+        }
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value).startswith(
+            'Invalid targets for database template "tmpl": '
+        )
+
+    def test_load_database_templates_targets_invalid(
+        self, logger, config_full, write_config
+    ):
+        config_full["database-templates"] = {"tmpl": {"targets": "env:TARGETS"}}
+        config_file = write_config(config_full)
+        env = {"TARGETS": '[{"name": "t1"}]'}
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger, env=env)
+        assert str(err.value) == (
+            'Invalid targets for database template "tmpl" at 0: '
+            "'dsn' is a required property"
+        )
+
+    def test_load_database_templates_settings_dsn(
+        self, logger, config_full, write_config
+    ):
+        config_full["database-templates"] = {
+            "tmpl": {
+                "settings": {"dsn": "sqlite://"},
+                "targets": [{"name": "t", "dsn": "sqlite://"}],
+            }
+        }
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == (
+            'Invalid settings for database template "tmpl": '
+            '"dsn" must be specified in targets'
+        )
+
+    @pytest.mark.parametrize(
+        "templates,error_message",
+        [
+            (
+                {"db": {"targets": [{"name": "t", "dsn": "sqlite://"}]}},
+                'Database template "db" has the same name as a database',
+            ),
+            (
+                {"tmpl": {"targets": [{"name": "db", "dsn": "sqlite://"}]}},
+                'Duplicated database name "db" in database template "tmpl"',
+            ),
+            (
+                {
+                    "tmpl1": {"targets": [{"name": "t", "dsn": "sqlite://"}]},
+                    "tmpl2": {"targets": [{"name": "t", "dsn": "sqlite://"}]},
+                },
+                'Duplicated database name "t" in database template "tmpl2"',
+            ),
+        ],
+    )
+    def test_load_database_templates_duplicated_names(
+        self, logger, config_full, write_config, templates, error_message
+    ):
+        config_full["database-templates"] = templates
+        config_file = write_config(config_full)
+        with pytest.raises(ConfigError) as err, config_file.open() as fd:
+            load_config(fd, logger)
+        assert str(err.value) == error_message
+
+    def test_load_database_templates_sharded(self, logger, config_full, write_config):
+        """Databases from templates are assigned to shards individually."""
+        dbnames = [f"t{index}" for index in range(20)]
+        config_full["database-templates"] = {
+            "tmpl": {
+                "targets": [{"name": name, "dsn": "sqlite://"} for name in dbnames]
+            }
+        }
+        config_full["queries"]["q"]["databases"] = ["tmpl"]
+        config_file = write_config(config_full)
+        shard_dbs = []
+        for index in range(2):
+            with config_file.open() as fd:
+                config = load_config(fd, logger, shard=Shard(index, 2))
+            if "q" in config.queries:
+                shard_dbs.extend(config.queries["q"].databases)
+        assert sorted(shard_dbs) == sorted(dbnames)
+
+    def test_load_database_templates_warning_unused(
+        self, caplog, logger, config_full, write_config
+    ):
+        """Templates are reported as unused if none of their databases is used."""
+        config_full["database-templates"] = {
+            "tmpl1": {"targets": [{"name": "t1", "dsn": "sqlite://"}]},
+            "tmpl2": {
+                "targets": [
+                    {"name": "t2", "dsn": "sqlite://"},
+                    {"name": "t3", "dsn": "sqlite://"},
+                ]
+            },
+        }
+        config_full["queries"]["q"]["databases"] = ["db", "t2"]
+        config_file = write_config(config_full)
+        with config_file.open() as fd:
+            load_config(fd, logger)
+        assert caplog.messages == ['unused entries in "databases" section: tmpl1']
+
+
+class TestDatabaseShard:
+    def test_shard_in_range(self):
+        """The shard index is between 0 and the number of shards."""
+        assert {database_shard(f"db{index}", 4) for index in range(100)} == {
+            0,
+            1,
+            2,
+            3,
+        }
+
+    def test_single_shard(self):
+        """With a single shard, all databases are in it."""
+        assert database_shard("db", 1) == 0
+
+    def test_minimal_rebalance(self):
+        """When adding a shard, databases only move to the new one."""
+        for index in range(100):
+            name = f"db{index}"
+            shard = database_shard(name, 5)
+            assert shard in (database_shard(name, 4), 4)
@@ -1,24 +1,62 @@
 import asyncio
+from collections import Counter
+from datetime import (
+    datetime,
+    timezone,
+)
+from decimal import Decimal
 import logging
+import pickle
+import re
+import time
 
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import (
+    postgresql,
+    sqlite,
+)
 from sqlalchemy_aio import ASYNCIO_STRATEGY
 from sqlalchemy_aio.base import AsyncConnection
 
 import pytest
 
 from ..db import (
+    AdaptiveInterval,
+    batch_query_sql,
+    CircuitBreaker,
     DataBase,
     DataBaseError,
+    DataBaseUnavailable,
+    ExecutorBackend,
+    ExecutorConnection,
+    InvalidBatchResults,
     InvalidQueryParameters,
     InvalidResultColumnNames,
     InvalidResultCount,
+    LabelFilter,
+    load_dialect,
     MetricResult,
+    MetricResults,
+    PoolStatus,
     Query,
     QueryMetric,
     QueryResults,
+    QueryTimeoutExpired,
+    ThreadBackend,
 )
 
+# a query running until interrupted
+SLOW_SQL = """
+WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)
+SELECT COUNT(*) AS metric FROM c
+"""
+
+
+async def wait_closed(conn):
+    """Wait until a connection closed in background is closed."""
+    while not conn.closed:
+        await asyncio.sleep(0.01)
+
 
 class TestInvalidResultCount:
     def test_message(self):
@@ -27,7 +65,89 @@ class TestInvalidResultCount:
         assert str(error) == "Wrong result count from query: expected 1, got 2"
 
 
+class TestQueryTimeoutExpired:
+    def test_message(self):
+        """The error message contains the query name and timeout."""
+        error = QueryTimeoutExpired("myquery", 10)
+        assert str(error) == 'Execution for query "myquery" expired after 10 seconds'
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        DataBaseError("failed", fatal=True),
+        DataBaseUnavailable(10.0),
+        InvalidResultCount(1, 2),
+        InvalidResultColumnNames(),
+        InvalidBatchResults("metric", 0, 1),
+        QueryTimeoutExpired("myquery", 10),
+        InvalidQueryParameters("myquery"),
+    ],
+)
+def test_errors_pickle(error):
+    """Errors can be pickled, preserving their details."""
+    unpickled = pickle.loads(pickle.dumps(error))
+    assert type(unpickled) is type(error)
+    assert str(unpickled) == str(error)
+    assert vars(unpickled) == vars(error)
+
+
+class TestBatchQuerySQL:
+    def test_batch(self):
+        """Parameter sets are combined in a single query."""
+        sql, parameters = batch_query_sql(
+            "SELECT :a AS l, :b AS m;", [{"a": 1, "b": 2}, {"a": 3, "b": 4}]
+        )
+        assert sql == (
+            "SELECT batch0.*, 0 AS batch_index "
+            "FROM (SELECT :a__batch0 AS l, :b__batch0 AS m) batch0\n"
+            "UNION ALL\n"
+            "SELECT batch1.*, 1 AS batch_index "
+            "FROM (SELECT :a__batch1 AS l, :b__batch1 AS m) batch1"
+        )
+        assert parameters == {
+            "a__batch0": 1,
+            "b__batch0": 2,
+            "a__batch1": 3,
+            "b__batch1": 4,
+        }
+
+    def test_batch_escaped_colon(self):
+        """Escaped colons and colons inside words are not parameters."""
+        sql, _ = batch_query_sql(r"SELECT :a AS m, '\:b' AS l, 'x:y' AS n", [{"a": 1}])
+        assert sql == (
+            "SELECT batch0.*, 0 AS batch_index "
+            r"FROM (SELECT :a__batch0 AS m, '\:b' AS l, 'x:y' AS n) batch0"
+        )
+
+
 class TestQuery:
+    def test_pickle(self):
+        """Queries can be pickled, only preserving their definition."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("metric", ["label"])],
+            "SELECT :param AS metric, 'foo' AS label",
+            parameters={"param": 1},
+            chunk_size=10,
+            adaptive_interval=AdaptiveInterval(10, 60),
+        )
+        query.compiled_statement(sqlite.dialect())
+        unpickled = pickle.loads(pickle.dumps(query))
+        assert unpickled.__getstate__() == query.__getstate__()
+        assert len(unpickled._compiled_statements) == 0
+        assert unpickled.compiled_cache_misses == 0
+
+    def test_same_definition(self):
+        """Queries with the same definition are recognized."""
+        query1 = Query("query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1")
+        query2 = Query("query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1")
+        query3 = Query("query", 30, ["db"], [QueryMetric("metric", [])], "SELECT 1")
+        assert query1.same_definition(query2)
+        assert not query1.same_definition(query3)
+
     def test_instantiate(self):
         """A query can be instantiated with the specified arguments."""
         query = Query(
@@ -49,6 +169,21 @@ class TestQuery:
         ]
         assert query.sql == "SELECT 1"
         assert query.parameters == {}
+        assert query.timeout is None
+
+    def test_instantiate_with_chunk_size(self):
+        """A query can be instantiated with a chunk size."""
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1", chunk_size=10
+        )
+        assert query.chunk_size == 10
+
+    def test_instantiate_with_timeout(self):
+        """A query can be instantiated with a timeout."""
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1", timeout=2.5
+        )
+        assert query.timeout == 2.5
 
     def test_instantiate_with_parameters(self):
         """A query can be instantiated with parameters."""
@@ -96,6 +231,50 @@ class TestQuery:
         )
         assert query.labels() == frozenset(["label1", "label2"])
 
+    def test_compiled_statement_cached(self):
+        """Compiled statements are cached by dialect."""
+        query = Query("query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1")
+        dialect = sqlite.dialect()
+        compiled = query.compiled_statement(dialect)
+        assert str(compiled) == "SELECT 1"
+        assert query.compiled_statement(dialect) is compiled
+        assert query.compiled_cache_hits == 1
+        assert query.compiled_cache_misses == 1
+
+    def test_compiled_statement_per_dialect(self):
+        """Statements are compiled separately for each dialect."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("metric", [])],
+            "SELECT :param",
+            parameters={"param": 1},
+        )
+        sqlite_compiled = query.compiled_statement(sqlite.dialect())
+        postgresql_compiled = query.compiled_statement(postgresql.dialect())
+        assert str(sqlite_compiled) == "SELECT ?"
+        assert str(postgresql_compiled) == "SELECT %(param)s"
+        assert query.compiled_cache_hits == 0
+        assert query.compiled_cache_misses == 2
+
+    def test_compiled_statement_per_dialect_instance(self):
+        """Statements are compiled separately for each dialect instance."""
+        query = Query("query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1")
+        compiled1 = query.compiled_statement(sqlite.dialect())
+        dialect = sqlite.dialect()
+        compiled2 = query.compiled_statement(dialect)
+        assert compiled2 is not compiled1
+        assert compiled2.dialect is dialect
+
+    def test_compiled_statement_stream_results(self):
+        """Compiled statements for chunked queries use streamed results."""
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1", chunk_size=10
+        )
+        compiled = query.compiled_statement(sqlite.dialect())
+        assert compiled.execution_options["stream_results"]
+
     def test_results_empty(self):
         """No error is raised if the result set is empty"""
         query = Query("query", 20, ["db"], [QueryMetric("metric", [])], "")
@@ -163,6 +342,92 @@ class TestQuery:
         with pytest.raises(InvalidResultColumnNames):
             query.results(query_results)
 
+    def test_results_convert_values(self):
+        """Metric values are converted to numbers where needed."""
+        query = Query("query", 20, ["db"], [QueryMetric("metric", [])], "")
+        query_results = QueryResults(
+            ["metric"],
+            [
+                (Decimal("100.123"),),
+                (None,),
+                (True,),
+                (datetime(2020, 1, 1, tzinfo=timezone.utc),),
+                (10,),
+                ("state",),
+            ],
+        )
+        results = query.results(query_results)
+        assert [result.value for result in results] == [
+            100.123,
+            0.0,
+            1.0,
+            1577836800.0,
+            10,
+            "state",
+        ]
+        assert isinstance(results[0].value, float)
+
+    def test_results_mapper_reused(self):
+        """The results mapper is reused while result keys don't change."""
+        query = Query("query", 20, ["db"], [QueryMetric("metric", ["label"])], "")
+        query.results(QueryResults(["metric", "label"], [(1, "foo")]))
+        mapper = query._mapper
+        query.results(QueryResults(["metric", "label"], [(2, "bar")]))
+        assert query._mapper is mapper
+        assert query.results(QueryResults(["label", "metric"], [("baz", 3)])) == [
+            MetricResult("metric", 3, {"label": "baz"})
+        ]
+        assert query._mapper is not mapper
+
+    def test_results_label_filters(self):
+        """Rows with label values not passing filters are dropped."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [
+                QueryMetric(
+                    "metric1",
+                    ["label"],
+                    label_filters={"label": LabelFilter(deny=re.compile("b.*"))},
+                ),
+                QueryMetric("metric2", ["label"]),
+            ],
+            "",
+        )
+        query_results = QueryResults(
+            ["metric1", "metric2", "label"], [(1, 2, "foo"), (3, 4, "bar")]
+        )
+        filtered = Counter()
+        assert query.results(query_results, filtered=filtered) == [
+            MetricResult("metric1", 1, {"label": "foo"}),
+            MetricResult("metric2", 2, {"label": "foo"}),
+            MetricResult("metric2", 4, {"label": "bar"}),
+        ]
+        assert filtered == {"metric1": 1}
+
+
+class TestLabelFilter:
+    @pytest.mark.parametrize(
+        "allow,deny,value,match",
+        [
+            (None, None, "foo", True),
+            ("fo+", None, "foo", True),
+            ("fo+", None, "foobar", False),
+            (None, "bar", "bar", False),
+            (None, "bar", "foobar", True),
+            ("[a-z]+", "bar", "bar", False),
+            ("[0-9]+", None, 123, True),
+        ],
+    )
+    def test_match(self, allow, deny, value, match):
+        """Values must match the allow regexp and not the deny one."""
+        label_filter = LabelFilter(
+            allow=re.compile(allow) if allow else None,
+            deny=re.compile(deny) if deny else None,
+        )
+        assert label_filter.match(value) == match
+
 
 class TestQueryResults:
     @pytest.mark.asyncio
@@ -175,6 +440,23 @@ class TestQueryResults:
         assert query_results.keys == ["a", "b"]
         assert query_results.rows == [(1, 2)]
 
+    @pytest.mark.asyncio
+    async def test_from_results_chunks(self):
+        """The from_results_chunks method yields QueryResults in chunks."""
+        engine = create_engine("sqlite://", strategy=ASYNCIO_STRATEGY)
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                "SELECT 1 AS a UNION SELECT 2 UNION SELECT 3 ORDER BY a"
+            )
+            chunks = [
+                query_results
+                async for query_results in QueryResults.from_results_chunks(result, 2)
+            ]
+        assert chunks == [
+            QueryResults(["a"], [(1,), (2,)]),
+            QueryResults(["a"], [(3,)]),
+        ]
+
 
 @pytest.fixture
 async def db():
@@ -183,7 +465,96 @@ async def db():
     await db.close()
 
 
+class TestCircuitBreaker:
+    def test_closed(self):
+        """Attempts are allowed when the breaker is closed."""
+        breaker = CircuitBreaker()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow_attempt()
+        assert breaker.retry_in() == 0.0
+
+    def test_open_after_failures(self):
+        """The breaker opens after consecutive failures."""
+        breaker = CircuitBreaker(failures=2, min_backoff=10, max_backoff=20)
+        assert not breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow_attempt()
+        assert 5.0 <= breaker.retry_in() <= 10.0
+
+    def test_success_resets_failures(self):
+        """A successful attempt resets the failures count."""
+        breaker = CircuitBreaker(failures=2)
+        breaker.record_failure()
+        breaker.record_success()
+        assert not breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open(self):
+        """After the backoff time, a single attempt is allowed."""
+        breaker = CircuitBreaker(failures=1)
+        breaker.record_failure()
+        breaker.retry_at = time.time()
+        assert breaker.allow_attempt()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow_attempt()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.retry_at is None
+
+    def test_half_open_retry_in(self):
+        """While half-open, refused attempts retry after min_backoff."""
+        breaker = CircuitBreaker(failures=1, min_backoff=10)
+        breaker.record_failure()
+        breaker.retry_at = time.time()
+        assert breaker.allow_attempt()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow_attempt()
+        assert 9.0 < breaker.retry_in() <= 10.0
+        assert breaker.retry_at > time.time()
+
+    def test_half_open_failure_doubles_backoff(self, mocker):
+        """A failed attempt when half-open doubles the backoff time."""
+        mocker.patch("query_exporter.db.random.uniform", lambda low, high: high)
+        breaker = CircuitBreaker(failures=1, min_backoff=10, max_backoff=30)
+        backoffs = []
+        for _ in range(4):
+            breaker.record_failure()
+            backoffs.append(round(breaker.retry_in()))
+            breaker.retry_at = time.time()
+            assert breaker.allow_attempt()
+        assert backoffs == [10, 20, 30, 30]
+
+
 class TestDataBase:
+    def test_pickle(self):
+        """DataBases can be pickled, only preserving their definition."""
+        db = DataBase(
+            "db",
+            "sqlite://",
+            labels={"l": "v"},
+            pool_size=2,
+            circuit_breaker=CircuitBreaker(failures=3),
+        )
+        unpickled = pickle.loads(pickle.dumps(db))
+        state = unpickled.__getstate__()
+        assert state.pop("circuit_breaker").failures == 3
+        expected_state = db.__getstate__()
+        del expected_state["circuit_breaker"]
+        assert state == expected_state
+        assert not unpickled.connected
+
+    def test_same_definition(self):
+        """DataBases with the same definition are recognized."""
+        db1 = DataBase("db", "sqlite://", circuit_breaker=CircuitBreaker(failures=3))
+        db2 = DataBase("db", "sqlite://", circuit_breaker=CircuitBreaker(failures=3))
+        db3 = DataBase("db", "sqlite://", circuit_breaker=CircuitBreaker(failures=4))
+        db4 = DataBase("db", "sqlite://")
+        assert db1.same_definition(db2)
+        assert not db1.same_definition(db3)
+        assert not db1.same_definition(db4)
+
     def test_instantiate(self):
         """A DataBase can be instantiated with the specified arguments."""
         db = DataBase("db", "sqlite:///foo")
@@ -191,6 +562,18 @@ class TestDataBase:
         assert db.dsn == "sqlite:///foo"
         assert db.keep_connected
         assert db.labels == {}
+        assert db.pool_size == 1
+        assert db.max_overflow == 0
+        assert db.pool_timeout is None
+
+    def test_instantiate_pool_options(self):
+        """Connection pool options can be passed to a database."""
+        db = DataBase(
+            "db", "sqlite:///foo", pool_size=3, max_overflow=2, pool_timeout=1.5
+        )
+        assert db.pool_size == 3
+        assert db.max_overflow == 2
+        assert db.pool_timeout == 1.5
 
     def test_instantiate_no_keep_connected(self):
         """keep_connected can be set to false."""
@@ -202,6 +585,41 @@ class TestDataBase:
         db = DataBase("db", "sqlite:///foo", labels={"l1": "v1", "l2": "v2"})
         assert db.labels == {"l1": "v1", "l2": "v2"}
 
+    def test_instantiate_default_backend(self):
+        """The thread backend is used by default."""
+        db = DataBase("db", "sqlite:///foo")
+        assert db.backend == "thread"
+        assert isinstance(db._backend, ThreadBackend)
+
+    def test_instantiate_lazy_engine(self):
+        """The engine is not created until the backend is used."""
+        db = DataBase("db", "sqlite:///foo")
+        assert db._backend_instance is None
+        assert db._backend.engine is db._backend.engine
+        assert db._backend_instance is not None
+
+    def test_load_dialect_cached(self):
+        """Dialects are loaded once for each driver."""
+        load_dialect.cache_clear()
+        DataBase("db1", "sqlite:///foo")
+        DataBase("db2", "sqlite:///bar")
+        info = load_dialect.cache_info()
+        assert info.misses == 1
+        assert info.hits == 1
+
+    def test_instantiate_executor_backend(self):
+        """The executor backend can be used."""
+        db = DataBase("db", "sqlite:///foo", backend="executor")
+        assert db.backend == "executor"
+        assert isinstance(db._backend, ExecutorBackend)
+
+    def test_instantiate_unknown_backend(self, caplog):
+        """An error is raised if the backend is unknown."""
+        with caplog.at_level(logging.ERROR), pytest.raises(DataBaseError) as error:
+            DataBase("db", "sqlite:///foo", backend="unknown")
+        assert str(error.value) == 'Unknown backend: "unknown"'
+        assert error.value.fatal
+
     def test_instantiate_missing_engine_module(self, caplog):
         """An error is raised if a module for the engine is missing."""
         with caplog.at_level(logging.ERROR):
@@ -237,9 +655,28 @@ class TestDataBase:
         """The connect connects to the database."""
         with caplog.at_level(logging.DEBUG):
             await db.connect()
-        assert isinstance(db._conn, AsyncConnection)
+        [conn] = db._conns
+        assert isinstance(conn, AsyncConnection)
+        assert db.pool_status() == PoolStatus(used=0, idle=1)
         assert caplog.messages == ['connected to database "db"']
 
+    @pytest.mark.asyncio
+    async def test_connect_executor_backend(self):
+        """With the executor backend, connections use the shared executor."""
+        db = DataBase("db", "sqlite://", backend="executor")
+        await db.connect()
+        [conn] = db._conns
+        assert isinstance(conn, ExecutorConnection)
+        assert conn._executor is ExecutorBackend.executor()
+        await db.close()
+        assert conn.closed
+
+    def test_executor_backend_max_threads(self, mocker):
+        """The size of the shared executor can be configured."""
+        mocker.patch.object(ExecutorBackend, "_executor", None)
+        mocker.patch.object(ExecutorBackend, "max_threads", 3)
+        assert ExecutorBackend.executor()._max_workers == 3
+
     @pytest.mark.asyncio
     async def test_connect_lock(self, caplog, db):
         """The connect method has a lock to prevent concurrent calls."""
@@ -255,6 +692,94 @@ class TestDataBase:
             await db.connect()
         assert "unable to open database file" in str(error.value)
 
+    @pytest.mark.asyncio
+    async def test_connect_circuit_breaker(self, mocker, caplog):
+        """Connections are not attempted while the circuit breaker is open."""
+        db = DataBase("db", "sqlite://", circuit_breaker=CircuitBreaker(failures=2))
+        mock_connect = mocker.patch.object(
+            db._backend, "connect", side_effect=Exception("connection refused")
+        )
+        with caplog.at_level(logging.WARNING):
+            for _ in range(2):
+                with pytest.raises(DataBaseError):
+                    await db.connect()
+            with pytest.raises(DataBaseUnavailable):
+                await db.connect()
+        assert mock_connect.call_count == 2
+        [message] = [
+            message for message in caplog.messages if "circuit breaker" in message
+        ]
+        assert message.startswith('circuit breaker open for database "db"')
+
+    @pytest.mark.asyncio
+    async def test_connect_timeout(self, mocker, caplog):
+        """Connections not established within the timeout are closed later."""
+        db = DataBase("db", "sqlite://", circuit_breaker=CircuitBreaker(failures=1))
+        backend_connect = db._backend.connect
+        release = asyncio.Event()
+        conns = []
+
+        async def connect():
+            await release.wait()
+            conn = await backend_connect()
+            conns.append(conn)
+            return conn
+
+        mocker.patch.object(db._backend, "connect", connect)
+        with pytest.raises(DataBaseError) as error:
+            await db.connect(timeout=0.01)
+        assert str(error.value) == "timeout connecting after 0.01 seconds"
+        assert 'error from database "db": timeout connecting after 0.01 seconds' in (
+            caplog.messages
+        )
+        # the failure is recorded by the circuit breaker
+        assert db.circuit_breaker.state == CircuitBreaker.OPEN
+        assert not db.connected
+        # the connection is closed when it completes, and closing the
+        # database waits for it
+        release.set()
+        await db.close()
+        [conn] = conns
+        assert conn.closed
+        assert not db.connected
+
+    @pytest.mark.asyncio
+    async def test_connect_cancelled(self, mocker):
+        """Connections completing after the attempt is cancelled are closed."""
+        db = DataBase("db", "sqlite://")
+        backend_connect = db._backend.connect
+        release = asyncio.Event()
+        conns = []
+
+        async def connect():
+            await release.wait()
+            conn = await backend_connect()
+            conns.append(conn)
+            return conn
+
+        mocker.patch.object(db._backend, "connect", connect)
+        task = asyncio.ensure_future(db.connect())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        release.set()
+        await db.close()
+        [conn] = conns
+        assert conn.closed
+        assert not db.connected
+
+    @pytest.mark.asyncio
+    async def test_connect_circuit_breaker_retry(self):
+        """The circuit breaker closes when a connection attempt succeeds."""
+        breaker = CircuitBreaker(failures=1)
+        breaker.record_failure()
+        breaker.retry_at = time.time()
+        db = DataBase("db", "sqlite://", circuit_breaker=breaker)
+        await db.connect()
+        assert breaker.state == CircuitBreaker.CLOSED
+        await db.close()
+
     @pytest.mark.asyncio
     async def test_connect_sql(self):
         """If connect_sql is specified, it's run at connection."""
@@ -262,14 +787,40 @@ class TestDataBase:
 
         queries = []
 
-        async def execute_sql(sql):
+        async def execute_sql(conn, sql):
             queries.append(sql)
 
-        db.execute_sql = execute_sql
+        db._execute_sql = execute_sql
         await db.connect()
         assert queries == ["SELECT 1", "SELECT 2"]
         await db.close()
 
+    @pytest.mark.parametrize("backend", ["thread", "executor"])
+    @pytest.mark.asyncio
+    async def test_connect_sql_every_pool_connection(self, backend):
+        """Connect SQL is run on each new connection in the pool."""
+        db = DataBase(
+            "db",
+            "sqlite://",
+            connect_sql=["PRAGMA user_version = 42"],
+            pool_size=2,
+            backend=backend,
+        )
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("user_version", [])],
+            "PRAGMA user_version",
+        )
+        await db.connect()
+        results = await asyncio.gather(db.execute(query), db.execute(query))
+        assert len(db._conns) == 2
+        assert [result.results for result in results] == [
+            [MetricResult("user_version", 42, {})]
+        ] * 2
+        await db.close()
+
     @pytest.mark.asyncio
     async def test_connect_sql_fail(self, caplog):
         """If the SQL at connection fails, an error is raised."""
@@ -284,12 +835,13 @@ class TestDataBase:
     async def test_close(self, caplog, db):
         """The close method closes database connection."""
         await db.connect()
-        connection = db._conn
+        [connection] = db._conns
         with caplog.at_level(logging.DEBUG):
             await db.close()
         assert caplog.messages == ['disconnected from database "db"']
         assert connection.closed
-        assert db._conn is None
+        assert db._conns == []
+        assert db.pool_status() == PoolStatus(used=0, idle=0)
 
     @pytest.mark.asyncio
     async def test_execute_log(self, caplog):
@@ -338,13 +890,16 @@ class TestDataBase:
             "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
         )
         result = await db.execute(query)
-        assert result == [MetricResult("metric", 1, {})]
+        assert result.results == [MetricResult("metric", 1, {})]
         # the connection is kept for reuse
-        assert not db._conn.closed
+        [conn] = db._idle_conns
+        assert not conn.closed
 
+    @pytest.mark.parametrize("backend", ["thread", "executor"])
     @pytest.mark.asyncio
-    async def test_execute(self, db):
+    async def test_execute(self, backend):
         """The execute method executes a query."""
+        db = DataBase("db", "sqlite://", backend=backend)
         sql = (
             "SELECT * FROM (SELECT 10 AS metric1, 20 AS metric2 UNION"
             " SELECT 30 AS metric1, 40 AS metric2)"
@@ -358,12 +913,13 @@ class TestDataBase:
         )
         await db.connect()
         result = await db.execute(query)
-        assert result == [
+        assert result.results == [
             MetricResult("metric1", 10, {}),
             MetricResult("metric2", 20, {}),
             MetricResult("metric1", 30, {}),
             MetricResult("metric2", 40, {}),
         ]
+        await db.close()
 
     @pytest.mark.asyncio
     async def test_execute_with_labels(self, db):
@@ -389,13 +945,269 @@ class TestDataBase:
         )
         await db.connect()
         result = await db.execute(query)
-        assert result == [
+        assert result.results == [
             MetricResult("metric1", 22, {"label1": "bar", "label2": "foo"}),
             MetricResult("metric2", 11, {"label2": "foo"}),
             MetricResult("metric1", 44, {"label1": "bza", "label2": "baz"}),
             MetricResult("metric2", 33, {"label2": "baz"}),
         ]
 
+    @pytest.mark.asyncio
+    async def test_execute_handler(self, db):
+        """If a handler is passed, results are passed to it."""
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        handled = []
+        result = await db.execute(query, handler=handled.append)
+        assert handled == [[MetricResult("metric", 1, {})]]
+        assert result.results == []
+
+    @pytest.mark.asyncio
+    async def test_execute_reuses_compiled_statement(self, mocker, db):
+        """The compiled statement is reused across executions."""
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        compile_spy = mocker.patch.object(
+            query.statement, "compile", wraps=query.statement.compile
+        )
+        result = await db.execute(query)
+        assert not result.stats.statement_cached
+        result = await db.execute(query)
+        assert result.results == [MetricResult("metric", 1, {})]
+        assert result.stats.statement_cached
+        compile_spy.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_execute_batch_parameters(self, db):
+        """A batched query returns results for all parameters sets."""
+        sql, parameters = batch_query_sql(
+            "SELECT :l AS l, :m AS m", [{"l": "a", "m": 1}, {"l": "b", "m": 2}]
+        )
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("m", ["l"])],
+            sql,
+            parameters=parameters,
+            batched=True,
+        )
+        result = await db.execute(query)
+        assert result.results == [
+            MetricResult("m", 1, {"l": "a"}),
+            MetricResult("m", 2, {"l": "b"}),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_execute_batch_parameters_same_labels(self, db):
+        """Batched queries fail if parameters sets return the same labels."""
+        sql, parameters = batch_query_sql(
+            "SELECT 'a' AS l, :m AS m", [{"m": 1}, {"m": 2}]
+        )
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("m", ["l"])],
+            sql,
+            parameters=parameters,
+            batched=True,
+        )
+        with pytest.raises(DataBaseError) as error:
+            await db.execute(query)
+        assert str(error.value) == (
+            'Same labels for metric "m" from parameters sets 0 and 1'
+        )
+        assert error.value.fatal
+
+    @pytest.mark.asyncio
+    async def test_execute_batch_parameters_same_labels_chunks(self, db):
+        """Labels from parameters sets are checked across chunks."""
+        sql, parameters = batch_query_sql(
+            "SELECT 'a' AS l, :m AS m", [{"m": 1}, {"m": 2}]
+        )
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("m", ["l"])],
+            sql,
+            parameters=parameters,
+            chunk_size=1,
+            batched=True,
+        )
+        with pytest.raises(DataBaseError) as error:
+            await db.execute(query)
+        assert "from parameters sets 0 and 1" in str(error.value)
+
+    @pytest.mark.asyncio
+    async def test_execute_chunk_size(self, db):
+        """With a chunk size, results are processed in chunks."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("metric", [])],
+            "SELECT 1 AS metric UNION SELECT 2 UNION SELECT 3 ORDER BY metric",
+            chunk_size=2,
+        )
+        handled = []
+        await db.execute(query, handler=handled.append)
+        assert handled == [
+            [MetricResult("metric", 1, {}), MetricResult("metric", 2, {})],
+            [MetricResult("metric", 3, {})],
+        ]
+
+    @pytest.mark.asyncio
+    async def test_execute_chunk_size_no_handler(self, db):
+        """With a chunk size and no handler, all results are returned."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("metric", [])],
+            "SELECT 1 AS metric UNION SELECT 2 UNION SELECT 3 ORDER BY metric",
+            chunk_size=2,
+        )
+        result = await db.execute(query)
+        assert result.results == [
+            MetricResult("metric", 1, {}),
+            MetricResult("metric", 2, {}),
+            MetricResult("metric", 3, {}),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_execute_chunk_size_invalid_names(self, db):
+        """Errors processing a chunk fail the query."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("metric", [])],
+            "SELECT 1 AS foo UNION SELECT 2 UNION SELECT 3",
+            chunk_size=2,
+        )
+        with pytest.raises(DataBaseError) as error:
+            await db.execute(query)
+        assert str(error.value) == "Wrong column names from query"
+        assert error.value.fatal
+        # the connection is still usable
+        result = await db.execute_sql("SELECT 10")
+        assert await result.fetchall() == [(10,)]
+
+    @pytest.mark.parametrize("backend", ["thread", "executor"])
+    @pytest.mark.asyncio
+    async def test_execute_timeout(self, caplog, backend):
+        """If the query times out, it's cancelled and the connection dropped."""
+        db = DataBase("db", "sqlite://", backend=backend)
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], SLOW_SQL, timeout=0.1
+        )
+        await db.connect()
+        [conn] = db._conns
+        with caplog.at_level(logging.ERROR):
+            with pytest.raises(QueryTimeoutExpired):
+                await db.execute(query)
+        await wait_closed(conn)
+        assert caplog.messages == [
+            'query "query" on database "db" failed: '
+            'Execution for query "query" expired after 0.1 seconds'
+        ]
+        assert db.pool_status() == PoolStatus(used=0, idle=0)
+        # a new connection is used for following queries
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        result = await db.execute(query)
+        assert result.results == [MetricResult("metric", 1, {})]
+        await db.close()
+
+    @pytest.mark.parametrize("backend", ["thread", "executor"])
+    @pytest.mark.asyncio
+    async def test_execute_cancelled(self, backend):
+        """If the execution is cancelled, the query is cancelled too."""
+        db = DataBase("db", "sqlite://", backend=backend)
+        query = Query("query", 20, ["db"], [QueryMetric("metric", [])], SLOW_SQL)
+        await db.connect()
+        [conn] = db._conns
+        task = asyncio.ensure_future(db.execute(query))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await wait_closed(conn)
+        # the busy connection is not returned to the pool
+        assert db.pool_status() == PoolStatus(used=0, idle=0)
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        result = await asyncio.wait_for(db.execute(query), 5)
+        assert result.results == [MetricResult("metric", 1, {})]
+        await db.close()
+
+    @pytest.mark.asyncio
+    async def test_execute_timeout_database_default(self):
+        """The database query timeout is used if the query has none."""
+        db = DataBase("db", "sqlite://", query_timeout=0.1)
+        query = Query("query", 20, ["db"], [QueryMetric("metric", [])], SLOW_SQL)
+        await db.connect()
+        [conn] = db._conns
+        with pytest.raises(QueryTimeoutExpired) as error:
+            await db.execute(query)
+        assert "expired after 0.1 seconds" in str(error.value)
+        await wait_closed(conn)
+
+    @pytest.mark.asyncio
+    async def test_execute_timeout_cancel_failure(self, caplog, mocker):
+        """A failure cancelling a query is logged."""
+        db = DataBase("db", "sqlite://")
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], SLOW_SQL, timeout=0.1
+        )
+        mocker.patch.dict(
+            "query_exporter.db._QUERY_CANCEL_METHODS", {"sqlite": "unknown"}
+        )
+        await db.connect()
+        [conn] = db._conns
+        with caplog.at_level(logging.WARNING):
+            with pytest.raises(QueryTimeoutExpired):
+                await db.execute(query)
+        assert 'failed cancelling query on database "db"' in caplog.text
+        # stop the query
+        conn.sync_connection.connection.connection.interrupt()
+        await wait_closed(conn)
+
+    @pytest.mark.parametrize("thread_id_method", [True, False])
+    @pytest.mark.asyncio
+    async def test_cancel_query_mysql(self, mocker, thread_id_method):
+        """MySQL queries are killed from a separate connection."""
+        db = DataBase("db", "sqlite://")
+        calls = []
+
+        class FakeConnection:
+            async def execute(self, statement):
+                calls.append(str(statement))
+
+            async def close(self):
+                calls.append("close")
+
+        async def connect():
+            return FakeConnection()
+
+        mocker.patch.object(db._backend, "connect", connect)
+        if thread_id_method:
+            dbapi_conn = mocker.Mock(spec=["thread_id"])
+            dbapi_conn.thread_id.return_value = 42
+        else:
+            dbapi_conn = mocker.Mock(spec=["connection_id"], connection_id=42)
+        conn = mocker.MagicMock()
+        conn.dialect.name = "mysql"
+        conn.sync_connection.connection.connection = dbapi_conn
+        await db._cancel_query(conn)
+        assert calls == ["KILL QUERY 42", "close"]
+
     @pytest.mark.asyncio
     async def test_execute_query_invalid_count(self, caplog, db):
         """If the number of fields don't match, an error is raised."""
@@ -449,6 +1261,149 @@ class TestDataBase:
         assert str(error.value) == "Wrong column names from query"
         assert error.value.fatal
 
+    @pytest.mark.asyncio
+    async def test_execute_pool_wait(self):
+        """Time spent waiting for a connection from the pool is reported."""
+        db = DataBase("db", "sqlite://")
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        result = await db.execute(query)
+        assert isinstance(result, MetricResults)
+        assert result.pool_wait >= 0
+        await db.close()
+
+    @pytest.mark.asyncio
+    async def test_execute_stats(self, db):
+        """Statistics for the query execution are reported."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("m1", []), QueryMetric("m2", [])],
+            "SELECT 1 AS m1, 2 AS m2 UNION SELECT 3, 4",
+        )
+        result = await db.execute(query)
+        stats = result.stats
+        assert stats.rows == 2
+        assert stats.series == 4
+        assert stats.process_time >= 0
+        assert stats.fetch_time >= 0
+        assert stats.latency >= stats.process_time
+
+    @pytest.mark.asyncio
+    async def test_execute_stats_filtered(self, db):
+        """Rows dropped by label filters are counted in stats."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [
+                QueryMetric(
+                    "m", ["l"], label_filters={"l": LabelFilter(allow=re.compile("a"))},
+                )
+            ],
+            "SELECT 1 AS m, 'a' AS l UNION SELECT 2, 'b' UNION SELECT 3, 'c'",
+        )
+        result = await db.execute(query)
+        assert result.results == [MetricResult("m", 1, {"l": "a"})]
+        assert result.stats.filtered == {"m": 2}
+
+    @pytest.mark.asyncio
+    async def test_execute_stats_chunk_size(self, db):
+        """Statistics are collected across chunks."""
+        query = Query(
+            "query",
+            20,
+            ["db"],
+            [QueryMetric("metric", [])],
+            "SELECT 1 AS metric UNION SELECT 2 UNION SELECT 3",
+            chunk_size=2,
+        )
+        result = await db.execute(query, handler=lambda results: None)
+        assert result.stats.rows == 3
+        assert result.stats.series == 3
+
+    @pytest.mark.asyncio
+    async def test_execute_concurrent_pool(self):
+        """Concurrent queries use separate connections from the pool."""
+        db = DataBase("db", "sqlite://", pool_size=2)
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        await asyncio.gather(*(db.execute(query) for _ in range(4)))
+        assert db.pool_status() == PoolStatus(used=0, idle=2)
+        await db.close()
+
+    @pytest.mark.asyncio
+    async def test_execute_max_overflow(self):
+        """Overflow connections are closed after use."""
+        db = DataBase("db", "sqlite://", pool_size=1, max_overflow=2)
+        await db.connect()
+        conns = [(await db._checkout())[0] for _ in range(3)]
+        assert db.pool_status() == PoolStatus(used=3, idle=0)
+        for conn in conns:
+            await db._checkin(conn)
+        assert db.pool_status() == PoolStatus(used=0, idle=1)
+        await db.close()
+
+    @pytest.mark.asyncio
+    async def test_execute_pool_timeout(self, caplog):
+        """An error is raised if no connection is available before timeout."""
+        db = DataBase("db", "sqlite://", pool_timeout=0.1)
+        query = Query(
+            "query", 20, ["db"], [QueryMetric("metric", [])], "SELECT 1 AS metric"
+        )
+        await db.connect()
+        conn, _ = await db._checkout()
+        with caplog.at_level(logging.ERROR), pytest.raises(DataBaseError) as error:
+            await db.execute(query)
+        message = "timeout waiting for a connection from the pool after 0.1 seconds"
+        assert str(error.value) == message
+        assert not error.value.fatal
+        assert caplog.messages == [f'error from database "db": {message}']
+        await db._checkin(conn)
+        await db.close()
+
+    @pytest.mark.asyncio
+    async def test_checkout_cancelled(self, mocker):
+        """The pool slot is released if checkout is cancelled while connecting."""
+        db = DataBase("db", "sqlite://", pool_size=2)
+        release = asyncio.Event()
+
+        async def open_connection():
+            await release.wait()
+
+        mocker.patch.object(db, "_open_connection", open_connection)
+        task = asyncio.ensure_future(db._checkout())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert db._pool_semaphore._value == 2
+
+    @pytest.mark.asyncio
+    async def test_close_discarded_connection(self, db):
+        """Closing the database waits for discarded connections to close."""
+        await db.connect()
+        conn, _ = await db._checkout()
+        await db._checkin(conn, discard=True)
+        assert not conn.closed
+        await db.close()
+        assert conn.closed
+
+    @pytest.mark.asyncio
+    async def test_checkin_closed_connection(self, db):
+        """A connection closed while in use is not returned to the pool."""
+        await db.connect()
+        conn, _ = await db._checkout()
+        await db.close()
+        await db._checkin(conn)
+        assert db._idle_conns == []
+        # the connection slot is released
+        conn, _ = await db._checkout()
+        await db._checkin(conn)
+
     @pytest.mark.asyncio
     async def test_execute_sql(self, db):
         """It's possible to execute raw SQL."""
@@ -1,6 +1,5 @@
 import asyncio
 from collections import defaultdict
-from decimal import Decimal
 import logging
 
 from prometheus_aioexporter import MetricsRegistry
@@ -9,7 +8,12 @@ import yaml
 import pytest
 
 from ..config import load_config
-from ..db import DataBase
+from ..db import (
+    DataBase,
+    PoolStatus,
+    QueryTimeoutExpired,
+    ThreadBackend,
+)
 from ..loop import QueryLoop
 
 
@@ -35,16 +39,30 @@ def registry():
 
 
 @pytest.fixture
-async def make_query_loop(tmpdir, config_data, registry):
-    query_loops = []
+def phase_offset(mocker):
+    """Run periodic queries at start without offsets, unless changed."""
+    yield mocker.patch("query_exporter.loop.phase_offset", return_value=0.0)
+
 
-    def make_loop():
+@pytest.fixture
+def make_config(tmpdir):
+    def make(data):
         config_file = tmpdir / "config.yaml"
-        config_file.write_text(yaml.dump(config_data), "utf-8")
+        config_file.write_text(yaml.dump(data), "utf-8")
         with config_file.open() as fh:
-            config = load_config(fh, logging.getLogger())
+            return load_config(fh, logging.getLogger())
+
+    yield make
+
+
+@pytest.fixture
+async def make_query_loop(config_data, registry, phase_offset, make_config):
+    query_loops = []
+
+    def make_loop(**kwargs):
+        config = make_config(config_data)
         registry.create_metrics(config.metrics.values())
-        query_loop = QueryLoop(config, registry, logging)
+        query_loop = QueryLoop(config, registry, logging.getLogger(), **kwargs)
         query_loops.append(query_loop)
         return query_loop
 
@@ -78,20 +96,177 @@ def metric_values(metric, by_labels=()):
     return values if by_labels else values[suffix]
 
 
+async def start_connected(query_loop):
+    """Start the loop, waiting for connection attempts to complete."""
+    await query_loop.start()
+    if query_loop._connect_task is not None:
+        await query_loop._connect_task
+
+
+def block_executions(mocker, query_loop):
+    """Make query executions block until the returned event is set."""
+    release = asyncio.Event()
+    calls = []
+
+    async def execute_query(query, dbname):
+        calls.append((query.name, dbname))
+        await release.wait()
+
+    mocker.patch.object(query_loop, "_execute_query", execute_query)
+    return release, calls
+
+
 @pytest.mark.asyncio
 class TestQueryLoop:
     async def test_start(self, query_loop):
-        """The start method starts periodic calls for queries."""
+        """The start method schedules periodic calls for queries."""
         await query_loop.start()
-        periodic_call = query_loop._periodic_calls["q"]
-        assert periodic_call.running
+        await query_loop._connect_task
+        assert query_loop._scheduler.running
+        assert ("q", "db") in query_loop._scheduler
 
     async def test_stop(self, query_loop):
         """The stop method stops periodic calls for queries."""
         await query_loop.start()
-        periodic_call = query_loop._periodic_calls["q"]
         await query_loop.stop()
-        assert not periodic_call.running
+        assert not query_loop._scheduler.running
+
+    async def test_start_connect_parallelism(
+        self, mocker, config_data, make_query_loop, phase_offset
+    ):
+        """Databases are connected concurrently, up to the parallelism limit."""
+        # don't run queries while connecting
+        phase_offset.return_value = 5.0
+        config_data["databases"] = {
+            f"db{index}": {"dsn": "sqlite://"} for index in range(5)
+        }
+        config_data["queries"]["q"]["databases"] = list(config_data["databases"])
+        connecting = []
+        max_connecting = 0
+
+        async def connect(db, timeout=None):
+            nonlocal max_connecting
+            connecting.append(db)
+            max_connecting = max(max_connecting, len(connecting))
+            await asyncio.sleep(0.01)
+            connecting.remove(db)
+
+        mocker.patch.object(DataBase, "connect", connect)
+        query_loop = make_query_loop(connect_parallelism=2)
+        await query_loop.start()
+        await query_loop._connect_task
+        assert max_connecting == 2
+        assert len(query_loop._scheduler) == 5
+
+    async def test_start_schedule_ready_databases(
+        self, mocker, config_data, make_query_loop
+    ):
+        """Queries are scheduled as soon as their database is connected."""
+        config_data["databases"] = {
+            "db1": {"dsn": "sqlite://"},
+            "db2": {"dsn": "sqlite://"},
+        }
+        config_data["queries"]["q"]["databases"] = ["db1", "db2"]
+        release = asyncio.Event()
+
+        async def connect(db, timeout=None):
+            if db.name == "db2":
+                await release.wait()
+
+        mocker.patch.object(DataBase, "connect", connect)
+        query_loop = make_query_loop()
+        # databases are connected in background
+        await query_loop.start()
+        await asyncio.sleep(0.01)
+        assert ("q", "db1") in query_loop._scheduler
+        assert ("q", "db2") not in query_loop._scheduler
+        release.set()
+        await query_loop._connect_task
+        assert ("q", "db2") in query_loop._scheduler
+
+    async def test_start_connect_timeout(
+        self, mocker, caplog, config_data, make_query_loop, registry
+    ):
+        """Connections not completing within the timeout are counted as errors."""
+
+        async def connect(backend):
+            await asyncio.sleep(0.1)
+
+        mocker.patch.object(ThreadBackend, "connect", connect)
+        query_loop = make_query_loop(connect_timeout=0.01)
+        await query_loop.start()
+        await query_loop._connect_task
+        assert ("q", "db") in query_loop._scheduler
+        assert 'error from database "db": timeout connecting after 0.01 seconds' in (
+            caplog.messages
+        )
+        assert metric_values(registry.get_metric("database_errors")) == [1.0]
+
+    async def test_stop_while_connecting(self, mocker, query_loop):
+        """Stopping the loop cancels pending connection attempts."""
+        release = asyncio.Event()
+
+        async def connect(db, timeout=None):
+            await release.wait()
+
+        mocker.patch.object(DataBase, "connect", connect)
+        await query_loop.start()
+        connect_task = query_loop._connect_task
+        assert ("q", "db") not in query_loop._scheduler
+        await query_loop.stop()
+        assert connect_task.cancelled()
+        assert query_loop._connect_task is None
+
+    async def test_reload_while_connecting(
+        self, mocker, config_data, make_config, query_loop, phase_offset
+    ):
+        """Pending connection attempts are restarted on reload."""
+        # don't run queries after connecting
+        phase_offset.return_value = 5.0
+        release = asyncio.Event()
+        connects = []
+
+        async def connect(db, timeout=None):
+            connects.append(db.name)
+            await release.wait()
+
+        mocker.patch.object(DataBase, "connect", connect)
+        await query_loop.start()
+        connect_task = query_loop._connect_task
+        await asyncio.sleep(0.01)
+        await query_loop.reload(make_config(config_data))
+        assert connect_task.cancelled()
+        assert ("q", "db") not in query_loop._scheduler
+        release.set()
+        await query_loop._connect_task
+        assert connects == ["db", "db"]
+        assert ("q", "db") in query_loop._scheduler
+
+    async def test_start_phase_offsets(
+        self, advance_time, query_tracker, config_data, make_query_loop, phase_offset
+    ):
+        """Periodic queries are run with a phase offset for each database."""
+        config_data["databases"] = {
+            "db1": {"dsn": "sqlite://"},
+            "db2": {"dsn": "sqlite://"},
+        }
+        config_data["queries"]["q"]["databases"] = ["db1", "db2"]
+        phase_offset.side_effect = lambda key, interval: {"q:db1": 2, "q:db2": 4}[key]
+        query_loop = make_query_loop()
+        await start_connected(query_loop)
+        await advance_time(0)
+        assert query_tracker.queries == []
+        await advance_time(2)
+        assert len(query_tracker.queries) == 1
+        await advance_time(2)
+        assert len(query_tracker.queries) == 2
+        # following runs keep the offset
+        await advance_time(7)
+        assert len(query_tracker.queries) == 2
+        await advance_time(1)
+        assert len(query_tracker.queries) == 3
+        phase_offset.assert_any_call("q:db1", 10)
+        phase_offset.assert_any_call("q:db2", 10)
 
     async def test_run_query(self, query_tracker, query_loop, registry):
         """Queries are run and update metrics."""
@@ -126,6 +301,20 @@ class TestQueryLoop:
             ("success",): 2.0
         }
 
+    async def test_run_query_chunk_size(
+        self, query_tracker, registry, config_data, make_query_loop
+    ):
+        """Results for queries with a chunk size update metrics."""
+        config_data["metrics"]["m"]["type"] = "counter"
+        config_data["queries"]["q"].update(
+            {"sql": "SELECT 1 AS m UNION SELECT 2 UNION SELECT 3", "chunk-size": 2}
+        )
+        query_loop = make_query_loop()
+        await query_loop.start()
+        await query_tracker.wait_results()
+        metric = registry.get_metric("m")
+        assert metric_values(metric) == [6.0]
+
     async def test_run_query_null_value(
         self, query_tracker, registry, config_data, make_query_loop
     ):
@@ -155,27 +344,285 @@ class TestQueryLoop:
             ("db2", "v3", "v4"): 100.0,
         }
 
-    async def test_update_metric_decimal_value(self, registry, make_query_loop):
-        """A Decimal value in query results is converted to float."""
-        db = DataBase("db", f"sqlite://")
+    async def test_run_query_pool_wait(self, query_tracker, query_loop, registry):
+        """Time spent waiting for pool connections is recorded."""
+        await query_loop.start()
+        await query_tracker.wait_results()
+        metric = registry.get_metric("database_pool_wait_seconds")
+        [count] = [
+            value for suffix, labels, value in metric._samples() if suffix == "_count"
+        ]
+        assert count == 1.0
+
+    async def test_run_query_stats(self, query_tracker, query_loop, registry):
+        """Statistics for query executions are recorded."""
+        await query_loop.start()
+        await query_tracker.wait_results()
+        metric = registry.get_metric("query_latency_seconds")
+        [count] = [
+            value for suffix, labels, value in metric._samples() if suffix == "_count"
+        ]
+        assert count == 1.0
+        for name in ("query_fetch_seconds", "query_process_seconds"):
+            metric = registry.get_metric(name)
+            assert [
+                labels["query"]
+                for suffix, labels, value in metric._samples()
+                if suffix == "_count"
+            ] == ["q"]
+        rows_metric = registry.get_metric("query_rows")
+        assert metric_values(rows_metric, by_labels=("query",)) == {("q",): 1.0}
+        series_metric = registry.get_metric("query_series_updated")
+        assert metric_values(series_metric, by_labels=("query",)) == {("q",): 1.0}
+        cache_metric = registry.get_metric("query_statement_cache_lookups")
+        assert metric_values(cache_metric, by_labels=("query", "result")) == {
+            ("q", "miss"): 1.0
+        }
+
+    async def test_run_query_no_stats(
+        self, query_tracker, config_data, make_query_loop, registry
+    ):
+        """Statistics for query executions can be disabled."""
         query_loop = make_query_loop()
-        query_loop._update_metric(db, "m", Decimal("100.123"))
-        metric = registry.get_metric("m")
-        [value] = metric_values(metric)
-        assert value == 100.123
-        assert isinstance(value, float)
+        query_loop._query_stats = False
+        await query_loop.start()
+        await query_tracker.wait_results()
+        metric = registry.get_metric("query_rows")
+        assert metric_values(metric) == []
+
+    async def test_update_metric_cached(self, mocker, query_loop, registry):
+        """Update methods for metric series are cached."""
+        get_metric = mocker.spy(registry, "get_metric")
+        db = query_loop._config.databases["db"]
+        query_loop._update_metric(db, "m", 10.0)
+        query_loop._update_metric(db, "m", 20.0)
+        get_metric.assert_called_once_with("m", labels={"database": "db"})
+        assert metric_values(registry.get_metric("m")) == [20.0]
+
+    async def test_update_metric_cache_eviction(
+        self, config_data, make_query_loop, registry
+    ):
+        """Least recently used series are evicted from the cache."""
+        config_data["metrics"]["m"]["labels"] = ["l"]
+        config_data["queries"]["q"]["sql"] = "SELECT 1 AS m, 'a' AS l"
+        query_loop = make_query_loop()
+        query_loop.METRIC_CACHE_SIZE = 2
+        db = query_loop._config.databases["db"]
+        query_loop._update_metric(db, "m", 1.0, labels={"l": "a"})
+        query_loop._update_metric(db, "m", 2.0, labels={"l": "b"})
+        query_loop._update_metric(db, "m", 3.0, labels={"l": "a"})
+        query_loop._update_metric(db, "m", 4.0, labels={"l": "c"})
+        assert list(query_loop._metric_updaters) == [
+            ("m", "db", (("l", "a"),)),
+            ("m", "db", (("l", "c"),)),
+        ]
+        # evicted series are still updated
+        query_loop._update_metric(db, "m", 5.0, labels={"l": "b"})
+        assert metric_values(registry.get_metric("m"), by_labels=("l",)) == {
+            ("a",): 3.0,
+            ("b",): 5.0,
+            ("c",): 4.0,
+        }
+
+    async def test_expire_series_scheduled(self, config_data, make_query_loop):
+        """A call removing expired series is scheduled if metrics expire."""
+        config_data["metrics"]["m"]["expiration"] = 60
+        query_loop = make_query_loop()
+        await query_loop.start()
+        call = query_loop._scheduler.get("expire-series")
+        assert call.interval == 30
+
+    async def test_expire_series_not_scheduled(self, query_loop):
+        """No call removing expired series is scheduled by default."""
+        await query_loop.start()
+        assert "expire-series" not in query_loop._scheduler
+
+    async def test_expire_series(
+        self, advance_time, config_data, make_query_loop, registry
+    ):
+        """Series not updated within the expiration are removed."""
+        config_data["metrics"]["m"]["labels"] = ["l"]
+        config_data["metrics"]["m"]["expiration"] = 60
+        query_loop = make_query_loop()
+        db = query_loop._config.databases["db"]
+        query_loop._update_metric(db, "m", 1.0, labels={"l": "a"})
+        query_loop._update_metric(db, "m", 2.0, labels={"l": "b"})
+        await advance_time(30)
+        query_loop._update_metric(db, "m", 3.0, labels={"l": "b"})
+        await advance_time(30)
+        query_loop._expire_series()
+        assert metric_values(registry.get_metric("m"), by_labels=("l",)) == {
+            ("b",): 3.0
+        }
+        expired_metric = registry.get_metric("expired_series")
+        assert metric_values(expired_metric, by_labels=("metric",)) == {("m",): 1.0}
+        # expired series are created again when updated
+        query_loop._update_metric(db, "m", 4.0, labels={"l": "a"})
+        assert metric_values(registry.get_metric("m"), by_labels=("l",)) == {
+            ("a",): 4.0,
+            ("b",): 3.0,
+        }
+
+    async def test_expire_series_database_labels(
+        self, advance_time, config_data, make_query_loop, registry
+    ):
+        """Expired series with database labels are removed."""
+        config_data["databases"]["db"]["labels"] = {"region": "eu"}
+        config_data["metrics"]["m"]["expiration"] = 60
+        query_loop = make_query_loop()
+        db = query_loop._config.databases["db"]
+        query_loop._update_metric(db, "m", 1.0)
+        await advance_time(60)
+        query_loop._expire_series()
+        assert metric_values(registry.get_metric("m")) == []
+
+    async def test_update_metric_max_series(
+        self, caplog, config_data, make_query_loop, registry
+    ):
+        """Updates creating series beyond the metric limit are dropped."""
+        config_data["metrics"]["m"].update({"labels": ["l"], "max-series": 2})
+        query_loop = make_query_loop()
+        db = query_loop._config.databases["db"]
+        for label, value in (("a", 1.0), ("b", 2.0), ("c", 3.0), ("a", 4.0)):
+            query_loop._update_metric(db, "m", value, labels={"l": label})
+        query_loop._update_metric(db, "m", 5.0, labels={"l": "d"})
+        assert metric_values(registry.get_metric("m"), by_labels=("l",)) == {
+            ("a",): 4.0,
+            ("b",): 2.0,
+        }
+        dropped_metric = registry.get_metric("dropped_updates")
+        assert metric_values(dropped_metric, by_labels=("metric", "reason")) == {
+            ("m", "max-series"): 2.0
+        }
+        # the limit is only logged once
+        assert (
+            caplog.messages.count(
+                'limit of 2 series reached for metric "m", '
+                "dropping updates for new series"
+            )
+            == 1
+        )
+
+    async def test_update_metric_max_series_expired(
+        self, advance_time, config_data, make_query_loop, registry
+    ):
+        """Expired series don't count for the metric limit."""
+        config_data["metrics"]["m"].update(
+            {"labels": ["l"], "max-series": 1, "expiration": 10}
+        )
+        query_loop = make_query_loop()
+        db = query_loop._config.databases["db"]
+        query_loop._update_metric(db, "m", 1.0, labels={"l": "a"})
+        await advance_time(10)
+        query_loop._expire_series()
+        query_loop._update_metric(db, "m", 2.0, labels={"l": "b"})
+        assert metric_values(registry.get_metric("m"), by_labels=("l",)) == {
+            ("b",): 2.0
+        }
+
+    async def test_run_query_label_filters(
+        self, query_tracker, config_data, make_query_loop, registry
+    ):
+        """Rows dropped by label filters are counted."""
+        config_data["metrics"]["m"].update(
+            {"labels": ["l"], "label-filters": {"l": {"deny": "b"}}}
+        )
+        config_data["queries"]["q"][
+            "sql"
+        ] = "SELECT 1 AS m, 'a' AS l UNION SELECT 2 AS m, 'b' AS l"
+        query_loop = make_query_loop()
+        await query_loop.start()
+        await query_tracker.wait_results()
+        assert metric_values(registry.get_metric("m"), by_labels=("l",)) == {
+            ("a",): 1.0
+        }
+        dropped_metric = registry.get_metric("dropped_updates")
+        assert metric_values(dropped_metric, by_labels=("metric", "reason")) == {
+            ("m", "label-filter"): 1.0
+        }
+
+    async def test_run_query_workers(self, make_query_loop, registry):
+        """Queries can be run in worker processes."""
+        query_loop = make_query_loop(workers=1)
+        await query_loop.start()
+        assert not query_loop._config.databases["db"].connected
+        queries_metric = registry.get_metric("queries")
+        for _ in range(100):
+            if metric_values(queries_metric, by_labels=("status",)):
+                break
+            await asyncio.sleep(0.05)
+        assert metric_values(queries_metric, by_labels=("status",)) == {
+            ("success",): 1.0
+        }
+        assert metric_values(registry.get_metric("m")) == [100.0]
+        query_loop.update_database_metrics()
+        pool_metric = registry.get_metric("database_pool_connections")
+        assert metric_values(pool_metric) == []
+        await query_loop.stop()
+        [worker] = query_loop._worker_pool._workers.values()
+        assert not worker.running
+
+    async def test_update_database_metrics(self, query_tracker, query_loop, registry):
+        """Metrics for database connection pools are updated."""
+        await query_loop.start()
+        await query_tracker.wait_results()
+        query_loop.update_database_metrics()
+        metric = registry.get_metric("database_pool_connections")
+        assert metric_values(metric, by_labels=("state",)) == {
+            ("idle",): 1.0,
+            ("used",): 0.0,
+        }
+
+    async def test_update_database_metrics_circuit_breaker(
+        self, config_data, make_query_loop, registry
+    ):
+        """Metrics for database circuit breakers are updated."""
+        config_data["databases"]["db"]["circuit-breaker"] = {"failures": 1}
+        query_loop = make_query_loop()
+        breaker = query_loop._config.databases["db"].circuit_breaker
+        breaker.record_failure()
+        query_loop.update_database_metrics()
+        state_metric = registry.get_metric("database_circuit_breaker_state")
+        states = {
+            labels["database_circuit_breaker_state"]: value
+            for _, labels, value in state_metric._samples()
+        }
+        assert states == {"closed": 0.0, "open": 1.0, "half-open": 0.0}
+        retry_metric = registry.get_metric(
+            "database_circuit_breaker_retry_timestamp_seconds"
+        )
+        assert metric_values(retry_metric) == [breaker.retry_at]
+
+    async def test_run_query_database_unavailable(
+        self, query_tracker, config_data, make_query_loop, registry
+    ):
+        """Queries on databases with an open circuit breaker are not run."""
+        config_data["databases"]["db"]["circuit-breaker"] = {"failures": 1}
+        query_loop = make_query_loop()
+        query_loop._config.databases["db"].circuit_breaker.record_failure()
+        await query_loop.start()
+        await query_tracker.wait_failures()
+        queries_metric = registry.get_metric("queries")
+        assert metric_values(queries_metric, by_labels=("status",)) == {
+            ("unavailable",): 1.0
+        }
 
     async def test_run_query_log(self, caplog, query_tracker, query_loop):
         """Debug messages are logged on query execution."""
         caplog.set_level(logging.DEBUG)
         await query_loop.start()
         await query_tracker.wait_queries()
-        assert caplog.messages == [
+        messages = caplog.messages[:4]
+        pool_wait_message = caplog.messages[4]
+        assert messages == [
             'connected to database "db"',
             'running query "q" on database "db"',
             'updating metric "m" set 100.0 {database="db"}',
             'updating metric "queries" inc 1 {database="db",status="success"}',
         ]
+        assert pool_wait_message.startswith(
+            'updating metric "database_pool_wait_seconds" observe '
+        )
 
     async def test_run_query_log_labels(
         self, caplog, query_tracker, config_data, make_query_loop
@@ -187,7 +634,7 @@ class TestQueryLoop:
         caplog.set_level(logging.DEBUG)
         await query_loop.start()
         await query_tracker.wait_queries()
-        assert caplog.messages == [
+        assert caplog.messages[:4] == [
             'connected to database "db"',
             'running query "q" on database "db"',
             'updating metric "m" set 100.0 {database="db",l="foo"}',
@@ -200,11 +647,99 @@ class TestQueryLoop:
         """Query errors are logged."""
         config_data["databases"]["db"]["dsn"] = "sqlite:////invalid"
         query_loop = make_query_loop()
-        await query_loop.start()
+        await start_connected(query_loop)
         await query_tracker.wait_failures()
         queries_metric = registry.get_metric("database_errors")
         assert metric_values(queries_metric) == [1.0]
 
+    async def test_run_query_increase_timeout_count(
+        self, query_tracker, config_data, make_query_loop, registry
+    ):
+        """Count of timed out queries is incremented on timeout."""
+        config_data["queries"]["q"].update(
+            {
+                "sql": "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)"
+                " SELECT COUNT(*) AS m FROM c",
+                "timeout": 0.1,
+            }
+        )
+        query_loop = make_query_loop()
+        await query_loop.start()
+        await query_tracker.wait_failures()
+        queries_metric = registry.get_metric("queries")
+        assert metric_values(queries_metric, by_labels=("status",)) == {
+            ("timeout",): 1.0
+        }
+
+    async def test_run_query_overlap_allow(self, mocker, query_loop):
+        """By default, overlapping query executions are allowed."""
+        release, calls = block_executions(mocker, query_loop)
+        [query] = query_loop._periodic_queries
+        for _ in range(3):
+            query_loop._run_query(query, "db")
+        await asyncio.sleep(0)
+        assert calls == [("q", "db")] * 3
+        release.set()
+
+    async def test_run_query_overlap_skip(
+        self, mocker, config_data, make_query_loop, registry
+    ):
+        """With the "skip" policy, overlapping executions are skipped."""
+        config_data["queries"]["q"]["overlap"] = "skip"
+        query_loop = make_query_loop()
+        release, calls = block_executions(mocker, query_loop)
+        [query] = query_loop._periodic_queries
+        for _ in range(3):
+            query_loop._run_query(query, "db")
+        await asyncio.sleep(0)
+        assert calls == [("q", "db")]
+        queries_metric = registry.get_metric("queries")
+        assert metric_values(queries_metric, by_labels=("status",)) == {
+            ("skipped",): 2.0
+        }
+        [task] = query_loop._running_queries[("q", "db")]
+        release.set()
+        await task
+        # once done, the query runs again
+        query_loop._run_query(query, "db")
+        await asyncio.sleep(0)
+        assert calls == [("q", "db")] * 2
+
+    async def test_run_query_overlap_queue_one(
+        self, mocker, config_data, make_query_loop, registry
+    ):
+        """With the "queue-one" policy, one execution is queued."""
+        config_data["queries"]["q"]["overlap"] = "queue-one"
+        query_loop = make_query_loop()
+        release, calls = block_executions(mocker, query_loop)
+        [query] = query_loop._periodic_queries
+        for _ in range(3):
+            query_loop._run_query(query, "db")
+        await asyncio.sleep(0)
+        assert calls == [("q", "db")]
+        queries_metric = registry.get_metric("queries")
+        assert metric_values(queries_metric, by_labels=("status",)) == {
+            ("skipped",): 1.0
+        }
+        [task] = query_loop._running_queries[("q", "db")]
+        release.set()
+        await task
+        await asyncio.sleep(0)
+        # the queued execution is run
+        assert calls == [("q", "db")] * 2
+        assert query_loop._queued_queries == set()
+
+    async def test_stop_cancels_running_queries(self, mocker, query_loop):
+        """Running query executions are cancelled on stop."""
+        release, calls = block_executions(mocker, query_loop)
+        [query] = query_loop._periodic_queries
+        query_loop._run_query(query, "db")
+        await asyncio.sleep(0)
+        [task] = query_loop._running_queries[("q", "db")]
+        await query_loop.stop()
+        assert task.cancelled()
+        assert query_loop._running_queries == {}
+
     async def test_run_query_increase_error_count(
         self, query_tracker, config_data, make_query_loop, registry
     ):
@@ -218,7 +753,7 @@ class TestQueryLoop:
 
     async def test_run_query_at_interval(self, advance_time, query_tracker, query_loop):
         """Queries are run at the specified time interval."""
-        await query_loop.start()
+        await start_connected(query_loop)
         await advance_time(0)  # kick the first run
         # the query has been run once
         assert len(query_tracker.queries) == 1
@@ -229,13 +764,99 @@ class TestQueryLoop:
         await advance_time(5)
         assert len(query_tracker.queries) == 2
 
+    async def test_run_scheduled_query(
+        self, mocker, advance_time, query_tracker, config_data, make_query_loop
+    ):
+        """Queries with a schedule are run at scheduled times."""
+        mock_time = mocker.patch("query_exporter.schedule.time")
+        mock_time.time.return_value = 1000.0
+        del config_data["queries"]["q"]["interval"]
+        config_data["queries"]["q"]["schedule"] = "every 5m"
+        query_loop = make_query_loop()
+        await start_connected(query_loop)
+        await advance_time(199)
+        assert query_tracker.queries == []
+        mock_time.time.return_value = 1200.0
+        await advance_time(1)
+        assert len(query_tracker.queries) == 1
+        mock_time.time.return_value = 1500.0
+        await advance_time(300)
+        assert len(query_tracker.queries) == 2
+
+    async def test_adaptive_interval_metric(
+        self, config_data, make_query_loop, registry
+    ):
+        """The interval metric is set for queries with adaptive intervals."""
+        config_data["queries"]["q"]["adaptive-interval"] = {"max-interval": 40}
+        query_loop = make_query_loop()
+        await start_connected(query_loop)
+        metric = registry.get_metric("query_interval_seconds")
+        assert metric_values(metric, by_labels=("query",)) == {("q",): 10.0}
+
+    @pytest.mark.parametrize(
+        "duration,interval", [(None, 20), (6.0, 20), (2.0, 10), (1.0, 5),],
+    )
+    async def test_adapt_interval(
+        self, config_data, make_query_loop, registry, duration, interval
+    ):
+        """Query intervals are adapted based on the execution cost."""
+        config_data["queries"]["q"]["adaptive-interval"] = {
+            "min-interval": 5,
+            "max-interval": 40,
+        }
+        query_loop = make_query_loop()
+        await start_connected(query_loop)
+        query = query_loop._config.queries["q"]
+        query_loop._adapt_interval(query, "db", duration)
+        assert query_loop._scheduler.get(("q", "db")).interval == interval
+        metric = registry.get_metric("query_interval_seconds")
+        assert metric_values(metric, by_labels=("query",)) == {("q",): interval}
+
+    async def test_adapt_interval_bounds(self, config_data, make_query_loop):
+        """Adapted intervals are kept within bounds."""
+        config_data["queries"]["q"]["adaptive-interval"] = {
+            "min-interval": 5,
+            "max-interval": 15,
+        }
+        query_loop = make_query_loop()
+        await start_connected(query_loop)
+        query = query_loop._config.queries["q"]
+        call = query_loop._scheduler.get(("q", "db"))
+        query_loop._adapt_interval(query, "db", None)
+        query_loop._adapt_interval(query, "db", None)
+        assert call.interval == 15
+        query_loop._adapt_interval(query, "db", 0.0)
+        query_loop._adapt_interval(query, "db", 0.0)
+        assert call.interval == 5
+
+    async def test_adapt_interval_not_scheduled(self, config_data, make_query_loop):
+        """Intervals are not adapted for calls not in the scheduler."""
+        config_data["queries"]["q"]["adaptive-interval"] = {"max-interval": 40}
+        query_loop = make_query_loop()
+        query = query_loop._config.queries["q"]
+        query_loop._adapt_interval(query, "db", None)
+        assert query_loop._scheduler.get(("q", "db")) is None
+
+    async def test_adaptive_interval_slow_query(
+        self, mocker, advance_time, query_tracker, config_data, make_query_loop
+    ):
+        """The interval for slow queries is stretched."""
+        config_data["queries"]["q"]["adaptive-interval"] = {"max-interval": 40}
+        query_loop = make_query_loop()
+        db = query_loop._config.databases["db"]
+        mocker.patch.object(db, "execute", side_effect=QueryTimeoutExpired("q", 1))
+        await start_connected(query_loop)
+        await advance_time(0)
+        await asyncio.sleep(0)
+        assert query_loop._scheduler.get(("q", "db")).interval == 20
+
     async def test_run_periodic_queries_invalid_result_count(
         self, query_tracker, config_data, make_query_loop, advance_time
     ):
         """Periodic queries returning invalid elements count are removed."""
         config_data["queries"]["q"]["sql"] = "SELECT 100.0 AS a, 200.0 AS b"
         query_loop = make_query_loop()
-        await query_loop.start()
+        await start_connected(query_loop)
         await advance_time(0)  # kick the first run
         assert len(query_tracker.queries) == 1
         assert len(query_tracker.results) == 0
@@ -253,12 +874,11 @@ class TestQueryLoop:
         config_data["queries"]["q"]["interval"] = 1.0
         query_loop = make_query_loop()
         await query_loop.start()
-        periodic_call = query_loop._periodic_calls["q"]
         await asyncio.sleep(1.1)
         await query_tracker.wait_failures()
         # the query has been stopped and removed
-        assert not periodic_call.running
-        assert query_loop._periodic_calls == {}
+        assert ("q", "db") not in query_loop._scheduler
+        assert query_loop._periodic_queries == []
 
     async def test_run_periodic_queries_not_removed_if_not_failing_on_all_dbs(
         self, tmpdir, query_tracker, config_data, make_query_loop
@@ -303,6 +923,55 @@ class TestQueryLoop:
         await query_loop.run_aperiodic_queries()
         assert len(query_tracker.queries) == 2
 
+    async def test_run_aperiodic_queries_single_flight(
+        self, mocker, config_data, make_query_loop
+    ):
+        """Concurrent runs of aperiodic queries share executions."""
+        del config_data["queries"]["q"]["interval"]
+        query_loop = make_query_loop()
+        release, calls = block_executions(mocker, query_loop)
+        runs = [
+            asyncio.ensure_future(query_loop.run_aperiodic_queries()) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*runs)
+        assert calls == [("q", "db")]
+
+    async def test_run_aperiodic_queries_deadline(
+        self, mocker, config_data, make_query_loop, registry
+    ):
+        """Queries not completed within the deadline are left running."""
+        del config_data["queries"]["q"]["interval"]
+        query_loop = make_query_loop()
+        release, calls = block_executions(mocker, query_loop)
+        await query_loop.run_aperiodic_queries(deadline=0.01)
+        assert calls == [("q", "db")]
+        [task] = query_loop._running_queries[("q", "db")]
+        assert not task.done()
+        metric = registry.get_metric("scrape_deadline_misses")
+        assert metric_values(metric, by_labels=("database", "query")) == {
+            ("db", "q"): 1.0
+        }
+        release.set()
+        await task
+
+    async def test_run_aperiodic_queries_cache_ttl(
+        self, advance_time, query_tracker, config_data, make_query_loop
+    ):
+        """Results of aperiodic queries are reused within the cache TTL."""
+        del config_data["queries"]["q"]["interval"]
+        config_data["queries"]["q"]["cache-ttl"] = 10
+        query_loop = make_query_loop()
+        await query_loop.run_aperiodic_queries()
+        assert len(query_tracker.queries) == 1
+        await advance_time(5)
+        await query_loop.run_aperiodic_queries()
+        assert len(query_tracker.queries) == 1
+        await advance_time(5)
+        await query_loop.run_aperiodic_queries()
+        assert len(query_tracker.queries) == 2
+
     async def test_run_aperiodic_queries_invalid_result_count(
         self, query_tracker, config_data, make_query_loop
     ):
@@ -351,3 +1020,176 @@ class TestQueryLoop:
         # succeeding query is run again, failing one is not
         assert len(query_tracker.results) == 2
         assert len(query_tracker.failures) == 1
+
+    async def test_reload_unchanged(self, config_data, make_config, query_loop):
+        """Reloading an unchanged config keeps databases and scheduled calls."""
+        await start_connected(query_loop)
+        db = query_loop._config.databases["db"]
+        query = query_loop._config.queries["q"]
+        call = query_loop._scheduler.get(("q", "db"))
+        await query_loop.reload(make_config(config_data))
+        assert query_loop._config.databases["db"] is db
+        assert query_loop._config.queries["q"] is query
+        assert query_loop._scheduler.get(("q", "db")) is call
+        assert db.connected
+
+    async def test_reload_changed_query(
+        self, query_tracker, config_data, make_config, query_loop
+    ):
+        """Changed queries are rescheduled, without reconnecting databases."""
+        await start_connected(query_loop)
+        # a running query would be cancelled, discarding its connection
+        await query_tracker.wait_results()
+        db = query_loop._config.databases["db"]
+        call = query_loop._scheduler.get(("q", "db"))
+        config_data["queries"]["q"]["sql"] = "SELECT 200.0 AS m"
+        await query_loop.reload(make_config(config_data))
+        assert query_loop._config.databases["db"] is db
+        assert query_loop._config.queries["q"].sql == "SELECT 200.0 AS m"
+        assert query_loop._scheduler.get(("q", "db")) is not call
+        assert call.cancelled
+        assert db.connected
+
+    async def test_reload_cancel_running_query(
+        self, query_tracker, config_data, make_config, make_query_loop
+    ):
+        """Running queries stopped on reload leave the database pool usable."""
+        config_data["queries"]["q"]["sql"] = (
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)"
+            " SELECT COUNT(*) AS m FROM c"
+        )
+        query_loop = make_query_loop()
+        await start_connected(query_loop)
+        await query_tracker.wait_queries()
+        # let the query start running
+        await asyncio.sleep(0.1)
+        db = query_loop._config.databases["db"]
+        assert db.pool_status().used == 1
+        config_data["queries"]["q"]["sql"] = "SELECT 1.0 AS m"
+        await asyncio.wait_for(query_loop.reload(make_config(config_data)), 5)
+        assert query_loop._config.databases["db"] is db
+        # the busy connection is discarded, and its pool slot released
+        assert db.pool_status() == PoolStatus(used=0, idle=0)
+        assert db._pool_semaphore._value == db.pool_size
+        # the changed query runs on the database
+        await query_tracker.wait_results()
+        assert len(query_tracker.results) == 1
+
+    async def test_reload_changed_database(self, config_data, make_config, query_loop):
+        """Changed databases are reconnected and their queries rescheduled."""
+        await start_connected(query_loop)
+        db = query_loop._config.databases["db"]
+        call = query_loop._scheduler.get(("q", "db"))
+        config_data["databases"]["db"]["connect-sql"] = ["SELECT 1"]
+        await query_loop.reload(make_config(config_data))
+        # changed databases are connected in background
+        await query_loop._connect_task
+        new_db = query_loop._config.databases["db"]
+        assert new_db is not db
+        assert not db.connected
+        assert new_db.connected
+        assert query_loop._scheduler.get(("q", "db")) is not call
+
+    async def test_reload_removed(self, config_data, make_config, query_loop):
+        """Removed databases are closed and their queries unscheduled."""
+        config_data["databases"]["db2"] = {"dsn": "sqlite://"}
+        config_data["queries"]["q2"] = {
+            "interval": 10,
+            "databases": ["db2"],
+            "metrics": ["m"],
+            "sql": "SELECT 1 AS m",
+        }
+        await query_loop.reload(make_config(config_data))
+        await start_connected(query_loop)
+        db2 = query_loop._config.databases["db2"]
+        assert ("q2", "db2") in query_loop._scheduler
+        del config_data["databases"]["db2"]
+        del config_data["queries"]["q2"]
+        await query_loop.reload(make_config(config_data))
+        assert "db2" not in query_loop._config.databases
+        assert "q2" not in query_loop._config.queries
+        assert ("q2", "db2") not in query_loop._scheduler
+        assert ("q", "db") in query_loop._scheduler
+        assert not db2.connected
+
+    async def test_reload_removed_database_series(
+        self, query_tracker, config_data, make_config, query_loop, registry
+    ):
+        """Series for removed databases are removed from metrics."""
+        config_data["databases"]["db2"] = {"dsn": "sqlite://"}
+        config_data["queries"]["q"]["databases"].append("db2")
+        await query_loop.reload(make_config(config_data))
+        await query_loop.start()
+        await query_tracker.wait_results(count=2)
+        metric = registry.get_metric("m")
+        assert metric_values(metric, by_labels=("database",)) == {
+            ("db",): 100.0,
+            ("db2",): 100.0,
+        }
+        del config_data["databases"]["db2"]
+        config_data["queries"]["q"]["databases"] = ["db"]
+        await query_loop.reload(make_config(config_data))
+        assert registry.get_metric("m") is metric
+        assert metric_values(metric, by_labels=("database",)) == {("db",): 100.0}
+
+    async def test_reload_changed_database_labels_series(
+        self, query_tracker, config_data, make_config, make_query_loop, registry
+    ):
+        """Series for databases with changed labels are removed from metrics."""
+        config_data["databases"]["db"]["labels"] = {"l": "foo"}
+        query_loop = make_query_loop()
+        await query_loop.start()
+        await query_tracker.wait_results()
+        metric = registry.get_metric("m")
+        assert metric_values(metric, by_labels=("l",)) == {("foo",): 100.0}
+        config_data["databases"]["db"]["labels"] = {"l": "bar"}
+        await query_loop.reload(make_config(config_data))
+        assert metric_values(metric, by_labels=("l",)) == {}
+
+    async def test_reload_workers(self, config_data, make_config, make_query_loop):
+        """Only workers for changed databases or queries are restarted."""
+        # with 4 workers, db and db2 are in different ones
+        config_data["databases"]["db2"] = {"dsn": "sqlite://"}
+        config_data["queries"]["q2"] = {
+            "interval": 10,
+            "databases": ["db2"],
+            "metrics": ["m"],
+            "sql": "SELECT 1 AS m",
+        }
+        query_loop = make_query_loop(workers=4)
+        await query_loop.start()
+        worker_pool = query_loop._worker_pool
+        worker = worker_pool._database_workers["db"]
+        worker2 = worker_pool._database_workers["db2"]
+        config_data["queries"]["q2"]["sql"] = "SELECT 2 AS m"
+        await query_loop.reload(make_config(config_data))
+        assert query_loop._worker_pool is worker_pool
+        assert worker_pool._database_workers["db"] is worker
+        assert worker.running
+        assert worker_pool._database_workers["db2"] is not worker2
+        assert not worker2.running
+
+    async def test_reload_metrics(self, config_data, make_config, query_loop, registry):
+        """Changed metrics are registered again, and removed ones unregistered."""
+        config_data["metrics"]["m2"] = {"type": "gauge"}
+        await query_loop.reload(make_config(config_data))
+        assert b"m2" in registry.generate_metrics()
+        m = registry.get_metric("m")
+        del config_data["metrics"]["m2"]
+        config_data["metrics"]["m"]["description"] = "changed"
+        await query_loop.reload(make_config(config_data))
+        assert b"m2" not in registry.generate_metrics()
+        assert registry.get_metric("m") is not m
+        assert registry.get_metric("m")._documentation == "changed"
+
+    async def test_reload_changed_metric_series(
+        self, query_tracker, config_data, make_config, query_loop, registry
+    ):
+        """Queries update metrics registered again after a reload."""
+        await query_loop.start()
+        await query_tracker.wait_results()
+        config_data["metrics"]["m"]["description"] = "changed"
+        await query_loop.reload(make_config(config_data))
+        assert metric_values(registry.get_metric("m")) == []
+        query_loop._update_metric(query_loop._config.databases["db"], "m", 3.0)
+        assert metric_values(registry.get_metric("m")) == [3.0]
@@ -0,0 +1,235 @@
+import pytest
+
+from ..schedule import (
+    AlignedScheduledCall,
+    CronScheduledCall,
+    phase_offset,
+    scheduled_call,
+    ScheduledCall,
+    Scheduler,
+    valid_schedule,
+    WallClockScheduledCall,
+)
+
+
+@pytest.fixture
+def wall_time(mocker):
+    """Mock the wall clock time, returning the mock time() function."""
+    mock_time = mocker.patch("query_exporter.schedule.time")
+    mock_time.time.return_value = 1000.0
+    yield mock_time.time
+
+
+def test_phase_offset():
+    """Phase offsets are deterministic and within the interval."""
+    offset = phase_offset("query:db", 60)
+    assert offset == phase_offset("query:db", 60)
+    assert 0 <= offset < 60
+    assert offset != phase_offset("query:other-db", 60)
+
+
+class TestScheduledCall:
+    def test_first_time(self):
+        """The first call is made after the offset."""
+        call = ScheduledCall("key", lambda: None, 10, offset=3)
+        assert call.first_time(100) == 103
+
+    def test_following_time(self):
+        """Following calls are made at the interval."""
+        call = ScheduledCall("key", lambda: None, 10)
+        call.next_time = 100
+        assert call.following_time(100) == 110
+
+    def test_following_time_skip_missed(self):
+        """Missed calls are skipped, keeping the same phase."""
+        call = ScheduledCall("key", lambda: None, 10)
+        call.next_time = 100
+        assert call.following_time(125) == 130
+
+
+@pytest.mark.parametrize(
+    "schedule,valid",
+    [
+        ("every 5m", True),
+        ("every 30", True),
+        ("*/5 * * * *", True),
+        ("0 3 * * 1-5", True),
+        ("every 0m", False),
+        ("every 5w", False),
+        ("* * *", False),
+        ("foo", False),
+    ],
+)
+def test_valid_schedule(schedule, valid):
+    """Schedules can be aligned intervals or cron expressions."""
+    assert valid_schedule(schedule) == valid
+
+
+def test_scheduled_call_aligned():
+    """An aligned call is returned for "every" schedules."""
+    call = scheduled_call("key", lambda: None, "every 5m", jitter=2)
+    assert isinstance(call, AlignedScheduledCall)
+    assert call.interval == 300
+    assert call.jitter == 2
+
+
+def test_scheduled_call_cron():
+    """A cron call is returned for cron expressions."""
+    call = scheduled_call("key", lambda: None, "0 3 * * *")
+    assert isinstance(call, CronScheduledCall)
+    assert call.expression == "0 3 * * *"
+
+
+class TestWallClockScheduledCall:
+    def test_abstract(self):
+        """Subclasses must define the wall-clock time of calls."""
+        with pytest.raises(TypeError):
+            WallClockScheduledCall("key", lambda: None)  # type: ignore
+
+
+class TestAlignedScheduledCall:
+    def test_first_time(self, wall_time):
+        """The first call is at the next multiple of the interval."""
+        call = AlignedScheduledCall("key", lambda: None, 300)
+        assert call.first_time(10) == 10 + 200
+        assert call.next_wall_time == 1200
+
+    def test_following_time(self, wall_time):
+        """Following calls are at the next multiple of the interval."""
+        call = AlignedScheduledCall("key", lambda: None, 300)
+        call.first_time(10)
+        wall_time.return_value = 1200.0
+        assert call.following_time(210) == 510
+        assert call.next_wall_time == 1500
+
+    def test_following_time_early(self, wall_time):
+        """If the call runs early, the following one is not the same."""
+        call = AlignedScheduledCall("key", lambda: None, 300)
+        call.first_time(10)
+        wall_time.return_value = 1199.999
+        assert call.next_wall_time == 1200
+        call.following_time(209.999)
+        assert call.next_wall_time == 1500
+
+
+class TestCronScheduledCall:
+    def test_following_time(self, wall_time):
+        """Calls are made at times matching the cron expression."""
+        call = CronScheduledCall("key", lambda: None, "*/10 * * * *")
+        assert call.first_time(0) == 200
+        assert call.next_wall_time == 1200
+        wall_time.return_value = 1200.0
+        assert call.following_time(200) == 800
+        assert call.next_wall_time == 1800
+
+
+@pytest.fixture
+def scheduler(event_loop):
+    scheduler = Scheduler(event_loop)
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.mark.asyncio
+class TestScheduler:
+    async def test_start_stop(self, scheduler):
+        """The scheduler can be started and stopped."""
+        assert not scheduler.running
+        scheduler.start()
+        assert scheduler.running
+        scheduler.stop()
+        assert not scheduler.running
+
+    async def test_add(self, scheduler):
+        """Calls can be added to the scheduler."""
+        scheduler.add(ScheduledCall("key", lambda: None, 10))
+        assert "key" in scheduler
+        assert len(scheduler) == 1
+
+    async def test_add_duplicated(self, scheduler):
+        """An error is raised if a call with the same key is added."""
+        scheduler.add(ScheduledCall("key", lambda: None, 10))
+        with pytest.raises(KeyError):
+            scheduler.add(ScheduledCall("key", lambda: None, 10))
+
+    async def test_get(self, scheduler):
+        """Calls can be looked up by key."""
+        call = ScheduledCall("key", lambda: None, 10)
+        scheduler.add(call)
+        assert scheduler.get("key") is call
+        assert scheduler.get("other") is None
+
+    async def test_remove(self, scheduler):
+        """Calls can be removed from the scheduler."""
+        scheduler.add(ScheduledCall("key", lambda: None, 10))
+        scheduler.remove("key")
+        assert "key" not in scheduler
+        # removing again is a no-op
+        scheduler.remove("key")
+
+    async def test_run_calls(self, advance_time, scheduler):
+        """Calls are run at their interval, shifted by their offset."""
+        calls = []
+        scheduler.add(ScheduledCall("a", lambda: calls.append("a"), 10))
+        scheduler.add(ScheduledCall("b", lambda: calls.append("b"), 5, offset=2))
+        scheduler.start()
+        await advance_time(0)
+        assert calls == ["a"]
+        await advance_time(2)
+        assert calls == ["a", "b"]
+        await advance_time(5)
+        assert calls == ["a", "b", "b"]
+        await advance_time(3)
+        assert calls == ["a", "b", "b", "a"]
+
+    async def test_add_running(self, advance_time, scheduler):
+        """Calls added while running are scheduled from the current time."""
+        calls = []
+        scheduler.start()
+        await advance_time(5)
+        scheduler.add(ScheduledCall("a", lambda: calls.append("a"), 10, offset=1))
+        await advance_time(0)
+        assert calls == []
+        await advance_time(1)
+        assert calls == ["a"]
+
+    async def test_removed_not_run(self, advance_time, scheduler):
+        """Removed calls are not run anymore."""
+        calls = []
+        scheduler.add(ScheduledCall("a", lambda: calls.append("a"), 10))
+        scheduler.start()
+        await advance_time(0)
+        scheduler.remove("a")
+        await advance_time(10)
+        assert calls == ["a"]
+
+    async def test_jitter(self, mocker, advance_time, scheduler):
+        """Calls are delayed by jitter, without shifting following ones."""
+        mocker.patch("query_exporter.schedule.random.uniform", return_value=3)
+        calls = []
+        scheduler.add(ScheduledCall("a", lambda: calls.append("a"), 10, jitter=5))
+        scheduler.start()
+        await advance_time(2)
+        assert calls == []
+        await advance_time(1)
+        assert calls == ["a"]
+        await advance_time(9)
+        assert calls == ["a"]
+        await advance_time(1)
+        assert calls == ["a", "a"]
+
+    async def test_call_error(self, advance_time, event_loop, scheduler):
+        """Errors from calls are reported, and the call is rescheduled."""
+        errors = []
+        event_loop.set_exception_handler(lambda loop, context: errors.append(context))
+        calls = []
+
+        def func():
+            calls.append("a")
+            raise Exception("fail")
+
+        scheduler.add(ScheduledCall("a", func, 10))
+        scheduler.start()
+        await advance_time(10)
+        assert calls == ["a", "a"]
+        assert [str(error["exception"]) for error in errors] == ["fail", "fail"]
@@ -0,0 +1,304 @@
+import asyncio
+from multiprocessing import Pipe
+
+import pytest
+
+from ..db import (
+    DataBase,
+    DataBaseError,
+    MetricResult,
+    MetricResults,
+    Query,
+    QueryMetric,
+    QueryStats,
+)
+from ..workers import (
+    worker_index,
+    WorkerPool,
+    WorkerResults,
+    WorkerServer,
+)
+
+
+@pytest.fixture
+def databases():
+    yield {"db1": DataBase("db1", "sqlite://"), "db2": DataBase("db2", "sqlite://")}
+
+
+@pytest.fixture
+def queries():
+    yield {
+        "q": Query(
+            "q",
+            10,
+            ["db1", "db2"],
+            [QueryMetric("m", ["l"])],
+            "SELECT 1 AS m, 'foo' AS l",
+        ),
+        "bad": Query(
+            "bad", 10, ["db1"], [QueryMetric("m", [])], "SELECT 1 AS m, 2 AS n"
+        ),
+    }
+
+
+@pytest.fixture
+async def worker_pool(databases, queries):
+    pool = WorkerPool(databases, queries, 2)
+    pool.start()
+    yield pool
+    await pool.stop()
+
+
+def test_worker_index():
+    """Databases are assigned to workers based on their name."""
+    assert worker_index("db", 4) == worker_index("db", 4)
+    assert {worker_index(f"db{index}", 4) for index in range(20)} == {0, 1, 2, 3}
+
+
+class TestWorkerResults:
+    def test_metric_results(self):
+        """WorkerResults are converted to and from MetricResults."""
+        query = Query(
+            "q",
+            10,
+            ["db"],
+            [QueryMetric("m1", ["l1", "l2"]), QueryMetric("m2", [])],
+            "",
+        )
+        stats = QueryStats(1.0, 0.5, 0.5, 1, 2, {})
+        metric_results = MetricResults(
+            [
+                MetricResult("m1", 10, {"l1": "a", "l2": "b"}),
+                MetricResult("m2", 20, {}),
+            ],
+            pool_wait=0.1,
+            stats=stats,
+        )
+        worker_results = WorkerResults.from_metric_results(metric_results)
+        assert worker_results.updates == [("m1", 10, ("a", "b")), ("m2", 20, ())]
+        assert worker_results.metric_results(query) == metric_results
+
+
+@pytest.mark.asyncio
+class TestWorkerPool:
+    async def test_workers(self, databases, queries):
+        """Databases are split across workers."""
+        pool = WorkerPool(databases, queries, 4)
+        assert len(pool) == len({worker_index(name, 4) for name in databases})
+        for name, database in databases.items():
+            assert pool._database_workers[name].databases[name] is database
+
+    async def test_execute(self, worker_pool, queries):
+        """Queries are executed in worker processes."""
+        for dbname in ("db1", "db2"):
+            results = await worker_pool.execute(queries["q"], dbname)
+            assert results.results == [MetricResult("m", 1, {"l": "foo"})]
+            assert results.stats.rows == 1
+
+    async def test_execute_concurrent(self, worker_pool, queries):
+        """Multiple queries can run concurrently in workers."""
+        results = await asyncio.gather(
+            *(worker_pool.execute(queries["q"], "db1") for _ in range(5))
+        )
+        assert len(results) == 5
+
+    async def test_execute_error(self, worker_pool, queries):
+        """Errors from queries in workers are raised."""
+        with pytest.raises(DataBaseError) as error:
+            await worker_pool.execute(queries["bad"], "db1")
+        assert str(error.value) == "Wrong result count from query: expected 1, got 2"
+        assert error.value.fatal
+
+    async def test_execute_handler(self, worker_pool, queries):
+        """If a handler is passed, it's called with results."""
+        handled = []
+        results = await worker_pool.execute(queries["q"], "db1", handler=handled.append)
+        assert handled == [[MetricResult("m", 1, {"l": "foo"})]]
+        assert results.results == []
+        assert results.stats.rows == 1
+
+    async def test_execute_chunks(self, databases):
+        """Results for queries with a chunk size are received in chunks."""
+        query = Query(
+            "q",
+            10,
+            ["db1"],
+            [QueryMetric("m", [])],
+            "SELECT 1 AS m UNION ALL SELECT 2 AS m UNION ALL SELECT 3 AS m",
+            chunk_size=2,
+        )
+        pool = WorkerPool(databases, {"q": query}, 1)
+        pool.start()
+        handled = []
+        results = await pool.execute(query, "db1", handler=handled.append)
+        assert handled == [
+            [MetricResult("m", 1, {}), MetricResult("m", 2, {})],
+            [MetricResult("m", 3, {})],
+        ]
+        assert results.stats.rows == 3
+        # without a handler, results from all chunks are returned
+        results = await pool.execute(query, "db1")
+        assert results.results == [
+            MetricResult("m", 1, {}),
+            MetricResult("m", 2, {}),
+            MetricResult("m", 3, {}),
+        ]
+        await pool.stop()
+
+    async def test_stop(self, databases, queries):
+        """Worker processes are stopped."""
+        pool = WorkerPool(databases, queries, 1)
+        pool.start()
+        [worker] = pool._workers.values()
+        assert worker.running
+        await pool.stop()
+        assert not worker.running
+        # stopping again is a no-op
+        await pool.stop()
+
+    async def test_update(self, databases, queries):
+        """Only workers for changed databases are restarted on update."""
+        # with 4 workers, db1 and db2 are in different ones
+        pool = WorkerPool(databases, queries, 4)
+        pool.start()
+        worker1 = pool._database_workers["db1"]
+        worker2 = pool._database_workers["db2"]
+        new_databases = {
+            "db1": DataBase("db1", "sqlite://"),
+            "db2": databases["db2"],
+        }
+        restarted = await pool.update(new_databases, queries, {"db1"})
+        assert restarted == 1
+        assert not worker1.running
+        assert pool._database_workers["db1"] is not worker1
+        assert pool._database_workers["db1"].databases["db1"] is new_databases["db1"]
+        assert pool._database_workers["db2"] is worker2
+        assert worker2.running
+        results = await pool.execute(queries["q"], "db1")
+        assert results.results == [MetricResult("m", 1, {"l": "foo"})]
+        await pool.stop()
+
+    async def test_update_removed_database(self, databases, queries):
+        """Workers left without databases are stopped on update."""
+        pool = WorkerPool(databases, queries, 4)
+        pool.start()
+        worker1 = pool._database_workers["db1"]
+        worker2 = pool._database_workers["db2"]
+        restarted = await pool.update({"db2": databases["db2"]}, queries, set())
+        assert restarted == 1
+        assert not worker1.running
+        assert list(pool._workers.values()) == [worker2]
+        assert "db1" not in pool._database_workers
+        await pool.stop()
+
+    async def test_worker_terminated(self, databases, queries):
+        """Requests fail if the worker process terminates."""
+        pool = WorkerPool(databases, queries, 1)
+        pool.start()
+        [worker] = pool._workers.values()
+        execution = asyncio.ensure_future(pool.execute(queries["q"], "db1"))
+        # wait for the request to be sent
+        while not worker._pending:
+            await asyncio.sleep(0)
+        worker._process.kill()
+        with pytest.raises(DataBaseError) as error:
+            await execution
+        assert str(error.value) == "worker process terminated unexpectedly"
+        await pool.stop()
+
+    async def test_worker_not_running(self, databases, queries):
+        """Requests to a worker which is not running fail."""
+        pool = WorkerPool(databases, queries, 1)
+        [worker] = pool._workers.values()
+        with pytest.raises(DataBaseError) as error:
+            await worker.execute(queries["q"], "db1")
+        assert str(error.value) == "worker process not running"
+
+    async def test_worker_restarted(self, caplog, databases, queries):
+        """Workers which terminated are restarted when running queries."""
+        pool = WorkerPool(databases, queries, 1)
+        pool.start()
+        [worker] = pool._workers.values()
+        worker._process.kill()
+        worker._process.join()
+        results = await pool.execute(queries["q"], "db1")
+        assert results.results == [MetricResult("m", 1, {"l": "foo"})]
+        [new_worker] = pool._workers.values()
+        assert new_worker is not worker
+        assert new_worker.running
+        assert pool._database_workers["db2"] is new_worker
+        assert "worker process 0 not running, restarting" in caplog.messages
+        await pool.stop()
+
+
+class UnpicklableError(Exception):
+    def __init__(self):
+        super().__init__("unpicklable")
+        self.func = lambda: None
+
+
+@pytest.mark.asyncio
+class TestWorkerServer:
+    async def test_serve(self, event_loop, databases, queries):
+        """Requests are served, until a stop request is received."""
+        conn, worker_conn = Pipe()
+        server = WorkerServer(worker_conn, databases, queries)
+        task = event_loop.create_task(server.serve())
+        conn.send((1, "q", "db1"))
+        request_id, kind, results = await event_loop.run_in_executor(None, conn.recv)
+        assert request_id == 1
+        assert kind == "results"
+        assert results.updates == [("m", 1, ("foo",))]
+        conn.send(None)
+        await task
+        assert not databases["db1"].connected
+
+    async def test_serve_error(self, event_loop, databases, queries):
+        """Errors from queries are sent back."""
+        conn, worker_conn = Pipe()
+        server = WorkerServer(worker_conn, databases, queries)
+        task = event_loop.create_task(server.serve())
+        conn.send((1, "bad", "db1"))
+        request_id, kind, error = await event_loop.run_in_executor(None, conn.recv)
+        assert request_id == 1
+        assert kind == "error"
+        assert isinstance(error, DataBaseError)
+        assert error.fatal
+        conn.close()
+        await task
+
+    async def test_serve_unpicklable_error(
+        self, mocker, event_loop, databases, queries
+    ):
+        """Errors that can't be sent back are replaced with DataBaseErrors."""
+        mocker.patch.object(databases["db1"], "execute", side_effect=UnpicklableError())
+        conn, worker_conn = Pipe()
+        server = WorkerServer(worker_conn, databases, queries)
+        task = event_loop.create_task(server.serve())
+        conn.send((1, "q", "db1"))
+        _, kind, error = await event_loop.run_in_executor(None, conn.recv)
+        assert kind == "error"
+        assert isinstance(error, DataBaseError)
+        assert str(error).startswith("failed sending results: ")
+        conn.send(None)
+        await task
+
+    async def test_serve_stop_cancels_queries(
+        self, mocker, event_loop, databases, queries
+    ):
+        """Running queries are cancelled when the server stops."""
+        started = asyncio.Event()
+
+        async def execute(query, handler=None):
+            started.set()
+            await asyncio.sleep(10)
+
+        mocker.patch.object(databases["db1"], "execute", execute)
+        conn, worker_conn = Pipe()
+        server = WorkerServer(worker_conn, databases, queries)
+        task = event_loop.create_task(server.serve())
+        conn.send((1, "q", "db1"))
+        await started.wait()
+        conn.send(None)
+        await task
+        assert server._tasks == {}
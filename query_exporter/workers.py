@@ -0,0 +1,451 @@
+"""Worker processes for executing queries."""
+
+import asyncio
+from collections import defaultdict
+from functools import partial
+from itertools import count
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+import signal
+from typing import (
+    AbstractSet,
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+import zlib
+
+from .db import (
+    DataBase,
+    DataBaseError,
+    ExecutorBackend,
+    MetricResult,
+    MetricResults,
+    Query,
+    QueryStats,
+    ResultsHandler,
+)
+
+# a metric update from a worker, as (metric, value, label values)
+_Update = Tuple[str, Any, Tuple[str, ...]]
+
+# kinds of responses from workers.  Results for queries with a chunk size are
+# sent in multiple chunks before the final response
+_RESULTS = "results"
+_CHUNK = "chunk"
+_ERROR = "error"
+
+# time to wait for worker processes to exit on stop
+_STOP_TIMEOUT = 5.0
+
+
+class WorkerResults(NamedTuple):
+    """Compact results for a query execution sent by a worker.
+
+    Label values for each metric update are in the same order as labels of the
+    corresponding QueryMetric.
+
+    """
+
+    updates: List[_Update]
+    pool_wait: Optional[float]
+    stats: Optional[QueryStats]
+
+    @classmethod
+    def from_metric_results(cls, results: MetricResults) -> "WorkerResults":
+        """Return WorkerResults from MetricResults."""
+        updates = [
+            (result.metric, result.value, tuple(result.labels.values()))
+            for result in results.results
+        ]
+        return cls(updates, results.pool_wait, results.stats)
+
+    def metric_results(self, query: Query) -> MetricResults:
+        """Return MetricResults for the query."""
+        labels = {metric.name: metric.labels for metric in query.metrics}
+        results = [
+            MetricResult(name, value, dict(zip(labels[name], label_values)))
+            for name, value, label_values in self.updates
+        ]
+        return MetricResults(results, pool_wait=self.pool_wait, stats=self.stats)
+
+
+class _PendingRequest(NamedTuple):
+    """A request sent to a worker, waiting for results."""
+
+    future: asyncio.Future
+    receive_chunk: Callable[[WorkerResults], None]
+
+
+def worker_index(dbname: str, workers: int) -> int:
+    """Return the index of the worker running queries for a database."""
+    return zlib.crc32(dbname.encode("utf-8")) % workers
+
+
+class Worker:
+    """A process running queries on a set of databases.
+
+    Requests are sent to the process through a pipe, and results are
+    received asynchronously from the event loop.
+
+    """
+
+    def __init__(
+        self,
+        databases: Dict[str, DataBase],
+        queries: Dict[str, Query],
+        log_level: int = logging.WARNING,
+    ):
+        self.databases = databases
+        self.queries = queries
+        self.log_level = log_level
+        self.loop = asyncio.get_event_loop()
+        # processes are spawned, since forking a process with a running event
+        # loop is not safe
+        context = multiprocessing.get_context("spawn")
+        self._conn, worker_conn = context.Pipe()
+        self._process = context.Process(
+            target=run_worker,
+            args=(
+                worker_conn,
+                databases,
+                queries,
+                log_level,
+                ExecutorBackend.max_threads,
+            ),
+            daemon=True,
+        )
+        self._request_ids = count()
+        self._pending: Dict[int, _PendingRequest] = {}
+
+    @property
+    def running(self) -> bool:
+        """Whether the worker process is running and accepting requests."""
+        return not self._conn.closed and self._process.is_alive()
+
+    def start(self):
+        """Start the worker process."""
+        self._process.start()
+        self.loop.add_reader(self._conn.fileno(), self._receive)
+
+    async def stop(self):
+        """Stop the worker process."""
+        if self._conn.closed:
+            return
+        self.loop.remove_reader(self._conn.fileno())
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass  # the worker already exited
+        await self.loop.run_in_executor(None, self._process.join, _STOP_TIMEOUT)
+        if self._process.is_alive():
+            self._process.kill()
+        self._conn.close()
+        self._fail_pending()
+
+    async def execute(
+        self, query: Query, dbname: str, handler: Optional[ResultsHandler] = None
+    ) -> MetricResults:
+        """Execute a query on a database in the worker.
+
+        As for DataBase.execute(), if a handler is passed it's called with
+        results as they're received, and results are not included in the
+        returned MetricResults.
+
+        """
+        if not self.running:
+            raise DataBaseError("worker process not running")
+        collected: List[MetricResult] = []
+        report = handler or collected.extend
+
+        def receive_chunk(chunk: WorkerResults):
+            report(chunk.metric_results(query).results)
+
+        request_id = next(self._request_ids)
+        future = self.loop.create_future()
+        self._pending[request_id] = _PendingRequest(future, receive_chunk)
+        try:
+            try:
+                self._conn.send((request_id, query.name, dbname))
+            except OSError as error:
+                raise DataBaseError(f"failed sending request to worker: {error}")
+            worker_results: WorkerResults = await future
+        finally:
+            self._pending.pop(request_id, None)
+        metric_results = worker_results.metric_results(query)
+        if metric_results.results:
+            report(metric_results.results)
+        return metric_results._replace(results=collected)
+
+    def _receive(self):
+        """Receive a response from the worker process."""
+        try:
+            request_id, kind, payload = self._conn.recv()
+        except (EOFError, OSError):
+            # the worker process terminated
+            self.loop.remove_reader(self._conn.fileno())
+            self._conn.close()
+            self._fail_pending()
+            return
+        pending = self._pending.get(request_id)
+        if pending is None or pending.future.done():
+            return
+        if kind == _CHUNK:
+            try:
+                pending.receive_chunk(payload)
+            except Exception as error:
+                pending.future.set_exception(error)
+        elif kind == _ERROR:
+            pending.future.set_exception(payload)
+        else:
+            pending.future.set_result(payload)
+
+    def _fail_pending(self):
+        """Fail pending requests, since the worker is not running."""
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(
+                    DataBaseError("worker process terminated unexpectedly")
+                )
+
+
+class WorkerPool:
+    """A pool of worker processes running queries.
+
+    Each database is assigned to a worker based on a hash of its name, so
+    that connections to a database are kept in a single process.
+
+    Workers which terminate unexpectedly are restarted when a query for one
+    of their databases is executed.
+
+    """
+
+    def __init__(
+        self,
+        databases: Dict[str, DataBase],
+        queries: Dict[str, Query],
+        size: int,
+        log_level: int = logging.WARNING,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.size = size
+        self._log_level = log_level
+        self._logger = logger or logging.getLogger()
+        # map worker indexes to workers, only for those with databases
+        self._workers: Dict[int, Worker] = {
+            index: self._make_worker(dbs, queries)
+            for index, dbs in self._split_databases(databases).items()
+        }
+        self._database_workers: Dict[str, Worker] = {}
+        self._map_databases()
+        self._restart_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def start(self):
+        """Start worker processes."""
+        for worker in self._workers.values():
+            worker.start()
+
+    async def stop(self):
+        """Stop worker processes."""
+        await asyncio.gather(*(worker.stop() for worker in self._workers.values()))
+
+    async def update(
+        self,
+        databases: Dict[str, DataBase],
+        queries: Dict[str, Query],
+        changed_databases: AbstractSet[str],
+    ) -> int:
+        """Update databases and queries, restarting affected workers.
+
+        Only workers with a different set of databases, or with databases in
+        `changed_databases` (whose definition or queries changed), are
+        restarted.  Others keep running with their connections.
+
+        Return the number of restarted workers.
+
+        """
+        restarted = 0
+        workers: Dict[int, Worker] = {}
+        new_databases = self._split_databases(databases)
+        for index in set(self._workers) | set(new_databases):
+            worker = self._workers.get(index)
+            dbs = new_databases.get(index, {})
+            if (
+                worker is not None
+                and set(worker.databases) == set(dbs)
+                and not changed_databases & set(dbs)
+            ):
+                workers[index] = worker
+                continue
+            if worker is not None:
+                await worker.stop()
+            if dbs:
+                workers[index] = self._make_worker(dbs, queries)
+                workers[index].start()
+            restarted += 1
+        self._workers = workers
+        self._map_databases()
+        return restarted
+
+    async def execute(
+        self, query: Query, dbname: str, handler: Optional[ResultsHandler] = None
+    ) -> MetricResults:
+        """Execute a query on a database in the worker for the database."""
+        worker = self._database_workers[dbname]
+        if not worker.running:
+            worker = await self._restart_worker(dbname)
+        return await worker.execute(query, dbname, handler=handler)
+
+    async def _restart_worker(self, dbname: str) -> Worker:
+        """Restart the worker for a database, if not running."""
+        async with self._restart_lock:
+            index = worker_index(dbname, self.size)
+            worker = self._workers[index]
+            if worker.running:
+                # already restarted by a concurrent call
+                return worker
+            self._logger.warning(f"worker process {index} not running, restarting")
+            await worker.stop()
+            worker = self._make_worker(worker.databases, worker.queries)
+            worker.start()
+            self._workers[index] = worker
+            self._map_databases()
+            return worker
+
+    def _split_databases(
+        self, databases: Dict[str, DataBase]
+    ) -> Dict[int, Dict[str, DataBase]]:
+        """Return databases for each worker index."""
+        worker_databases: Dict[int, Dict[str, DataBase]] = defaultdict(dict)
+        for name, database in databases.items():
+            worker_databases[worker_index(name, self.size)][name] = database
+        return worker_databases
+
+    def _make_worker(
+        self, databases: Dict[str, DataBase], queries: Dict[str, Query]
+    ) -> Worker:
+        """Return a worker for databases, with queries running on them."""
+        return Worker(
+            databases,
+            {
+                name: query
+                for name, query in queries.items()
+                if set(query.databases) & set(databases)
+            },
+            log_level=self._log_level,
+        )
+
+    def _map_databases(self):
+        """Map database names to their worker."""
+        self._database_workers = {
+            name: worker
+            for worker in self._workers.values()
+            for name in worker.databases
+        }
+
+
+class WorkerServer:
+    """Run queries for requests received in a worker process."""
+
+    def __init__(
+        self,
+        conn: Connection,
+        databases: Dict[str, DataBase],
+        queries: Dict[str, Query],
+    ):
+        self.conn = conn
+        self.databases = databases
+        self.queries = queries
+        self.loop = asyncio.get_event_loop()
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._stopped = self.loop.create_future()
+
+    async def serve(self):
+        """Serve requests until stopped."""
+        self.loop.add_reader(self.conn.fileno(), self._receive)
+        try:
+            await self._stopped
+        finally:
+            self.loop.remove_reader(self.conn.fileno())
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(
+                *(db.close() for db in self.databases.values()), return_exceptions=True,
+            )
+
+    def _receive(self):
+        """Receive a request, starting the query execution."""
+        try:
+            request = self.conn.recv()
+        except (EOFError, OSError):
+            request = None
+        if request is None:
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+            return
+        request_id, query_name, dbname = request
+        self._tasks[request_id] = self.loop.create_task(
+            self._execute(request_id, query_name, dbname)
+        )
+
+    async def _execute(self, request_id: int, query_name: str, dbname: str):
+        """Execute a query and send back results.
+
+        Results for queries with a chunk size are sent as each chunk is
+        processed, so that the whole result is never held in memory.
+
+        """
+        query = self.queries[query_name]
+        handler = None
+        if query.chunk_size:
+            handler = partial(self._send_chunk, request_id)
+        try:
+            results = await self.databases[dbname].execute(query, handler=handler)
+        except Exception as error:
+            self._send(request_id, _ERROR, error)
+        else:
+            self._send(request_id, _RESULTS, WorkerResults.from_metric_results(results))
+        finally:
+            del self._tasks[request_id]
+
+    def _send_chunk(self, request_id: int, results: List[MetricResult]):
+        """Send a chunk of results for a request."""
+        chunk = WorkerResults.from_metric_results(MetricResults(results))
+        self._send(request_id, _CHUNK, chunk)
+
+    def _send(self, request_id: int, kind: str, payload: Any):
+        """Send a response for a request."""
+        try:
+            self.conn.send((request_id, kind, payload))
+        except Exception as error:
+            # payload is pickled before sending, so nothing has been sent
+            self.conn.send(
+                (request_id, _ERROR, DataBaseError(f"failed sending results: {error}"))
+            )
+
+
+def run_worker(
+    conn: Connection,
+    databases: Dict[str, DataBase],
+    queries: Dict[str, Query],
+    log_level: int,
+    executor_threads: Optional[int] = None,
+):
+    """Entry point for worker processes."""
+    # interrupts are handled by the main process, which stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level)
+    ExecutorBackend.max_threads = executor_threads
+    loop = asyncio.get_event_loop()
+    server = WorkerServer(conn, databases, queries)
+    loop.run_until_complete(server.serve())